@@ -13,6 +13,7 @@ from move.conf.schema import (
     TuneModelConfig,
 )
 from move.core.logging import get_logger
+from move.visualization.rendering import plotting_session
 
 
 @hydra.main(
@@ -29,19 +30,21 @@ def main(config: MOVEConfig) -> None:
     if not hasattr(config, "task"):
         raise ValueError("No task defined.")
     task_type = OmegaConf.get_type(config.task)
-    if task_type is None:
-        logger = get_logger("move")
-        logger.info("No task specified.")
-    elif task_type is EncodeDataConfig:
-        move.tasks.encode_data(config.data)
-    elif issubclass(task_type, TuneModelConfig):
-        move.tasks.tune_model(config)
-    elif task_type is AnalyzeLatentConfig:
-        move.tasks.analyze_latent(config)
-    elif issubclass(task_type, IdentifyAssociationsConfig):
-        move.tasks.identify_associations(config)
-    else:
-        raise ValueError("Unsupported type of task.")
+    # Figures are rendered in the background, and finished before exiting
+    with plotting_session(config.plotting):
+        if task_type is None:
+            logger = get_logger("move")
+            logger.info("No task specified.")
+        elif task_type is EncodeDataConfig:
+            move.tasks.encode_data(config.data)
+        elif issubclass(task_type, TuneModelConfig):
+            move.tasks.tune_model(config)
+        elif task_type is AnalyzeLatentConfig:
+            move.tasks.analyze_latent(config)
+        elif issubclass(task_type, IdentifyAssociationsConfig):
+            move.tasks.identify_associations(config)
+        else:
+            raise ValueError("Unsupported type of task.")
 
 
 if __name__ == "__main__":
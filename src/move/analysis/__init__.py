@@ -1,6 +1,13 @@
-__all__ = ["calculate_accuracy", "calculate_cosine_similarity"]
+__all__ = [
+    "calculate_accuracy",
+    "calculate_cosine_similarity",
+    "calculate_ks_statistics",
+    "calculate_reconstruction_qc",
+]
 
 from move.analysis.metrics import (
     calculate_accuracy,
     calculate_cosine_similarity,
+    calculate_ks_statistics,
+    calculate_reconstruction_qc,
 )
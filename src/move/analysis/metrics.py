@@ -1,4 +1,12 @@
-__all__ = ["calculate_accuracy", "calculate_cosine_similarity"]
+__all__ = [
+    "calculate_accuracy",
+    "calculate_cosine_similarity",
+    "calculate_ks_statistics",
+    "calculate_reconstruction_qc",
+]
+
+import math
+from typing import Optional
 
 import numpy as np
 
@@ -69,6 +77,160 @@ def calculate_cosine_similarity(
     return np.ma.filled(scores, 0)
 
 
+# Largest sample size for which SciPy's `ks_2samp` computes exact p-values
+# (in "auto" mode), which rounds the statistic to a multiple of 1/lcm(n1, n2)
+MAX_EXACT_KS_SAMPLES = 10_000
+
+
+def calculate_ks_statistics(
+    data1: FloatArray, data2: FloatArray, chunk_size: Optional[int] = None
+) -> tuple[FloatArray, FloatArray]:
+    """Compute the two-sided two-sample Kolmogorov-Smirnov statistic of each
+    column. The result is the same as calling `scipy.stats.ks_2samp` on every
+    pair of columns, but all columns are sorted and compared at once.
+
+    Both samples of a column are merged and sorted. Cumulative counts of each
+    sample along the merged order give both empirical distribution functions,
+    which are compared at the last of each run of equal values.
+
+    Args:
+        data1: First sample of each column (2D: N1 x C).
+        data2: Second sample of each column (2D: N2 x C).
+        chunk_size: Number of columns processed at once. By default, chosen
+            so that each chunk has about 16M merged values.
+
+    Returns:
+        Tuple containing the statistic and the statistic sign (+1 if the
+        empirical distribution function of the first sample exceeds that of
+        the second at the statistic location, -1 otherwise) of each column.
+        Both are NaN for columns with NaNs.
+    """
+    if data1.ndim != 2 or data2.ndim != 2:
+        raise ValueError("Expected both inputs to have two dimensions.")
+    if data1.shape[1] != data2.shape[1]:
+        raise ValueError(
+            f"First sample {data1.shape} and second sample {data2.shape} "
+            "columns do not match."
+        )
+    n1, n2 = data1.shape[0], data2.shape[0]
+    if min(n1, n2) == 0:
+        raise ValueError("Samples must not be empty.")
+    num_columns = data1.shape[1]
+    if chunk_size is None:
+        chunk_size = max(1, 2**24 // (n1 + n2))
+
+    statistics = np.empty(num_columns)
+    signs = np.empty(num_columns)
+    num_seen = np.arange(1, n1 + n2 + 1)[:, np.newaxis]
+    for start in range(0, num_columns, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        merged = np.concatenate((data1[:, chunk], data2[:, chunk]), axis=0)
+        order = np.argsort(merged, axis=0, kind="stable")
+        merged = np.take_along_axis(merged, order, axis=0)
+
+        # Number of values of each sample up to each position
+        count1 = np.cumsum(order < n1, axis=0)
+        cddiffs = count1 / n1 - (num_seen - count1) / n2
+
+        # Distribution functions include all equal values, so only the last
+        # of each run of equal values is compared
+        is_last = np.ones(merged.shape, dtype=bool)
+        is_last[:-1] = merged[1:] != merged[:-1]
+        max_s = np.max(np.where(is_last, cddiffs, -np.inf), axis=0)
+        min_s = np.clip(-np.min(np.where(is_last, cddiffs, np.inf), axis=0), 0, 1)
+
+        is_negative = min_s > max_s
+        statistics[chunk] = np.where(is_negative, min_s, max_s)
+        signs[chunk] = np.where(is_negative, -1.0, 1.0)
+
+        has_nan = np.isnan(merged).any(axis=0)
+        statistics[chunk][has_nan] = np.nan
+        signs[chunk][has_nan] = np.nan
+
+    if max(n1, n2) <= MAX_EXACT_KS_SAMPLES:
+        lcm = (n1 // math.gcd(n1, n2)) * n2
+        statistics = np.round(statistics * lcm) / lcm
+    return statistics, signs
+
+
+def calculate_reconstruction_qc(
+    original_input: FloatArray,
+    reconstruction: FloatArray,
+    chunk_size: Optional[int] = None,
+) -> tuple[FloatArray, FloatArray]:
+    """Fit a 2nd order polynomial and compute the Pearson correlation between
+    each feature and its reconstruction. The results are equivalent to calling
+    `np.polyfit(x, y, deg=2)` and `scipy.stats.pearsonr(x, y)` per column.
+
+    Polynomials are fitted on the standardized original values, which keeps
+    the normal equations well conditioned, and their coefficients are then
+    transformed back. Columns with constant values have a flat polynomial and
+    a NaN correlation.
+
+    Args:
+        original_input: Original values (2D: N x C).
+        reconstruction: Reconstructed values (2D: N x C).
+        chunk_size: Number of columns processed at once. By default, chosen
+            so that each chunk has about 4M values.
+
+    Returns:
+        Tuple containing the polynomial coefficients (2D: C x 3, highest power
+        first) and the correlation of each column.
+    """
+    if any((original_input.ndim != 2, reconstruction.ndim != 2)):
+        raise ValueError("Expected both inputs to have two dimensions.")
+    if original_input.shape != reconstruction.shape:
+        raise ValueError(
+            f"Original input {original_input.shape} and reconstruction "
+            f"{reconstruction.shape} shapes do not match."
+        )
+    num_samples, num_columns = original_input.shape
+    if chunk_size is None:
+        chunk_size = max(1, 2**22 // num_samples)
+
+    coefficients = np.empty((num_columns, 3))
+    correlations = np.empty(num_columns)
+    for start in range(0, num_columns, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        x = original_input[:, chunk].astype(np.float64)
+        y = reconstruction[:, chunk].astype(np.float64)
+
+        x_mean, x_std = x.mean(axis=0), x.std(axis=0)
+        x_std[x_std == 0] = 1.0
+        y_mean = y.mean(axis=0)
+        x = (x - x_mean) / x_std
+        y -= y_mean
+
+        # Normal equations of the basis (1, x, x^2), solved for all columns
+        x2 = x * x
+        s1, s2 = x.sum(axis=0), x2.sum(axis=0)
+        s3, s4 = (x2 * x).sum(axis=0), (x2 * x2).sum(axis=0)
+        gram = np.stack(
+            [
+                np.stack([np.full_like(s1, num_samples), s1, s2], axis=-1),
+                np.stack([s1, s2, s3], axis=-1),
+                np.stack([s2, s3, s4], axis=-1),
+            ],
+            axis=-2,
+        )
+        xy = (x * y).sum(axis=0)
+        moments = np.stack([y.sum(axis=0), xy, (x2 * y).sum(axis=0)], axis=-1)
+        b0, b1, b2 = (np.linalg.pinv(gram) @ moments[..., np.newaxis])[..., 0].T
+
+        # Back to the original scale: b2 * t^2 + b1 * t + b0, t = (x - m) / s
+        coefficients[chunk, 0] = b2 / x_std**2
+        coefficients[chunk, 1] = b1 / x_std - 2 * b2 * x_mean / x_std**2
+        coefficients[chunk, 2] = (
+            b0 + y_mean - b1 * x_mean / x_std + b2 * x_mean**2 / x_std**2
+        )
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r = xy / np.sqrt(s2 * (y * y).sum(axis=0))
+        correlations[chunk] = np.clip(r, -1.0, 1.0)
+
+    return coefficients, correlations
+
+
 def norm(x: np.ma.MaskedArray, axis: int = 1) -> np.ma.MaskedArray:
     """Return Euclidean norm. This function is equivalent to `np.linalg.norm`,
     but it can handle masked arrays.
@@ -37,6 +37,16 @@ class ContinuousInputConfig(InputConfig):
 
 @dataclass
 class DataConfig:
+    """Configure the input data.
+
+    Attributes:
+        sparse_input:
+            Whether to hold the training data as sparse tensors (CSR), which
+            saves memory and speeds up the first encoder layer when most
+            values are zeros (e.g., one-hot encoded categories, or missing
+            values of continuous datasets, which are encoded as zeros).
+    """
+
     raw_data_path: str = MISSING
     interim_data_path: str = MISSING
     results_path: str = MISSING
@@ -47,6 +57,7 @@ class DataConfig:
     continuous_names: list[str] = MISSING
     categorical_weights: list[int] = MISSING
     continuous_weights: list[int] = MISSING
+    sparse_input: bool = False
 
 
 @dataclass
@@ -57,7 +68,17 @@ class ModelConfig:
 
 @dataclass
 class VAEConfig(ModelConfig):
-    """Configuration for the VAE module."""
+    """Configuration for the VAE module.
+
+    Attributes:
+        precision:
+            Precision of the forward passes (training and inference): "float32"
+            (default), or "bfloat16" and "float16" to run them with autocast,
+            which roughly halves memory traffic on CPUs with native support.
+            Weights, losses and outputs remain float32. In the probabilistic
+            approach to identify associations, the deviation of the Bayes
+            factors from float32 is reported.
+    """
 
     _target_: str = get_fully_qualname(VAE)
     categorical_weights: list[int] = MISSING
@@ -67,10 +88,29 @@ class VAEConfig(ModelConfig):
     beta: float = MISSING
     dropout: float = MISSING
     cuda: bool = False
+    precision: str = "float32"
 
 
 @dataclass
 class TrainingLoopConfig:
+    """Configure the training loop.
+
+    Attributes:
+        optimizer:
+            Optimizer kept for the whole training, as a partially instantiated
+            class receiving the model parameters and `lr` (e.g., `_target_:
+            torch.optim.AdamW`, `_partial_: true`). Defaults to Adam.
+        lr_scheduler:
+            Learning rate scheduler stepped after every epoch, as a partially
+            instantiated class receiving the optimizer (e.g., `_target_:
+            torch.optim.lr_scheduler.CosineAnnealingLR`, `_partial_: true`,
+            `T_max: 50`). If not set, the learning rate is constant (except for
+            the reductions of early stopping).
+        reset_optimizer:
+            Whether to create a new optimizer every epoch, discarding its state,
+            as older versions did. Only useful to reproduce older results.
+    """
+
     _target_: str = get_fully_qualname(training_loop)
     num_epochs: int = MISSING
     lr: float = MISSING
@@ -78,6 +118,59 @@ class TrainingLoopConfig:
     batch_dilation_steps: list[int] = MISSING
     early_stopping: bool = MISSING
     patience: int = MISSING
+    optimizer: Any = None
+    lr_scheduler: Any = None
+    reset_optimizer: bool = False
+
+
+@dataclass
+class ParallelConfig:
+    """Configure the pool of worker processes used by multiprocess tasks.
+
+    Attributes:
+        workers:
+            Number of worker processes. If not set, it is derived from the CPUs
+            available to MOVE (honoring CPU affinity and cgroup quotas), the
+            number of threads per worker, and leaving one CPU for the main
+            process.
+        chunksize:
+            Number of tasks sent to a worker at once.
+        threads_per_worker:
+            Number of intra-op threads used by PyTorch in each worker.
+        pin_cores:
+            Whether to pin each worker to its own set of cores.
+        auto:
+            Whether to benchmark a few tasks with different numbers of workers
+            and threads, and pick the fastest layout. Overrides `workers` and
+            `threads_per_worker`.
+    """
+
+    workers: Optional[int] = None
+    chunksize: int = 1
+    threads_per_worker: int = 1
+    pin_cores: bool = False
+    auto: bool = False
+
+
+@dataclass
+class PlottingConfig:
+    """Configure how figures are rendered.
+
+    Attributes:
+        enabled:
+            Whether to render figures. If disabled, no figure is saved.
+        workers:
+            Number of background processes rendering figures, so that tasks do
+            not wait for them. If zero, figures are rendered by the main
+            process as soon as they are created.
+        max_figures:
+            Maximum number of figures rendered in a run. Further figures are
+            skipped. If not set, there is no limit.
+    """
+
+    enabled: bool = True
+    workers: int = 1
+    max_figures: Optional[int] = None
 
 
 @dataclass
@@ -113,9 +206,26 @@ class TuneModelConfig(TaskConfig):
 
 @dataclass
 class TuneModelStabilityConfig(TuneModelConfig):
-    """Configure the "tune model" task."""
+    """Configure the "tune model" task.
+
+    Attributes:
+        num_refits:
+            Number of times to refit the model.
+        training_parallel:
+            Configuration of the pool of worker processes that trains the
+            refits. By default, refits are trained one after another in the
+            main process.
+        ensemble_training:
+            Whether to train all refits at once, as an ensemble of stacked
+            models. Refits share the order of the training batches, and
+            `training_parallel` is ignored.
+    """
 
     num_refits: int = MISSING
+    training_parallel: ParallelConfig = field(
+        default_factory=lambda: ParallelConfig(workers=1)
+    )
+    ensemble_training: bool = False
 
 
 @dataclass
@@ -131,11 +241,21 @@ class AnalyzeLatentConfig(TaskConfig):
 
     Attributes:
         feature_names:
-            Names of features to visualize."""
+            Names of features to visualize.
+        parallel:
+            Configuration of the pool of worker processes (if `multiprocess`
+            is enabled).
+        quantize:
+            Whether to quantize the linear layers of the model (int8 weights,
+            dynamically quantized activations) to compute feature importance.
+            Only runs on the CPU and in float32. A QC report comparing
+            quantized and float reconstructions is saved."""
 
     feature_names: list[str] = field(default_factory=list)
     reducer: dict[str, Any] = MISSING
     multiprocess: bool = False
+    parallel: ParallelConfig = field(default_factory=ParallelConfig)
+    quantize: bool = False
 
 
 @dataclass
@@ -159,6 +279,49 @@ class IdentifyAssociationsConfig(TaskConfig):
         save_models:
             Whether to save the weights of each refit. If weights are saved,
             rerunning the task will load them instead of training.
+        perturbation_block_size:
+            Number of perturbed features whose perturbations are stacked and
+            reconstructed in a single forward pass (all approaches but the
+            serial KS approach). Memory grows linearly with this value, but
+            not with the number of perturbed features: a block needs about 13
+            bytes per sample and continuous feature for each of its
+            perturbations.
+        resume:
+            Whether to resume an interrupted run. Partial results are always
+            stored as they are computed (under the interim data path), and
+            if this is enabled, results stored by a previous run with the same
+            configuration and data are reused. In the Bayes approach, stored
+            results are only valid for the refits that computed them, so if
+            this is enabled, refits are always saved: in the results store,
+            unless `save_refits` is enabled.
+        parallel:
+            Configuration of the pool of worker processes (if `multiprocess`
+            is enabled).
+        training_parallel:
+            Configuration of the pool of worker processes that trains the
+            refits. By default, refits are trained one after another in the
+            main process. Set `workers` to train several refits at once, each
+            with `threads_per_worker` threads.
+        results_format:
+            Format of the table of significant associations: "tsv" (default),
+            or the compressed columnar formats "parquet" and "feather", which
+            store feature names and datasets dictionary-encoded. Columnar
+            formats require pyarrow.
+        inference_backend:
+            Compile the evaluation graph of the refits (with batch
+            normalizations folded into linear layers) to reconstruct and
+            project perturbed data: "script" (TorchScript) or "compile"
+            (`torch.compile`). Disabled by default.
+        quantize:
+            Whether to quantize the linear layers of the refits (int8 weights,
+            dynamically quantized activations) before the perturbations. Only
+            runs on the CPU, in float32 and without `inference_backend`. A QC
+            report comparing quantized and float reconstructions of each refit
+            is saved next to the refits.
+        ensemble_training:
+            Whether to train all refits at once, as an ensemble of stacked
+            models (in the main process). Refits share the order of the
+            training batches, and `training_parallel` is ignored.
     """
 
     target_dataset: str = MISSING
@@ -167,6 +330,16 @@ class IdentifyAssociationsConfig(TaskConfig):
     sig_threshold: float = 0.05
     save_refits: bool = False
     multiprocess: bool = False
+    perturbation_block_size: int = 16
+    resume: bool = True
+    parallel: ParallelConfig = field(default_factory=ParallelConfig)
+    training_parallel: ParallelConfig = field(
+        default_factory=lambda: ParallelConfig(workers=1)
+    )
+    results_format: str = "tsv"
+    inference_backend: Optional[str] = None
+    quantize: bool = False
+    ensemble_training: bool = False
 
 
 @dataclass
@@ -215,6 +388,7 @@ class MOVEConfig:
     defaults: list[Any] = field(default_factory=lambda: [dict(data="base_data")])
     data: DataConfig = MISSING
     task: TaskConfig = MISSING
+    plotting: PlottingConfig = field(default_factory=PlottingConfig)
     seed: Optional[int] = None
 
 
@@ -231,6 +405,11 @@ def extract_names(configs: list[InputConfig]) -> list[str]:
 # Store config schema
 cs = ConfigStore.instance()
 cs.store(name="config_schema", node=MOVEConfig)
+cs.store(
+    group="plotting",
+    name="plotting_schema",
+    node=PlottingConfig,
+)
 cs.store(
     group="task",
     name="encode_data",
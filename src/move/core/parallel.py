@@ -0,0 +1,206 @@
+__all__ = ["PoolLayout", "get_available_cpus", "get_pool_layout", "make_pool"]
+
+import multiprocessing
+import os
+import time
+from multiprocessing.pool import Pool as ProcessPool
+from pathlib import Path
+from typing import Any, Callable, NamedTuple, Optional, Sequence
+
+import torch
+from torch.multiprocessing import Pool
+
+from move.conf.schema import ParallelConfig
+from move.core.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class PoolLayout(NamedTuple):
+    """Number of worker processes, threads per worker, and whether workers are
+    pinned to cores."""
+
+    workers: int
+    threads: int
+    pin_cores: bool = False
+
+
+def _get_cgroup_cpu_limit() -> Optional[int]:
+    """Return the number of CPUs allowed by the cgroup CPU quota, if any."""
+    try:
+        cpu_max_path = Path("/sys/fs/cgroup/cpu.max")  # cgroup v2
+        if cpu_max_path.exists():
+            quota, period = cpu_max_path.read_text().split()[:2]
+            if quota == "max":
+                return None
+            return max(1, int(quota) // int(period))
+        quota_path = Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")  # cgroup v1
+        period_path = Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+        if quota_path.exists() and period_path.exists():
+            quota = int(quota_path.read_text())
+            if quota <= 0:
+                return None
+            return max(1, quota // int(period_path.read_text()))
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _get_cpu_affinity() -> list[int]:
+    """Return the cores this process is allowed to run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def get_available_cpus() -> int:
+    """Return the number of CPUs available to this process, honoring both CPU
+    affinity and cgroup quotas."""
+    num_cpus = len(_get_cpu_affinity())
+    cgroup_limit = _get_cgroup_cpu_limit()
+    if cgroup_limit is not None:
+        num_cpus = min(num_cpus, cgroup_limit)
+    return num_cpus
+
+
+def _init_pool_worker(
+    threads: int,
+    core_sets: Optional[list[list[int]]],
+    counter: Any,
+    initializer: Optional[Callable[..., None]],
+    initargs: tuple,
+) -> None:
+    """Set the threads (and cores) of a worker process, then run the task
+    initializer."""
+    # Limit intra-op threads, to avoid CPU oversubscription
+    torch.set_num_threads(threads)
+    if core_sets is not None:
+        with counter.get_lock():
+            worker_index = counter.value
+            counter.value += 1
+        os.sched_setaffinity(0, core_sets[worker_index % len(core_sets)])
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def make_pool(
+    layout: PoolLayout,
+    initializer: Optional[Callable[..., None]] = None,
+    initargs: tuple = (),
+) -> ProcessPool:
+    """Create a pool of worker processes following a layout.
+
+    Args:
+        layout: number of workers, threads per worker and core pinning
+        initializer: function run once in each worker process
+        initargs: arguments of the initializer
+
+    Returns:
+        Pool of worker processes
+    """
+    core_sets = None
+    if layout.pin_cores and hasattr(os, "sched_setaffinity"):
+        cores = _get_cpu_affinity()
+        num_threads = min(layout.threads, len(cores))
+        core_sets = [
+            [cores[(i * layout.threads + t) % len(cores)] for t in range(num_threads)]
+            for i in range(layout.workers)
+        ]
+    counter = multiprocessing.Value("i", 0)
+    return Pool(
+        processes=layout.workers,
+        initializer=_init_pool_worker,
+        initargs=(layout.threads, core_sets, counter, initializer, initargs),
+    )
+
+
+def _benchmark_layouts(
+    config: ParallelConfig,
+    func: Callable[[Any], Any],
+    tasks: Sequence[Any],
+    initializer: Optional[Callable[..., None]],
+    initargs: tuple,
+) -> tuple[PoolLayout, list[Any]]:
+    """Time a few tasks with every candidate layout (a power of two threads
+    per worker, and as many workers as fit in the available CPUs) and return
+    the one with the highest throughput, along with the results of the timed
+    tasks.
+
+    Each candidate runs two tasks per worker, picking up where the previous
+    candidate stopped, so the timed tasks are the first tasks and none of them
+    is computed twice. Candidates that cannot give one task to every worker
+    are skipped."""
+    num_cpus = get_available_cpus()
+    candidates = []
+    threads = 1
+    while threads <= num_cpus:
+        workers = max(1, num_cpus // threads)
+        candidates.append(PoolLayout(workers, threads, config.pin_cores))
+        threads *= 2
+
+    results: list[Any] = []
+    best_layout, best_rate = candidates[0], 0.0
+    for layout in candidates:
+        sample = tasks[len(results) : len(results) + 2 * layout.workers]
+        if len(sample) < layout.workers:
+            continue
+        with make_pool(layout, initializer, initargs) as pool:
+            start = time.perf_counter()
+            results.extend(pool.map(func, sample, chunksize=config.chunksize))
+            elapsed = time.perf_counter() - start
+        logger.debug(
+            f"Benchmark: {layout.workers} workers x {layout.threads} threads, "
+            f"{elapsed:.2f} s for {len(sample)} tasks"
+        )
+        rate = len(sample) / max(elapsed, 1e-9)
+        if rate > best_rate:
+            best_layout, best_rate = layout, rate
+    return best_layout, results
+
+
+def get_pool_layout(
+    config: ParallelConfig,
+    func: Optional[Callable[[Any], Any]] = None,
+    tasks: Optional[Sequence[Any]] = None,
+    initializer: Optional[Callable[..., None]] = None,
+    initargs: tuple = (),
+    results: Optional[list[Any]] = None,
+) -> PoolLayout:
+    """Resolve the layout of a pool of worker processes from its configuration.
+
+    In auto mode, a few tasks are run with each candidate layout and the
+    fastest layout is returned. This requires passing the worker function, the
+    tasks and the initializer of the pool. The timed tasks are always the first
+    ones; their results are appended to `results`, and the caller should only
+    submit the remaining tasks to the pool.
+
+    Args:
+        config: configuration of the pool
+        func: worker function (auto mode)
+        tasks: tasks of the worker function (auto mode)
+        initializer: function run once in each worker process (auto mode)
+        initargs: arguments of the initializer (auto mode)
+        results: list collecting the results of the timed tasks, in order
+            (auto mode)
+
+    Returns:
+        Number of workers, threads per worker and core pinning
+    """
+    if config.auto and func is not None and tasks is not None and len(tasks) > 0:
+        layout, timed_results = _benchmark_layouts(
+            config, func, tasks, initializer, initargs
+        )
+        if results is not None:
+            results.extend(timed_results)
+    else:
+        threads = max(1, config.threads_per_worker)
+        workers = config.workers
+        if workers is None:
+            # Leave one CPU for the main process
+            workers = max(1, (get_available_cpus() - 1) // threads)
+        layout = PoolLayout(max(1, workers), threads, config.pin_cores)
+    logger.info(
+        f"Using {layout.workers} worker processes with {layout.threads} "
+        "thread(s) each"
+    )
+    return layout
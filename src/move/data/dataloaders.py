@@ -1,14 +1,68 @@
-__all__ = ["MOVEDataset", "make_dataset", "make_dataloader", "split_samples"]
+__all__ = [
+    "MOVEDataLoader",
+    "MOVEDataset",
+    "PerturbedMOVEDataset",
+    "make_dataset",
+    "make_dataloader",
+    "split_samples",
+]
 
-from typing import Optional
+from typing import Iterator, Optional, Union
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data import (
+    BatchSampler,
+    DataLoader,
+    SequentialSampler,
+    TensorDataset,
+    default_collate,
+)
 
 from move.core.typing import BoolArray, FloatArray
 
 
+def _index_rows(
+    tensor: torch.Tensor, idx: Union[int, slice, torch.Tensor]
+) -> torch.Tensor:
+    """Index the rows of a tensor. Rows of a sparse CSR tensor (which cannot be
+    indexed) are sliced or gathered from its compressed row indices, and a
+    single row is returned dense."""
+    if tensor.layout != torch.sparse_csr:
+        return tensor[idx]
+    crow_indices = tensor.crow_indices()
+    col_indices = tensor.col_indices()
+    values = tensor.values()
+    num_columns = tensor.shape[1]
+    if isinstance(idx, (int, slice)):
+        rows = range(tensor.shape[0])[idx]
+        if isinstance(rows, int):
+            return _index_rows(tensor, slice(rows, rows + 1)).to_dense()[0]
+        if rows.step == 1:
+            start, stop = crow_indices[rows.start], crow_indices[rows.stop]
+            return torch.sparse_csr_tensor(
+                crow_indices[rows.start : rows.stop + 1] - start,
+                col_indices[start:stop],
+                values[start:stop],
+                (len(rows), num_columns),
+            )
+        idx = torch.arange(rows.start, rows.stop, rows.step)
+    starts = crow_indices[idx]
+    counts = crow_indices[idx + 1] - starts
+    new_crow_indices = crow_indices.new_zeros(len(idx) + 1)
+    new_crow_indices[1:] = torch.cumsum(counts, 0)
+    # Position of each gathered value in the original tensor
+    positions = torch.repeat_interleave(
+        starts - new_crow_indices[:-1], counts
+    ) + torch.arange(int(new_crow_indices[-1]))
+    return torch.sparse_csr_tensor(
+        new_crow_indices,
+        col_indices[positions],
+        values[positions],
+        (len(idx), num_columns),
+    )
+
+
 class MOVEDataset(TensorDataset):
     """
     Characterizes a dataset for PyTorch
@@ -25,6 +79,10 @@ class MOVEDataset(TensorDataset):
             list of tuples corresponding to number of features
             (N_variables) of each continuous class.
 
+    The input matrices may be sparse CSR tensors (e.g., for data that is
+    mostly zeros, as one-hot encodings or missing values), in which case
+    batches of samples are sparse CSR tensors as well.
+
     Raises:
         ValueError:
             Number of samples between categorical and continuous datasets must
@@ -62,10 +120,178 @@ class MOVEDataset(TensorDataset):
         return self.num_samples
 
     def __getitem__(self, idx: int) -> tuple[torch.Tensor, torch.Tensor]:
-        cat_slice = torch.empty(0) if self.cat_all is None else self.cat_all[idx]
-        con_slice = torch.empty(0) if self.con_all is None else self.con_all[idx]
+        cat_slice = (
+            torch.empty(0) if self.cat_all is None else _index_rows(self.cat_all, idx)
+        )
+        con_slice = (
+            torch.empty(0) if self.con_all is None else _index_rows(self.con_all, idx)
+        )
+        return cat_slice, con_slice
+
+    def share_memory_(self) -> "MOVEDataset":
+        """Move the categorical and continuous tensors to shared memory, so that
+        worker processes can read them without making copies."""
+        for tensor in (self.cat_all, self.con_all):
+            if tensor is None:
+                continue
+            if tensor.layout == torch.sparse_csr:
+                # The storage of a sparse tensor is that of its components
+                for component in (
+                    tensor.crow_indices(),
+                    tensor.col_indices(),
+                    tensor.values(),
+                ):
+                    component.share_memory_()
+            else:
+                tensor.share_memory_()
+        return self
+
+
+class PerturbedMOVEDataset(MOVEDataset):
+    """
+    View of a dataset in which some columns of the categorical or continuous
+    input matrix are replaced. The baseline tensors are referenced, not
+    copied: replaced columns are applied when a sample is produced, so many
+    perturbed datasets can be alive at once for the memory of one.
+
+    Accessing `cat_all` or `con_all` materializes the perturbed matrix.
+    Prefer indexing the dataset (or iterating a dataloader over it).
+
+    Args:
+        baseline_dataset:
+            dataset to perturb.
+        columns:
+            indices of the replaced columns, of the categorical input matrix
+            if `is_categorical`, else of the continuous input matrix.
+        values:
+            replacement values (N_samples, len(columns)). Views with expanded
+            dimensions (e.g., the same values for all samples) are kept as is.
+        is_categorical:
+            whether the replaced columns are categorical.
+    """
+
+    def __init__(
+        self,
+        baseline_dataset: MOVEDataset,
+        columns: torch.Tensor,
+        values: torch.Tensor,
+        is_categorical: bool,
+    ) -> None:
+        baseline_all = (
+            baseline_dataset.cat_all if is_categorical else baseline_dataset.con_all
+        )
+        if baseline_all is None:
+            raise ValueError("Cannot perturb an empty dataset.")
+        if baseline_all.layout != torch.strided:
+            raise ValueError("Cannot perturb a sparse dataset.")
+        if values.shape != (baseline_dataset.num_samples, len(columns)):
+            raise ValueError("Replacement values must have one row per sample.")
+        self.num_samples = baseline_dataset.num_samples
+        self.cat_shapes = baseline_dataset.cat_shapes
+        self.con_shapes = baseline_dataset.con_shapes
+        self.baseline_dataset = baseline_dataset
+        self.columns = columns
+        self.values = values
+        self.is_categorical = is_categorical
+
+    def _perturb(self, baseline: torch.Tensor, idx) -> torch.Tensor:
+        perturbed = baseline[idx].clone()
+        perturbed[..., self.columns] = self.values[idx]
+        return perturbed
+
+    @property
+    def cat_all(self) -> Optional[torch.Tensor]:  # type: ignore[override]
+        cat_all = self.baseline_dataset.cat_all
+        if cat_all is None or not self.is_categorical:
+            return cat_all
+        return self._perturb(cat_all, slice(None))
+
+    @property
+    def con_all(self) -> Optional[torch.Tensor]:  # type: ignore[override]
+        con_all = self.baseline_dataset.con_all
+        if con_all is None or self.is_categorical:
+            return con_all
+        return self._perturb(con_all, slice(None))
+
+    def __getitem__(self, idx: int) -> tuple[torch.Tensor, torch.Tensor]:
+        cat_all = self.baseline_dataset.cat_all
+        con_all = self.baseline_dataset.con_all
+        if self.is_categorical:
+            assert cat_all is not None
+            cat_slice = self._perturb(cat_all, idx)
+            con_slice = torch.empty(0) if con_all is None else con_all[idx]
+        else:
+            assert con_all is not None
+            cat_slice = torch.empty(0) if cat_all is None else cat_all[idx]
+            con_slice = self._perturb(con_all, idx)
         return cat_slice, con_slice
 
+    def share_memory_(self) -> "PerturbedMOVEDataset":
+        """Move the baseline tensors and the replacement values to shared
+        memory."""
+        self.baseline_dataset.share_memory_()
+        self.values.share_memory_()
+        return self
+
+
+class MOVEDataLoader(DataLoader):
+    """
+    DataLoader that slices each batch of a MOVE dataset directly from its
+    categorical and continuous tensors (contiguous slices if samples are not
+    shuffled, else index gathers), instead of fetching samples one by one and
+    stacking them.
+
+    Batches are the same as those of a regular DataLoader with the same
+    arguments, including the order of shuffled samples (drawn by the same
+    sampler, from the same random state). Other datasets, custom samplers or
+    collate functions, worker processes and pinned memory fall back to the
+    regular iteration.
+    """
+
+    def _is_sliceable(self) -> bool:
+        return (
+            isinstance(self.dataset, MOVEDataset)
+            and isinstance(self.batch_sampler, BatchSampler)
+            and self.collate_fn is default_collate
+            and self.num_workers == 0
+            and not self.pin_memory
+        )
+
+    def _get_batch(
+        self, idx: Union[slice, torch.Tensor], batch_size: int
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        cat, con = self.dataset[idx]  # type: ignore[index]
+        # Missing data types are empty per sample, hence (batch size x 0)
+        if cat.ndim == 1:
+            cat = cat.new_empty((batch_size, 0))
+        if con.ndim == 1:
+            con = con.new_empty((batch_size, 0))
+        return cat, con
+
+    def _iter_batches(self) -> Iterator[tuple[torch.Tensor, torch.Tensor]]:
+        assert isinstance(self.batch_sampler, BatchSampler)
+        batch_size = self.batch_sampler.batch_size
+        batches = iter(self.batch_sampler)
+        # A regular DataLoader draws a base seed (for worker processes) from
+        # the random state. It is drawn here as well, so that the random state
+        # ends up the same after iterating
+        torch.empty((), dtype=torch.int64).random_(generator=self.generator)
+        if isinstance(self.sampler, SequentialSampler):
+            num_samples = len(self.sampler)
+            if self.drop_last:
+                num_samples -= num_samples % batch_size
+            for start in range(0, num_samples, batch_size):
+                stop = min(start + batch_size, num_samples)
+                yield self._get_batch(slice(start, stop), stop - start)
+        else:
+            for indices in batches:
+                yield self._get_batch(torch.as_tensor(indices), len(indices))
+
+    def __iter__(self):  # type: ignore[override]
+        if not self._is_sliceable():
+            return super().__iter__()
+        return self._iter_batches()
+
 
 def concat_cat_list(
     cat_list: list[FloatArray],
@@ -116,6 +342,7 @@ def make_dataset(
     cat_list: Optional[list[FloatArray]] = None,
     con_list: Optional[list[FloatArray]] = None,
     mask: Optional[BoolArray] = None,
+    sparse: bool = False,
 ) -> MOVEDataset:
     """Creates a dataset that combines categorical and continuous datasets.
 
@@ -128,6 +355,10 @@ def make_dataset(
             Defaults to None.
         mask:
             Boolean array to mask samples. Defaults to None.
+        sparse:
+            Whether to store the combined datasets as sparse CSR tensors,
+            which only keep their non-zero values. Sparse datasets cannot be
+            perturbed. Defaults to False.
 
     Raises:
         ValueError: If both inputs are None
@@ -156,6 +387,12 @@ def make_dataset(
         if mask is not None:
             con_all = con_all[mask]
 
+    if sparse:
+        if cat_all is not None:
+            cat_all = cat_all.to_sparse_csr()
+        if con_all is not None:
+            con_all = con_all.to_sparse_csr()
+
     return MOVEDataset(cat_all, con_all, cat_shapes, con_shapes)
 
 
@@ -163,9 +400,11 @@ def make_dataloader(
     cat_list: Optional[list[FloatArray]] = None,
     con_list: Optional[list[FloatArray]] = None,
     mask: Optional[BoolArray] = None,
+    sparse: bool = False,
     **kwargs
 ) -> DataLoader:
     """Creates a DataLoader that combines categorical and continuous datasets.
+    Batches are sliced directly from the dataset tensors.
 
     Args:
         cat_list:
@@ -176,6 +415,9 @@ def make_dataloader(
             Defaults to None.
         mask:
             Boolean array to mask samples. Defaults to None.
+        sparse:
+            Whether to store the datasets as sparse CSR tensors (see
+            `make_dataset`). Defaults to False.
         **kwargs:
             Arguments to pass to the DataLoader (e.g., batch size)
 
@@ -185,8 +427,8 @@ def make_dataloader(
     Returns:
         DataLoader
     """
-    dataset = make_dataset(cat_list, con_list, mask)
-    return DataLoader(dataset, **kwargs)
+    dataset = make_dataset(cat_list, con_list, mask, sparse)
+    return MOVEDataLoader(dataset, **kwargs)
 
 
 def split_samples(
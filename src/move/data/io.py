@@ -1,6 +1,11 @@
 __all__ = [
+    "check_table_format",
+    "convert_checkpoint",
+    "dump_checkpoint",
     "dump_names",
     "dump_mappings",
+    "dump_table",
+    "load_checkpoint",
     "load_mappings",
     "load_preprocessed_data",
     "read_config",
@@ -8,18 +13,27 @@ __all__ = [
     "read_tsv",
 ]
 
+import importlib.util
 import json
+import pickle
+import warnings
+import zipfile
 from pathlib import Path
-from typing import Optional
+from typing import Any, Optional
 
 import hydra
 import numpy as np
 import pandas as pd
+import torch
 from omegaconf import DictConfig
+from torch import nn
 
 from move import HYDRA_VERSION_BASE, conf
+from move.core.logging import get_logger
 from move.core.typing import BoolArray, FloatArray, ObjectArray, PathLike
 
+logger = get_logger(__name__)
+
 
 def read_config(
     data_config_name: Optional[str], task_config_name: Optional[str], *args
@@ -162,3 +176,122 @@ def dump_mappings(path: PathLike, mappings: dict[str, dict[str, int]]) -> None:
 def dump_names(path: PathLike, names: np.ndarray) -> None:
     with open(path, "w", encoding="utf-8") as file:
         file.writelines([f"{name}\n" for name in names])
+
+
+# Formats in which tables can be dumped, and whether they require pyarrow
+TABLE_FORMATS = {"tsv": False, "parquet": True, "feather": True}
+
+
+def check_table_format(table_format: str) -> None:
+    """Raise an error if tables cannot be dumped in the given format."""
+    if table_format not in TABLE_FORMATS:
+        raise ValueError(
+            f"Unsupported table format '{table_format}'. "
+            f"Choose one of: {', '.join(TABLE_FORMATS)}."
+        )
+    if TABLE_FORMATS[table_format] and importlib.util.find_spec("pyarrow") is None:
+        raise ImportError(
+            f"Writing {table_format} tables requires pyarrow. "
+            "Install it with: pip install pyarrow"
+        )
+
+
+def dump_table(path: PathLike, table: pd.DataFrame) -> None:
+    """Write a table (without its index). The format is taken from the file
+    extension: TSV, or the columnar Parquet and Feather formats, which store
+    categorical columns dictionary-encoded.
+
+    Args:
+        path: Path to the table, ending in `.tsv`, `.parquet` or `.feather`
+        table: Table to write
+    """
+    table_format = Path(path).suffix.lstrip(".")
+    check_table_format(table_format)
+    if table_format == "parquet":
+        table.to_parquet(path, index=False)
+    elif table_format == "feather":
+        table.reset_index(drop=True).to_feather(path)
+    else:
+        table.to_csv(path, sep="\t", index=False)
+
+
+def dump_checkpoint(path: PathLike, obj: Any) -> None:
+    """Save tensors (e.g., a state dict) in a checkpoint that can be
+    memory-mapped (see `load_checkpoint`).
+
+    Checkpoints are uncompressed archives in which the data of each tensor is
+    a separate, aligned record, and only the structure of the object is
+    pickled. Objects other than tensors, containers and primitive types (e.g.,
+    NumPy arrays) cannot be loaded.
+
+    Args:
+        path: Path to the checkpoint
+        obj: Tensor, or container of tensors
+    """
+    # The default pickle protocol is the one the weights-only unpickler reads.
+    # Tensor data is not pickled, so big models do not need a newer protocol
+    torch.save(obj, path)
+
+
+def load_checkpoint(path: PathLike) -> Any:
+    """Load a checkpoint saved by `dump_checkpoint`, memory-mapping its tensors
+    instead of reading them. Loading takes a few milliseconds, pages are only
+    read when accessed, and processes loading the same checkpoint share them
+    through the page cache. Tensors are loaded on the CPU, and changes to them
+    are not written back to the file.
+
+    Checkpoints saved by older versions (pickled NumPy arrays or modules, or
+    in the legacy serialization format) are not loaded, as unpickling them
+    could run arbitrary code. Convert them with `convert_checkpoint`, or delete
+    them so they are recomputed.
+
+    Args:
+        path: Path to the checkpoint
+
+    Returns:
+        Saved tensor, or container of tensors
+
+    Raises:
+        ValueError: If the checkpoint was saved by an older version
+    """
+    if zipfile.is_zipfile(path):
+        try:
+            with warnings.catch_warnings():
+                # Older checkpoints were pickled with protocol 4
+                warnings.filterwarnings("ignore", "Detected pickle protocol")
+                return torch.load(
+                    path, map_location="cpu", mmap=True, weights_only=True
+                )
+        except pickle.UnpicklingError:
+            pass
+    raise ValueError(
+        f"Checkpoint '{path}' was saved by an older version of MOVE. If it comes "
+        "from a trusted source, convert it with "
+        "move.data.io.convert_checkpoint; otherwise, delete it so it is "
+        "recomputed."
+    )
+
+
+def convert_checkpoint(path: PathLike) -> Any:
+    """Convert a checkpoint saved by an older version of MOVE (a pickled NumPy
+    array or module, or a file in the legacy serialization format) and
+    rewrite it with `dump_checkpoint`. Arrays are converted to tensors and
+    modules to their state dicts.
+
+    The old file is fully unpickled, which can run arbitrary code: only
+    convert checkpoints from a trusted source.
+
+    Args:
+        path: Path to the checkpoint
+
+    Returns:
+        Converted tensor, or container of tensors
+    """
+    obj = torch.load(path, map_location="cpu", weights_only=False)
+    if isinstance(obj, np.ndarray):
+        obj = torch.from_numpy(obj)
+    elif isinstance(obj, nn.Module):
+        obj = obj.state_dict()
+    dump_checkpoint(path, obj)
+    logger.info(f"Converted checkpoint '{path}' to the current format.")
+    return obj
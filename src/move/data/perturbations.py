@@ -1,5 +1,7 @@
 __all__ = [
     "perturb_categorical_data",
+    "perturb_categorical_data_block",
+    "perturb_continuous_data_block",
     "perturb_continuous_data_extended_one",
     "perturb_continuous_data_extended",
 ]
@@ -12,67 +14,96 @@ import torch
 from torch.utils.data import DataLoader
 
 from move.core.logging import get_logger
-from move.data.dataloaders import MOVEDataset
+from move.data.dataloaders import (
+    MOVEDataLoader,
+    MOVEDataset,
+    PerturbedMOVEDataset,
+)
 from move.data.preprocessing import feature_stats
 from move.visualization.dataset_distributions import plot_value_distributions
+from move.visualization.rendering import submit_figure
 
 ContinuousPerturbationType = Literal["minimum", "maximum", "plus_std", "minus_std"]
 
 logger = get_logger(__name__)
 
 
-def _build_dataloader(
-    cat_data, con_data, cat_shapes, con_shapes, batch_size, shuffle=False
-):
-    # currently for continuous data only
-    dataset = MOVEDataset(
-        cat_data,
-        con_data,
-        cat_shapes,
-        con_shapes,
-    )
-
-    dataloader = DataLoader(
+def _build_dataloader(dataset: MOVEDataset, batch_size, shuffle=False) -> DataLoader:
+    return MOVEDataLoader(
         dataset,
         shuffle=shuffle,
         batch_size=batch_size,
     )
-    return dataloader
 
 
-def _pertub_cont_feat_col(
-    baseline_dataset, start_idx, num_features, index_pert_feat, perturbation_type
-):
+def _get_cat_feat_columns(
+    baseline_dataset: MOVEDataset, target_idx: int, index_pert_feat: int
+) -> torch.Tensor:
+    """Return the columns of the categorical input matrix encoding a feature."""
+    assert baseline_dataset.cat_shapes is not None
+    splits = np.cumsum(
+        [0] + [int.__mul__(*shape) for shape in baseline_dataset.cat_shapes]
+    )
+    num_classes = baseline_dataset.cat_shapes[target_idx][1]
+    start_idx = splits[target_idx] + index_pert_feat * num_classes
+    return torch.arange(start_idx, start_idx + num_classes)
+
 
-    perturbed_con = baseline_dataset.con_all.clone()
-    target_dataset = perturbed_con[:, start_idx : start_idx + num_features]
-    logger.debug(f"Target dataset shape: {target_dataset.shape}")
+def _perturb_cat_feat(
+    baseline_dataset: MOVEDataset,
+    target_idx: int,
+    index_pert_feat: int,
+    target_value: np.ndarray,
+) -> PerturbedMOVEDataset:
+    columns = _get_cat_feat_columns(baseline_dataset, target_idx, index_pert_feat)
+    values = torch.FloatTensor(target_value).reshape(1, -1)
+    return PerturbedMOVEDataset(
+        baseline_dataset,
+        columns,
+        values.expand(baseline_dataset.num_samples, -1),
+        is_categorical=True,
+    )
+
+
+def _pertub_cont_feat_col(
+    baseline_dataset: MOVEDataset,
+    start_idx: int,
+    index_pert_feat: int,
+    perturbation_type: ContinuousPerturbationType,
+    feat_stats: tuple[list, list, list],
+) -> PerturbedMOVEDataset:
+    assert baseline_dataset.con_all is not None
     logger.debug(
         f"Changing to desired perturbation value for feature {index_pert_feat}"
     )
     # Change the desired feature value by:
-    # ! one would only need the stats for a single feature?
-    min_feat_val_list, max_feat_val_list, std_feat_val_list = feature_stats(
-        target_dataset
-    )
+    min_feat_val_list, max_feat_val_list, std_feat_val_list = feat_stats
+    num_samples = baseline_dataset.num_samples
+    column = start_idx + index_pert_feat
+    baseline_column = baseline_dataset.con_all[:, [column]]
     if perturbation_type == "minimum":
-        perturbed_con[:, start_idx + index_pert_feat] = torch.FloatTensor(
-            [min_feat_val_list[index_pert_feat]]
-        )
+        values = torch.FloatTensor([min_feat_val_list[index_pert_feat]])
+        values = values.expand(num_samples, 1)
     elif perturbation_type == "maximum":
-        perturbed_con[:, start_idx + index_pert_feat] = torch.FloatTensor(
-            [max_feat_val_list[index_pert_feat]]
-        )
+        values = torch.FloatTensor([max_feat_val_list[index_pert_feat]])
+        values = values.expand(num_samples, 1)
     elif perturbation_type == "plus_std":
-        perturbed_con[:, start_idx + index_pert_feat] += torch.FloatTensor(
+        values = baseline_column + torch.FloatTensor(
             [std_feat_val_list[index_pert_feat]]
         )
     elif perturbation_type == "minus_std":
-        perturbed_con[:, start_idx + index_pert_feat] -= torch.FloatTensor(
+        values = baseline_column - torch.FloatTensor(
             [std_feat_val_list[index_pert_feat]]
         )
+    else:
+        values = baseline_column
     logger.debug(f"Perturbation succesful for feature {index_pert_feat}")
-    return perturbed_con
+    return PerturbedMOVEDataset(
+        baseline_dataset,
+        torch.tensor([column]),
+        values,
+        is_categorical=False,
+    )
 
 
 def perturb_categorical_data(
@@ -84,6 +115,10 @@ def perturb_categorical_data(
     """Add perturbations to categorical data. For each feature in the target
     dataset, change its value to target.
 
+    Perturbed datasets are views of the baseline dataset (see
+    `PerturbedMOVEDataset`), so they take no more memory than their
+    replaced column.
+
     Args:
         baseline_dataloader: Baseline dataloader
         cat_dataset_names: List of categorical dataset names
@@ -99,27 +134,15 @@ def perturb_categorical_data(
     assert baseline_dataset.cat_all is not None
 
     target_idx = cat_dataset_names.index(target_dataset_name)
-    splits = np.cumsum(
-        [0] + [int.__mul__(*shape) for shape in baseline_dataset.cat_shapes]
-    )
-    slice_ = slice(*splits[target_idx : target_idx + 2])
-
-    target_shape = baseline_dataset.cat_shapes[target_idx]
-    num_features = target_shape[0]
+    num_features = baseline_dataset.cat_shapes[target_idx][0]
 
     dataloaders = []
     for i in range(num_features):
-        perturbed_cat = baseline_dataset.cat_all.clone()
-        target_dataset = perturbed_cat[:, slice_].view(
-            baseline_dataset.num_samples, *target_shape
+        perturbed_dataset = _perturb_cat_feat(
+            baseline_dataset, target_idx, i, target_value
         )
-        target_dataset[:, i, :] = torch.FloatTensor(target_value)
         perturbed_dataloader = _build_dataloader(
-            cat_data=perturbed_cat,
-            con_data=baseline_dataset.con_all,
-            cat_shapes=baseline_dataset.cat_shapes,
-            con_shapes=baseline_dataset.con_shapes,
-            batch_size=baseline_dataloader.batch_size,
+            perturbed_dataset, batch_size=baseline_dataloader.batch_size
         )
         dataloaders.append(perturbed_dataloader)
     return dataloaders
@@ -150,25 +173,11 @@ def perturb_categorical_data_one(
     assert baseline_dataset.cat_all is not None
 
     target_idx = cat_dataset_names.index(target_dataset_name)
-    splits = np.cumsum(
-        [0] + [int.__mul__(*shape) for shape in baseline_dataset.cat_shapes]
-    )
-    slice_ = slice(*splits[target_idx : target_idx + 2])
-
-    target_shape = baseline_dataset.cat_shapes[target_idx]
-
-    i = index_pert_feat
-    perturbed_cat = baseline_dataset.cat_all.clone()
-    target_dataset = perturbed_cat[:, slice_].view(
-        baseline_dataset.num_samples, *target_shape
+    perturbed_dataset = _perturb_cat_feat(
+        baseline_dataset, target_idx, index_pert_feat, target_value
     )
-    target_dataset[:, i, :] = torch.FloatTensor(target_value)
     perturbed_dataloader = _build_dataloader(
-        cat_data=perturbed_cat,
-        con_data=baseline_dataset.con_all,
-        cat_shapes=baseline_dataset.cat_shapes,
-        con_shapes=baseline_dataset.con_shapes,
-        batch_size=baseline_dataloader.batch_size,
+        perturbed_dataset, batch_size=baseline_dataloader.batch_size
     )
     return perturbed_dataloader
 
@@ -201,14 +210,15 @@ def perturb_continuous_data_one(
     splits = np.cumsum([0] + baseline_dataset.con_shapes)
     start_idx = splits[target_idx]
 
-    perturbed_con = baseline_dataset.con_all.clone()
-    perturbed_con[:, start_idx + index_pert_feat] = torch.FloatTensor([target_value])
+    values = torch.FloatTensor([target_value]).expand(baseline_dataset.num_samples, 1)
+    perturbed_dataset = PerturbedMOVEDataset(
+        baseline_dataset,
+        torch.tensor([start_idx + index_pert_feat]),
+        values,
+        is_categorical=False,
+    )
     perturbed_dataloader = _build_dataloader(
-        cat_data=baseline_dataset.cat_all,
-        con_data=perturbed_con,
-        cat_shapes=baseline_dataset.cat_shapes,
-        con_shapes=baseline_dataset.con_shapes,
-        batch_size=baseline_dataloader.batch_size,
+        perturbed_dataset, batch_size=baseline_dataloader.batch_size
     )
 
     return perturbed_dataloader
@@ -234,7 +244,9 @@ def perturb_continuous_data_extended(
         output_subpath: path where the figure showing the perturbation will be saved
 
     Returns:
-        - List of dataloaders containing all perturbed datasets
+        - List of dataloaders containing all perturbed datasets. These are views
+          of the baseline dataset (see `PerturbedMOVEDataset`), so they take no
+          more memory than their replaced column.
         - Plot of the feature value distribution after the perturbation. Note that
           all perturbations are collapsed into one single plot.
 
@@ -253,35 +265,37 @@ def perturb_continuous_data_extended(
     start_idx = splits[target_idx]
 
     num_features = baseline_dataset.con_shapes[target_idx]
+    feat_stats = feature_stats(
+        baseline_dataset.con_all[:, start_idx : start_idx + num_features]
+    )
     dataloaders = []
     perturbations_list = []
 
     for i in range(num_features):
-        perturbed_con = _pertub_cont_feat_col(
+        perturbed_dataset = _pertub_cont_feat_col(
             baseline_dataset=baseline_dataset,
             start_idx=start_idx,
-            num_features=num_features,
             index_pert_feat=i,
             perturbation_type=perturbation_type,
+            feat_stats=feat_stats,
         )
-        perturbations_list.append(perturbed_con[:, start_idx + i].numpy())
+        perturbations_list.append(perturbed_dataset.values[:, 0].numpy())
 
         perturbed_dataloader = _build_dataloader(
-            cat_data=baseline_dataset.cat_all,
-            con_data=perturbed_con,
-            cat_shapes=baseline_dataset.cat_shapes,
-            con_shapes=baseline_dataset.con_shapes,
-            batch_size=baseline_dataloader.batch_size,
+            perturbed_dataset, batch_size=baseline_dataloader.batch_size
         )
         dataloaders.append(perturbed_dataloader)
 
     # Plot the perturbations for all features, collapsed in one plot:
     if output_subpath is not None:
-        fig = plot_value_distributions(np.array(perturbations_list).transpose())
-        fig_path = str(
+        fig_path = (
             output_subpath / f"perturbation_distribution_{target_dataset_name}.png"
         )
-        fig.savefig(fig_path)
+        submit_figure(
+            fig_path,
+            plot_value_distributions,
+            np.array(perturbations_list).transpose(),
+        )
 
     return dataloaders
 
@@ -338,24 +352,20 @@ def perturb_continuous_data_extended_one(
     # perturb, we do it only for one feature, the one indicated in index_pert_feat
     logger.debug(f"Setting up perturbed_con for feature {index_pert_feat}")
 
-    perturbed_con = _pertub_cont_feat_col(
+    perturbed_dataset = _pertub_cont_feat_col(
         baseline_dataset=baseline_dataset,
         start_idx=start_idx,
-        num_features=num_features,
         index_pert_feat=index_pert_feat,
         perturbation_type=perturbation_type,
+        feat_stats=feature_stats(
+            baseline_dataset.con_all[:, start_idx : start_idx + num_features]
+        ),
     )
 
-    logger.debug(
-        f"Creating perturbed dataset and dataloader for feature {index_pert_feat}"
-    )
+    logger.debug(f"Creating perturbed dataloader for feature {index_pert_feat}")
 
     perturbed_dataloader = _build_dataloader(
-        cat_data=baseline_dataset.cat_all,
-        con_data=perturbed_con,
-        cat_shapes=baseline_dataset.cat_shapes,
-        con_shapes=baseline_dataset.con_shapes,
-        batch_size=baseline_dataloader.batch_size,
+        perturbed_dataset, batch_size=baseline_dataloader.batch_size
     )
 
     logger.debug(
@@ -363,3 +373,86 @@ def perturb_continuous_data_extended_one(
     )
 
     return perturbed_dataloader
+
+
+def perturb_categorical_data_block(
+    baseline_dataset: MOVEDataset,
+    cat_dataset_names: list[str],
+    target_dataset_name: str,
+    target_value: np.ndarray,
+    feature_ids: list[int],
+) -> torch.Tensor:
+    """Add perturbations to categorical data for a block of features at once.
+    Only the one-hot columns of the perturbed features are returned, the
+    perturbed copies of the dataset are not built.
+
+    Args:
+        baseline_dataset: Baseline dataset
+        cat_dataset_names: List of categorical dataset names
+        target_dataset_name: Target categorical dataset to perturb
+        target_value: Target value
+        feature_ids: Indices of the features (in the target dataset) to perturb
+
+    Returns:
+        Perturbed one-hot columns of each feature (3D: K x N x C). Every
+        sample takes the target value, so this is an expanded view.
+    """
+    assert baseline_dataset.cat_shapes is not None
+
+    target_idx = cat_dataset_names.index(target_dataset_name)
+    num_classes = baseline_dataset.cat_shapes[target_idx][1]
+    return torch.FloatTensor(target_value).reshape(num_classes).expand(
+        len(feature_ids), baseline_dataset.num_samples, num_classes
+    )
+
+
+def perturb_continuous_data_block(
+    baseline_dataset: MOVEDataset,
+    con_dataset_names: list[str],
+    target_dataset_name: str,
+    perturbation_type: ContinuousPerturbationType,
+    feature_ids: list[int],
+) -> torch.Tensor:
+    """Add perturbations to continuous data for a block of features at once.
+    Perturbations are the same as in `perturb_continuous_data_extended`, but
+    only the columns of the perturbed features are returned, the perturbed
+    copies of the dataset are not built.
+
+    Args:
+        baseline_dataset: Baseline dataset
+        con_dataset_names: List of continuous dataset names
+        target_dataset_name: Target continuous dataset to perturb
+        perturbation_type: 'minimum', 'maximum', 'plus_std' or 'minus_std'.
+        feature_ids: Indices of the features (in the target dataset) to perturb
+
+    Returns:
+        Perturbed column of each feature (2D: K x N)
+    """
+    assert baseline_dataset.con_shapes is not None
+    assert baseline_dataset.con_all is not None
+
+    target_idx = con_dataset_names.index(target_dataset_name)  # dataset index
+    splits = np.cumsum([0] + baseline_dataset.con_shapes)
+    start_idx = splits[target_idx]
+
+    # Statistics are only computed for the columns of the block
+    baseline_columns = baseline_dataset.con_all[:, start_idx + np.array(feature_ids)]
+    min_feat_val_list, max_feat_val_list, std_feat_val_list = feature_stats(
+        baseline_columns
+    )
+
+    num_samples = baseline_dataset.num_samples
+    baseline_columns = baseline_columns.T  # 2D: K x N
+    if perturbation_type == "minimum":
+        values = torch.FloatTensor(min_feat_val_list)
+        return values[:, None].expand(-1, num_samples)
+    elif perturbation_type == "maximum":
+        values = torch.FloatTensor(max_feat_val_list)
+        return values[:, None].expand(-1, num_samples)
+    elif perturbation_type == "plus_std":
+        values = torch.FloatTensor(std_feat_val_list)
+        return baseline_columns + values[:, None]
+    elif perturbation_type == "minus_std":
+        values = torch.FloatTensor(std_feat_val_list)
+        return baseline_columns - values[:, None]
+    raise ValueError(f"Unknown perturbation type: {perturbation_type}")
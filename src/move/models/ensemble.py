@@ -0,0 +1,288 @@
+__all__ = ["EnsembleVAE"]
+
+import logging
+from collections.abc import Sequence
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+from torch import nn, optim
+from torch.utils.data import DataLoader
+
+from move.models.vae import VAE
+
+logger = logging.getLogger("ensemble.py")
+
+
+def _get_key(name: str) -> str:
+    """Return the key of a stacked layer from the name of a VAE submodule."""
+    return name.replace(".", "_")
+
+
+class EnsembleVAE(nn.Module):
+    """Ensemble of VAEs with the same architecture, trained at once.
+
+    The weights of every linear layer and batch normalization of the members
+    are stacked along a leading dimension. Each training batch goes through
+    all members in a single pass of batched matrix multiplications, and each
+    member normalizes its own activations. The members share the order of the
+    training batches, but have their own initial weights and dropout masks.
+
+    The members are trained on the sum of their losses, so each one receives
+    the gradients of its own loss. Once trained, their weights are exported as
+    state dicts of a `VAE`.
+
+    Instantiate with:
+        models: initialized VAEs with the same architecture (e.g., seeded
+            differently). Their weights are copied.
+
+    Raises:
+        ValueError: Members must have the same architecture
+    """
+
+    def __init__(self, models: Sequence[VAE]):
+        super().__init__()
+        template = models[0]
+        state_dicts = [model.state_dict() for model in models]
+        if any(sd.keys() != state_dicts[0].keys() for sd in state_dicts) or any(
+            sd[key].shape != state_dicts[0][key].shape
+            for sd in state_dicts
+            for key in sd
+        ):
+            raise ValueError("Members of an ensemble must share their architecture.")
+
+        self.num_models = len(models)
+        # The first member computes the losses (which do not depend on its
+        # weights), and sets the precision. It is not a submodule
+        self.__dict__["template"] = template
+
+        num_hidden = len(template.num_hidden)
+        self.encoder_names = [f"encoderlayers.{i}" for i in range(num_hidden)]
+        self.decoder_names = [f"decoderlayers.{i}" for i in range(num_hidden)]
+        self.linear_names = (
+            self.encoder_names + ["mu", "var"] + self.decoder_names + ["out"]
+        )
+        self.norm_names = [f"encodernorms.{i}" for i in range(num_hidden)] + [
+            f"decodernorms.{i}" for i in range(num_hidden)
+        ]
+
+        def stack(key: str) -> torch.Tensor:
+            return torch.stack([sd[key] for sd in state_dicts]).clone()
+
+        # Weights are stored transposed (M x I x O), so that their gradients
+        # are contiguous (and are not copied on every backward pass)
+        self.weights = nn.ParameterDict()
+        self.biases = nn.ParameterDict()
+        for name in self.linear_names:
+            weight = stack(f"{name}.weight").transpose(1, 2).contiguous()
+            self.weights[_get_key(name)] = nn.Parameter(weight)
+            self.biases[_get_key(name)] = nn.Parameter(stack(f"{name}.bias"))
+
+        self.norm_weights = nn.ParameterDict()
+        self.norm_biases = nn.ParameterDict()
+        for name in self.norm_names:
+            key = _get_key(name)
+            self.norm_weights[key] = nn.Parameter(stack(f"{name}.weight"))
+            self.norm_biases[key] = nn.Parameter(stack(f"{name}.bias"))
+            self.register_buffer(f"{key}_running_mean", stack(f"{name}.running_mean"))
+            self.register_buffer(f"{key}_running_var", stack(f"{name}.running_var"))
+            self.register_buffer(
+                f"{key}_num_batches_tracked",
+                state_dicts[0][f"{name}.num_batches_tracked"].clone(),
+            )
+
+    @property
+    def device(self) -> torch.device:
+        return self.template.device
+
+    def _linear(self, name: str, x: torch.Tensor) -> torch.Tensor:
+        """Apply the linear layer of every member to its input (3D: M x B x I)."""
+        key = _get_key(name)
+        return torch.baddbmm(self.biases[key].unsqueeze(1), x, self.weights[key])
+
+    def _norm(self, name: str, x: torch.Tensor) -> torch.Tensor:
+        """Apply the batch normalization of every member to its activations
+        (3D: M x B x H), as `nn.BatchNorm1d` does. Statistics are computed in
+        float32."""
+        key = _get_key(name)
+        x = x.float()
+        norm: nn.BatchNorm1d = self.template.get_submodule(name)
+        running_mean = getattr(self, f"{key}_running_mean")
+        running_var = getattr(self, f"{key}_running_var")
+        if self.training:
+            var, mean = torch.var_mean(x, dim=1, unbiased=False)
+            with torch.no_grad():
+                batch_size = x.shape[1]
+                # The running variance is unbiased
+                running_mean.lerp_(mean, norm.momentum)
+                running_var.lerp_(var * batch_size / (batch_size - 1), norm.momentum)
+                getattr(self, f"{key}_num_batches_tracked").add_(1)
+        else:
+            mean, var = running_mean, running_var
+        scale = torch.rsqrt(var + norm.eps) * self.norm_weights[key]
+        shift = self.norm_biases[key] - mean * scale
+        return torch.addcmul(shift.unsqueeze(1), x, scale.unsqueeze(1))
+
+    def _hidden(
+        self, linear_name: str, norm_name: str, x: torch.Tensor
+    ) -> torch.Tensor:
+        """Apply a hidden layer of every member: linear transformation,
+        activation, dropout and batch normalization."""
+        x = self._linear(linear_name, x)
+        x = F.leaky_relu(x, self.template.relu.negative_slope)
+        x = F.dropout(x, self.template.dropout, self.training)
+        return self._norm(norm_name, x)
+
+    def forward(
+        self, tensor: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Forward propagate the same input through every member
+
+        Args:
+            tensor: input data (2D: B x I). Sparse inputs are densified.
+
+        Returns:
+            (tuple): a tuple containing the output of the output layer, the
+                mean latent vectors and the log-variance latent vectors of
+                every member (3D: M x B x ...). Outputs are float32.
+        """
+        x = tensor.to_dense().expand(self.num_models, -1, -1)
+        for i, name in enumerate(self.encoder_names):
+            x = self._hidden(name, f"encodernorms.{i}", x)
+        mu, logvar = self._linear("mu", x), self._linear("var", x)
+
+        x = self.template.reparameterize(mu, logvar)
+        for i, name in enumerate(self.decoder_names):
+            x = self._hidden(name, f"decodernorms.{i}", x)
+        reconstruction = self._linear("out", x)
+
+        return reconstruction.float(), mu.float(), logvar.float()
+
+    def encoding(
+        self,
+        train_loader: DataLoader,
+        epoch: int,
+        lrate: float,
+        kld_w: float,
+        optimizer: Optional[optim.Optimizer] = None,
+    ) -> tuple[float, float, float, float]:
+        """
+        One training epoch of all members. Same as `VAE.encoding`, and the
+        losses are averaged over the members.
+
+        Args:
+            train_loader: Dataloader with train dataset
+            epoch: the epoch
+            lrate: learning rate for the model
+            kld_w: float of KLD weight
+            optimizer: optimizer of the parameters of all members, kept across
+                epochs. If not set, a new fused Adam optimizer (with learning
+                rate `lrate`) is created for this epoch.
+
+        Returns:
+            (tuple): a tuple containing:
+                total loss on train set during the training of the epoch
+                BCE loss on train set during the training of the epoch
+                SSE loss on train set during the training of the epoch
+                KLD loss on train set during the training of the epoch
+        """
+        template = self.template
+        self.train()
+        if optimizer is None:
+            optimizer = optim.Adam(self.parameters(), lr=lrate, fused=True)
+        # Gradients in float16 may underflow, so the loss is scaled
+        scaler = torch.amp.GradScaler(
+            self.device.type, enabled=template.precision == "float16"
+        )
+
+        epoch_loss = 0
+        epoch_kldloss = 0
+        epoch_sseloss = 0
+        epoch_bceloss = 0
+
+        for cat, con in train_loader:
+            tensor = template._validate_batch((cat, con))
+            cat = cat.to(self.device).to_dense().repeat(self.num_models, 1)
+            con = con.to(self.device).to_dense().repeat(self.num_models, 1)
+
+            optimizer.zero_grad()
+
+            with template.autocast():
+                reconstruction, mu, logvar = self(tensor)
+
+            # The losses of all members are computed at once. As the mean loss
+            # of the members, it is scaled back to their sum
+            reconstruction = reconstruction.flatten(0, 1)
+            cat_out, con_out = None, None
+            if template.num_categorical > 0:
+                cat_out = template.decompose_categorical(reconstruction)
+            if template.num_continuous > 0:
+                con_out = reconstruction.narrow(
+                    1, template.num_categorical, template.num_continuous
+                )
+            mu, logvar = mu.flatten(0, 1), logvar.flatten(0, 1)
+            loss, bce, sse, kld = template.loss_function(
+                cat, cat_out, con, con_out, mu, logvar, kld_w
+            )
+            scaler.scale(loss * self.num_models).backward()
+
+            epoch_loss += loss.data.item()
+            epoch_kldloss += kld.data.item()
+
+            if template.num_continuous > 0:
+                epoch_sseloss += sse.data.item()
+
+            if template.num_categorical > 0:
+                epoch_bceloss += bce.data.item()
+
+            scaler.step(optimizer)
+            scaler.update()
+
+        logger.info(
+            "\tEpoch: {}\tLoss: {:.6f}\tCE: {:.7f}\tSSE: {:.6f}\t"
+            "KLD: {:.4f}\tBatchsize: {}\tMembers: {}".format(
+                epoch,
+                epoch_loss / len(train_loader),
+                epoch_bceloss / len(train_loader),
+                epoch_sseloss / len(train_loader),
+                epoch_kldloss / len(train_loader),
+                train_loader.batch_size,
+                self.num_models,
+            )
+        )
+        return (
+            epoch_loss / len(train_loader),
+            epoch_bceloss / len(train_loader),
+            epoch_sseloss / len(train_loader),
+            epoch_kldloss / len(train_loader),
+        )
+
+    def member_state_dict(self, index: int) -> dict[str, torch.Tensor]:
+        """
+        Returns the weights of a member, as the state dict of a `VAE`
+
+        Args:
+            index: index of the member
+
+        Returns:
+            state dict (e.g., to load into a `VAE` or to save as a refit)
+        """
+        state_dict = {}
+        for name in self.linear_names:
+            key = _get_key(name)
+            weight = self.weights[key][index].detach().T
+            state_dict[f"{name}.weight"] = weight.contiguous()
+            state_dict[f"{name}.bias"] = self.biases[key][index].detach().clone()
+        for name in self.norm_names:
+            key = _get_key(name)
+            weight, bias = self.norm_weights[key], self.norm_biases[key]
+            state_dict[f"{name}.weight"] = weight[index].detach().clone()
+            state_dict[f"{name}.bias"] = bias[index].detach().clone()
+            for buffer in ("running_mean", "running_var"):
+                running_stat = getattr(self, f"{key}_{buffer}")
+                state_dict[f"{name}.{buffer}"] = running_stat[index].clone()
+            state_dict[f"{name}.num_batches_tracked"] = getattr(
+                self, f"{key}_num_batches_tracked"
+            ).clone()
+        return state_dict
@@ -0,0 +1,164 @@
+__all__ = ["INFERENCE_BACKENDS", "FoldedVAE", "compile_inference", "quantize_vae"]
+
+from typing import TYPE_CHECKING, Any
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+if TYPE_CHECKING:
+    from move.models.vae import VAE
+
+# Ways to compile the inference graph: TorchScript or `torch.compile`
+INFERENCE_BACKENDS = ("script", "compile")
+
+
+def _fold_batchnorm(norm: nn.BatchNorm1d, linear: nn.Linear) -> nn.Linear:
+    """Return a linear layer equivalent to applying a batch normalization (in
+    evaluation mode) and then a linear layer.
+
+    A batch normalization scales and shifts its input, y = s * x + t, so the
+    following layer computes W(s * x + t) + c = (W * s) x + (W t + c).
+    """
+    assert norm.running_mean is not None and norm.running_var is not None
+    scale = torch.rsqrt(norm.running_var + norm.eps)
+    shift = -norm.running_mean * scale
+    if norm.affine:
+        scale = scale * norm.weight
+        shift = shift * norm.weight + norm.bias
+    folded = nn.Linear(linear.in_features, linear.out_features)
+    folded.weight.copy_(linear.weight * scale)
+    folded.bias.copy_(linear.weight @ shift + linear.bias)
+    return folded
+
+
+class FoldedVAE(nn.Module):
+    """Evaluation graph of a VAE, with its batch normalizations folded into
+    the following linear layers.
+
+    In the VAE, each hidden layer is a linear transformation followed by an
+    activation, dropout and batch normalization. In evaluation mode, dropout
+    does nothing and a batch normalization is an affine transformation, which
+    is merged into the next linear layer (the next hidden layer, the latent
+    layers or the output layer). Hence, every layer is a single linear
+    transformation and an activation.
+
+    The folded layers are a copy of the weights of the model. Changes to the
+    model (training, loading weights) are not reflected.
+
+    Args:
+        model: trained VAE (its dropout and batch normalizations are taken in
+            evaluation mode, regardless of its current mode)
+    """
+
+    def __init__(self, model: "VAE") -> None:
+        super().__init__()
+        self.negative_slope = float(model.relu.negative_slope)
+        with torch.no_grad():
+            # The first encoder layer is kept out: perturbations update its
+            # output (pre-activations) directly
+            encodernorms = list(model.encodernorms)
+            self.encoderlayers = nn.ModuleList(
+                _fold_batchnorm(norm, layer)
+                for norm, layer in zip(encodernorms[:-1], model.encoderlayers[1:])
+            )
+            self.mu = _fold_batchnorm(encodernorms[-1], model.mu)
+            self.var = _fold_batchnorm(encodernorms[-1], model.var)
+
+            decodernorms = list(model.decodernorms)
+            self.decoderlayers = nn.ModuleList(
+                [_copy_linear(model.decoderlayers[0])]
+                + [
+                    _fold_batchnorm(norm, layer)
+                    for norm, layer in zip(decodernorms[:-1], model.decoderlayers[1:])
+                ]
+            )
+            self.out = _fold_batchnorm(decodernorms[-1], model.out)
+        self.requires_grad_(False)
+        self.eval()
+
+    @torch.jit.export
+    def encode_preactivation(
+        self, x: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """Encode data from the pre-activations of the first encoder layer.
+        Returns the mean and log-variance latent vectors."""
+        x = F.leaky_relu(x, self.negative_slope)
+        for layer in self.encoderlayers:
+            x = F.leaky_relu(layer(x), self.negative_slope)
+        return self.mu(x), self.var(x)
+
+    @torch.jit.export
+    def decode(self, z: torch.Tensor) -> torch.Tensor:
+        """Decode a sample of the latent space. Returns the output of the
+        output layer (before splitting categorical and continuous data)."""
+        for layer in self.decoderlayers:
+            z = F.leaky_relu(layer(z), self.negative_slope)
+        return self.out(z)
+
+    def forward(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """Same as `encode_preactivation`."""
+        return self.encode_preactivation(x)
+
+
+def _copy_linear(linear: nn.Linear) -> nn.Linear:
+    copy = nn.Linear(linear.in_features, linear.out_features)
+    copy.load_state_dict(linear.state_dict())
+    return copy
+
+
+def compile_inference(model: "VAE", backend: str = "script") -> Any:
+    """Fold the batch normalizations of a VAE and compile its evaluation graph.
+
+    The result has the methods `encode_preactivation` and `decode` of
+    `FoldedVAE`.
+
+    Args:
+        model: trained VAE
+        backend: "script" (`torch.jit.script`, frozen so that weights are
+            inlined as constants) or "compile" (`torch.compile`, which
+            compiles each method on its first call)
+
+    Raises:
+        ValueError: Unknown backend
+    """
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(
+            f"Unknown inference backend '{backend}'. "
+            f"Expected one of: {', '.join(INFERENCE_BACKENDS)}."
+        )
+    folded = FoldedVAE(model).to(model.device)
+    methods = ["encode_preactivation", "decode"]
+    if backend == "compile":
+        for name in methods:
+            setattr(folded, name, torch.compile(getattr(folded, name), dynamic=True))
+        return folded
+    return torch.jit.freeze(torch.jit.script(folded), preserved_attrs=methods)
+
+
+def quantize_vae(model: "VAE") -> "VAE":
+    """Return a copy of a trained VAE for inference, with dynamically
+    quantized linear layers: int8 weights (scaled per output channel), and
+    activations quantized on the fly (`torch.ao.quantization.quantize_dynamic`).
+
+    The first encoder layer is kept in float, as perturbations update its
+    pre-activations from its weights. Batch normalizations are also kept in
+    float.
+
+    Args:
+        model: trained VAE (on the CPU)
+
+    Raises:
+        ValueError: Quantized layers only run on the CPU
+    """
+    if model.device.type != "cpu":
+        raise ValueError("Quantized models only run on the CPU.")
+    qconfig_spec = {
+        name: torch.ao.quantization.per_channel_dynamic_qconfig
+        for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and name != "encoderlayers.0"
+    }
+    quantized = torch.ao.quantization.quantize_dynamic(
+        model, qconfig_spec, dtype=torch.qint8
+    )
+    return quantized.eval()
@@ -1,16 +1,49 @@
 __all__ = ["VAE"]
 
 import logging
-from typing import Callable, Optional
+from typing import Any, Optional
 
 import torch
 from torch import nn, optim
 from torch.utils.data import DataLoader
 
 from move.core.typing import FloatArray, IntArray
+from move.models.inference import compile_inference
 
 logger = logging.getLogger("vae.py")
 
+# Floating-point formats of the forward passes. Lower precisions run the
+# forward passes with autocast, while weights, losses and outputs stay float32
+PRECISIONS = {
+    "float32": torch.float32,
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+}
+
+
+class _SparseInputLinear(torch.autograd.Function):
+    """Linear transformation of a sparse CSR input, whose cost grows with its
+    number of non-zero values. The gradient of the weights is dense anyway, so
+    it is computed from the densified input (faster than sparse kernels)."""
+
+    @staticmethod
+    def forward(
+        ctx: Any, x: torch.Tensor, weight: torch.Tensor, bias: torch.Tensor
+    ) -> torch.Tensor:
+        ctx.save_for_backward(x)
+        return torch.addmm(bias, x, weight.T)
+
+    @staticmethod
+    def backward(ctx: Any, grad_output: torch.Tensor) -> tuple[Any, ...]:
+        (x,) = ctx.saved_tensors
+        grad_weight = grad_bias = None
+        if ctx.needs_input_grad[1]:
+            # Transposed, so that its layout matches the weights (see `VAE`)
+            grad_weight = (x.to_dense().T @ grad_output).T
+        if ctx.needs_input_grad[2]:
+            grad_bias = grad_output.sum(0)
+        return None, grad_weight, grad_bias
+
 
 class VAE(nn.Module):
     """Variational autoencoder.
@@ -25,6 +58,12 @@ class VAE(nn.Module):
         categorical_weights: list of weights for each categorical dataset
         dropout: Probability of dropout on forward pass [0.2]
         cuda: Use CUDA (GPU accelerated training) [False]
+        precision: Precision of the forward passes: "float32", "bfloat16" or
+            "float16" [float32]
+
+    Input batches may be dense or sparse CSR tensors (see `make_dataset`).
+    Sparse batches are multiplied by the first encoder layer in time
+    proportional to their non-zero values.
 
     Raises:
         ValueError: Minimum 1 latent unit
@@ -35,6 +74,7 @@ class VAE(nn.Module):
             continuous datasets
         ValueError: Number of categorical weights must be the same as number of
             categorical datasets
+        ValueError: Unknown precision
     """
 
     def __init__(
@@ -48,6 +88,7 @@ class VAE(nn.Module):
         beta: float = 0.01,
         dropout: float = 0.2,
         cuda: bool = False,
+        precision: str = "float32",
     ):
 
         if num_latent < 1:
@@ -62,7 +103,15 @@ class VAE(nn.Module):
         if continuous_shapes is None and categorical_shapes is None:
             raise ValueError("Shapes of the input data must be provided.")
 
+        if precision not in PRECISIONS:
+            raise ValueError(
+                f"Unknown precision '{precision}'. "
+                f"Expected one of: {', '.join(PRECISIONS)}."
+            )
+
         self.input_size = 0
+        self.continuous_weights = None
+        self.categorical_weights = None
         if continuous_shapes is not None:
             self.num_continuous = sum(continuous_shapes)
             self.input_size += self.num_continuous
@@ -102,9 +151,40 @@ class VAE(nn.Module):
         self.num_hidden = list(num_hidden)
         self.num_latent = num_latent
         self.dropout = dropout
+        self.precision = precision
 
         self.device = torch.device("cuda" if cuda else "cpu")
 
+        # Loss segments: the index of the dataset of each input column, so that
+        # the errors of all datasets are reduced at once. Buffers follow the
+        # model across devices, but are not part of its state dict
+        if self.num_continuous > 0:
+            con_sizes = torch.tensor(self.continuous_shapes)
+            con_segment_ids = torch.repeat_interleave(
+                torch.arange(len(con_sizes)), con_sizes
+            )
+            # The error of each continuous dataset leaves out its last feature
+            # (as it always has). These go to an extra, discarded segment
+            con_segment_ids[con_sizes.cumsum(0) - 1] = len(con_sizes)
+            self.register_buffer("con_segment_ids", con_segment_ids, False)
+            self.register_buffer("con_sizes", con_sizes.float(), False)
+            con_weights = None
+            if self.continuous_weights is not None:
+                con_weights = torch.Tensor(self.continuous_weights)
+            self.register_buffer("con_weights", con_weights, False)
+        if self.num_categorical > 0:
+            cat_sizes = torch.tensor([shape[0] for shape in self.categorical_shapes])
+            cat_segment_ids = torch.repeat_interleave(
+                torch.arange(len(cat_sizes)),
+                torch.tensor([int.__mul__(*shape) for shape in categorical_shapes]),
+            )
+            self.register_buffer("cat_segment_ids", cat_segment_ids, False)
+            self.register_buffer("cat_sizes", cat_sizes.float(), False)
+            cat_weights = None
+            if self.categorical_weights is not None:
+                cat_weights = torch.Tensor(self.categorical_weights)
+            self.register_buffer("cat_weights", cat_weights, False)
+
         # Activation functions
         self.relu = nn.LeakyReLU()
         self.log_softmax = nn.LogSoftmax(dim=1)
@@ -121,6 +201,12 @@ class VAE(nn.Module):
         for nin, nout in zip([self.input_size] + self.num_hidden, self.num_hidden):
             self.encoderlayers.append(nn.Linear(nin, nout))
             self.encodernorms.append(nn.BatchNorm1d(nout))
+        # The weights of the first layer are stored column-major (a transposed
+        # view), so that the rows of its transpose are contiguous. A sparse
+        # input then only reads the rows of its non-zero columns. Dense inputs
+        # are unaffected, and state dicts are the same
+        first_layer = self.encoderlayers[0]
+        first_layer.weight = nn.Parameter(first_layer.weight.detach().T.contiguous().T)
 
         # Latent layers
         self.mu = nn.Linear(self.num_hidden[-1], self.num_latent)  # mu layer
@@ -136,6 +222,59 @@ class VAE(nn.Module):
         # Reconstruction - output layers
         self.out = nn.Linear(self.num_hidden[0], self.input_size)  # to output
 
+        # Compiled evaluation graph (see `compile_inference`). Kept out of the
+        # submodules, so that it is not part of the state dict
+        self.__dict__["_inference"] = None
+
+    def compile_inference(self, backend: str = "script") -> None:
+        """
+        Compiles the evaluation graph of the trained model, with its batch
+        normalizations folded into the following linear layers. While the
+        model is in evaluation mode, the compiled graph replaces all layers
+        but the first encoder layer (e.g., in `reconstruct` and `project`).
+
+        The graph is a copy of the current weights. It is discarded when the
+        model is set to training mode.
+
+        Args:
+            backend: "script" (TorchScript) or "compile" (`torch.compile`)
+
+        Raises:
+            ValueError: TorchScript graphs only run in float32
+        """
+        if backend == "script" and self.precision != "float32":
+            raise ValueError(
+                "TorchScript inference requires float32 precision. "
+                "Use the 'compile' backend instead."
+            )
+        self.__dict__["_inference"] = compile_inference(self, backend)
+
+    def autocast(self) -> torch.autocast:
+        """
+        Returns a context in which forward passes run in the precision of the
+        model (autocast is disabled in float32).
+        """
+        dtype = PRECISIONS[self.precision]
+        return torch.autocast(
+            self.device.type, dtype=dtype, enabled=dtype != torch.float32
+        )
+
+    def train(self, mode: bool = True) -> "VAE":
+        if mode:
+            # Weights are about to change
+            self.__dict__["_inference"] = None
+        return super().train(mode)
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Compiled graphs cannot be pickled
+        state = self.__dict__.copy()
+        state["_inference"] = None
+        return state
+
+    def _get_inference(self) -> Any:
+        """Return the compiled evaluation graph, if any and in evaluation mode."""
+        return None if self.training else self._inference
+
     def encode(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
         """
         Encodes the data in the data loader and returns the encoded matrix.
@@ -148,9 +287,72 @@ class VAE(nn.Module):
                 mean latent vector
                 log-variance latent vector
         """
+        return self.encode_preactivation(self.preactivate(x))
+
+    def preactivate(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Computes the pre-activations of the first encoder layer (i.e., the
+        output of its linear transformation).
+
+        Args:
+            x: input data (dense or sparse CSR)
+
+        Returns:
+            first-layer pre-activations
+        """
+        layer = self.encoderlayers[0]
+        if x.layout == torch.sparse_csr:
+            # Sparse kernels only run in float32
+            with torch.autocast(self.device.type, enabled=False):
+                return _SparseInputLinear.apply(x, layer.weight, layer.bias)
+        return layer(x)
+
+    def update_preactivation(
+        self, preactivation: torch.Tensor, delta: torch.Tensor, columns: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Updates the first-layer pre-activations of some input data after changing
+        a few of its columns, without recomputing the full linear transformation.
+
+        Each of the K perturbations changes D columns of the input. Their
+        pre-activations are obtained by adding W[:, columns] @ delta to the
+        pre-activations of the unperturbed data.
+
+        Args:
+            preactivation: pre-activations of the unperturbed data (2D: N x H)
+            delta: change of the perturbed columns (3D: K x N x D)
+            columns: indices of the perturbed columns (2D: K x D)
+
+        Returns:
+            pre-activations of the perturbed data (3D: K x N x H)
+        """
+        weight = self.encoderlayers[0].weight[:, columns]  # 3D: H x K x D
+        return preactivation + torch.bmm(delta, weight.permute(1, 2, 0))
+
+    def encode_preactivation(
+        self, x: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Encodes the data from the pre-activations of the first encoder layer.
+
+        Args:
+            x: first-layer pre-activations
+
+        Returns:
+            A tuple containing:
+                mean latent vector
+                log-variance latent vector
+        """
+        inference = self._get_inference()
+        if inference is not None:
+            return inference.encode_preactivation(x)
+
         # Hidden layers
-        for encoderlayer, encodernorm in zip(self.encoderlayers, self.encodernorms):
-            x = encoderlayer(x)
+        for i, (encoderlayer, encodernorm) in enumerate(
+            zip(self.encoderlayers, self.encodernorms)
+        ):
+            if i > 0:
+                x = encoderlayer(x)
             x = self.relu(x)
             x = self.dropoutlayer(x)
             x = encodernorm(x)
@@ -168,7 +370,8 @@ class VAE(nn.Module):
         Returns:
             sample from latent space distribution
         """
-        std = torch.exp(0.5 * logvar)
+        # Sampled in float32, so that the noise does not depend on the precision
+        std = torch.exp(0.5 * logvar.float())
         eps = torch.randn_like(std)
 
         return eps.mul(std).add_(mu)
@@ -196,7 +399,7 @@ class VAE(nn.Module):
                 cat_dataset.shape[0], cat_shape[0], cat_shape[1]
             )
             cat_out_tmp = cat_out_tmp.transpose(1, 2)
-            cat_out_tmp = self.log_softmax(cat_out_tmp)
+            cat_out_tmp = self.log_softmax(cat_out_tmp.float())
 
             cat_out.append(cat_out_tmp)
             pos += cat_shape[0] * cat_shape[1]
@@ -219,13 +422,19 @@ class VAE(nn.Module):
                 con_out:
                     reconstruction of continuous data
         """
-        for decoderlayer, decodernorm in zip(self.decoderlayers, self.decodernorms):
-            x = decoderlayer(x)
-            x = self.relu(x)
-            x = self.dropoutlayer(x)
-            x = decodernorm(x)
+        inference = self._get_inference()
+        if inference is not None:
+            reconstruction = inference.decode(x)
+        else:
+            for decoderlayer, decodernorm in zip(
+                self.decoderlayers, self.decodernorms
+            ):
+                x = decoderlayer(x)
+                x = self.relu(x)
+                x = self.dropoutlayer(x)
+                x = decodernorm(x)
 
-        reconstruction = self.out(x)
+            reconstruction = self.out(x)
 
         # Decompose reconstruction to categorical and continuous variables
         # if both types are in the input
@@ -243,7 +452,8 @@ class VAE(nn.Module):
         self, tensor: torch.Tensor
     ) -> tuple[list[torch.Tensor], torch.Tensor, torch.Tensor, torch.Tensor]:
         """
-        Forward propagate through the VAE network
+        Forward propagate through the VAE network. Outputs are float32, even
+        within autocast.
 
         Args:
             tensor (torch.Tensor): input data
@@ -259,8 +469,10 @@ class VAE(nn.Module):
         mu, logvar = self.encode(tensor)
         z = self.reparameterize(mu, logvar)
         cat_out, con_out = self.decode(z)
+        if con_out is not None:
+            con_out = con_out.float()
 
-        return cat_out, con_out, mu, logvar
+        return cat_out, con_out, mu.float(), logvar.float()
 
     def calculate_cat_error(
         self,
@@ -270,6 +482,11 @@ class VAE(nn.Module):
         """
         Calculates errors (cross-entropy) for categorical data reconstructions
 
+        Inputs are one-hot encoded (missing values have no category), so the
+        negative log-likelihood of every feature is the sum of its one-hot
+        input times its reconstructed log-probabilities. These are summed per
+        dataset in a single pass.
+
         Args:
             cat_in:
                 input categorical data
@@ -281,63 +498,46 @@ class VAE(nn.Module):
                 Errors (cross-entropy) for categorical data reconstructions
         """
         batch_size = cat_in.shape[0]
+        num_datasets = len(self.categorical_shapes)
 
-        # calcualte target values for all cat datasets
-        count = 0
-        cat_errors = []
-        pos = 0
-        for cat_shape in self.categorical_shapes:
-            cat_dataset = cat_in[:, pos : (cat_shape[0] * cat_shape[1] + pos)]
-
-            cat_dataset = cat_dataset.view(cat_in.shape[0], cat_shape[0], cat_shape[1])
-            cat_target = cat_dataset
-            cat_target = cat_target.argmax(2)
-            cat_target[cat_dataset.sum(dim=2) == 0] = -1
-            cat_target = cat_target.to(self.device)
-
-            # Cross entropy loss for categroical
-            loss = nn.NLLLoss(reduction="sum", ignore_index=-1)
-            cat_errors.append(
-                loss(cat_out[count], cat_target) / (batch_size * cat_shape[0])
-            )
-            count += 1
-            pos += cat_shape[0] * cat_shape[1]
-
-        cat_errors = torch.stack(cat_errors)
-        return cat_errors
+        # Log-probabilities in the layout of the input (features x categories)
+        log_probs = torch.cat(
+            [out.transpose(1, 2).reshape(batch_size, -1) for out in cat_out], dim=1
+        )
+        nll = -torch.sum(cat_in * log_probs, dim=0)
+        cat_errors = torch.zeros(
+            num_datasets, dtype=nll.dtype, device=nll.device
+        ).index_add_(0, self.cat_segment_ids, nll)
+        return cat_errors / (batch_size * self.cat_sizes)
 
     def calculate_con_error(
         self,
         con_in: torch.Tensor,
         con_out: torch.Tensor,
-        loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
     ) -> torch.Tensor:
         """
         Calculates errors (MSE) for continuous data reconstructions
 
+        Squared errors are summed per dataset in a single pass, normalized by
+        the dataset size, and weighted.
+
         Args:
             con_in: input continuous data
             con_out: reconstructions of continuous data
-            loss: loss function
 
         Returns:
             MSE loss
         """
         batch_size = con_in.shape[0]
-        total_shape = 0
-        con_errors_list: list[torch.Tensor] = []
-        for s in self.continuous_shapes:
-            c_in = con_in[:, total_shape : (s + total_shape - 1)]
-            c_re = con_out[:, total_shape : (s + total_shape - 1)]
-            error = loss(c_re, c_in) / batch_size
-            con_errors_list.append(error)
-            total_shape += s
-
-        con_errors = torch.stack(con_errors_list)
-        con_errors = con_errors / torch.Tensor(self.continuous_shapes).to(self.device)
-        MSE = torch.sum(
-            con_errors * torch.Tensor(self.continuous_weights).to(self.device)
-        )
+        num_datasets = len(self.continuous_shapes)
+
+        sse = torch.sum((con_out - con_in) ** 2, dim=0)
+        con_errors = torch.zeros(
+            num_datasets + 1, dtype=sse.dtype, device=sse.device
+        ).index_add_(0, self.con_segment_ids, sse)
+        con_errors = con_errors[:num_datasets] / batch_size
+        con_errors = con_errors / self.con_sizes
+        MSE = torch.sum(con_errors * self.con_weights)
         return MSE
 
     # Reconstruction + KL divergence losses summed over all elements and batch
@@ -377,9 +577,7 @@ class VAE(nn.Module):
         if cat_out is not None:
             cat_errors = self.calculate_cat_error(cat_in, cat_out)
             if self.categorical_weights is not None:
-                CE = torch.sum(
-                    cat_errors * torch.Tensor(self.categorical_weights).to(self.device)
-                )
+                CE = torch.sum(cat_errors * self.cat_weights)
             else:
                 CE = torch.sum(cat_errors) / len(cat_errors)
 
@@ -393,7 +591,7 @@ class VAE(nn.Module):
 
             # include different weights for each omics dataset
             if self.continuous_weights is not None:
-                MSE = self.calculate_con_error(con_in, con_out, loss)
+                MSE = self.calculate_con_error(con_in, con_out)
             else:
                 MSE = loss(con_out, con_in) / (batch_size * self.num_continuous)
 
@@ -414,6 +612,7 @@ class VAE(nn.Module):
         epoch: int,
         lrate: float,
         kld_w: float,
+        optimizer: Optional[optim.Optimizer] = None,
     ) -> tuple[float, float, float, float]:
         """
         One iteration of VAE
@@ -423,6 +622,9 @@ class VAE(nn.Module):
             epoch: the epoch
             lrate: learning rate for the model
             kld_w: float of KLD weight
+            optimizer: optimizer of the model parameters, kept across epochs.
+                If not set, a new Adam optimizer (with learning rate `lrate`)
+                is created for this epoch.
 
         Returns:
             (tuple): a tuple containing:
@@ -432,7 +634,12 @@ class VAE(nn.Module):
                 KLD loss on train set during the training of the epoch
         """
         self.train()
-        optimizer = optim.Adam(self.parameters(), lr=lrate)
+        if optimizer is None:
+            optimizer = optim.Adam(self.parameters(), lr=lrate)
+        # Gradients in float16 may underflow, so the loss is scaled
+        scaler = torch.amp.GradScaler(
+            self.device.type, enabled=self.precision == "float16"
+        )
 
         epoch_loss = 0
         epoch_kldloss = 0
@@ -441,28 +648,20 @@ class VAE(nn.Module):
 
         for _, (cat, con) in enumerate(train_loader):
             # Move input to GPU if requested
-            cat = cat.to(self.device)
-            con = con.to(self.device)
-
-            if self.num_categorical > 0 and self.num_continuous > 0:
-                tensor = torch.cat((cat, con), 1)
-            elif self.num_categorical > 0:
-                tensor = cat
-            elif self.num_continuous > 0:
-                tensor = con
-            else:
-                raise ValueError(
-                    "Must have at least 1 categorial or 1 continuous feature"
-                )
+            tensor = self._validate_batch((cat, con))
+            # Losses compare reconstructions with dense inputs
+            cat = cat.to(self.device).to_dense()
+            con = con.to(self.device).to_dense()
 
             optimizer.zero_grad()
 
-            cat_out, con_out, mu, logvar = self(tensor)
+            with self.autocast():
+                cat_out, con_out, mu, logvar = self(tensor)
 
             loss, bce, sse, kld = self.loss_function(
                 cat, cat_out, con, con_out, mu, logvar, kld_w
             )
-            loss.backward()
+            scaler.scale(loss).backward()
 
             epoch_loss += loss.data.item()
             epoch_kldloss += kld.data.item()
@@ -473,7 +672,8 @@ class VAE(nn.Module):
             if self.num_categorical > 0:
                 epoch_bceloss += bce.data.item()
 
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
 
         logger.info(
             "\tEpoch: {}\tLoss: {:.6f}\tCE: {:.7f}\tSSE: {:.6f}\t"
@@ -571,7 +771,7 @@ class VAE(nn.Module):
     def _validate_batch(self, batch: tuple[torch.Tensor, torch.Tensor]) -> torch.Tensor:
         """
         Returns the batch of categorical and continuous data if they are not
-        None
+        None. Sparse CSR batches remain sparse.
 
         Args:
             batch: batches of categorical and continuous data
@@ -587,6 +787,9 @@ class VAE(nn.Module):
             return con
         elif self.num_continuous == 0:
             return cat
+        if cat.layout == torch.sparse_csr or con.layout == torch.sparse_csr:
+            # CSR tensors cannot be concatenated, but COO tensors can
+            return torch.cat((cat.to_sparse(), con.to_sparse()), dim=1).to_sparse_csr()
         return torch.cat((cat, con), dim=1)
 
     @torch.no_grad()
@@ -603,7 +806,8 @@ class VAE(nn.Module):
         embedding = []
         for batch in dataloader:
             batch = self._validate_batch(batch)
-            *_, mu, _ = self(batch)
+            with self.autocast():
+                *_, mu, _ = self(batch)
             embedding.append(mu)
         embedding = torch.cat(embedding, dim=0).cpu().numpy()
         return embedding
@@ -627,7 +831,8 @@ class VAE(nn.Module):
         con_recons = []
         for batch in dataloader:
             batch = self._validate_batch(batch)
-            cat_recon, con_recon, *_ = self(batch)
+            with self.autocast():
+                cat_recon, con_recon, *_ = self(batch)
             if cat_recon is not None:
                 for i, cat in enumerate(cat_recon):
                     cat_recons[i].append(torch.argmax(cat, dim=1))
@@ -685,23 +890,14 @@ class VAE(nn.Module):
 
         row = 0
         for cat, con in dataloader:
-            cat = cat.to(self.device)
-            con = con.to(self.device)
-
             # get dataset
-            if self.num_categorical > 0 and self.num_continuous > 0:
-                tensor = torch.cat((cat, con), 1)
-            elif self.num_categorical > 0:
-                tensor = cat
-            elif self.num_continuous > 0:
-                tensor = con
-            else:
-                raise ValueError(
-                    "Must have at least 1 categorial or 1 continuous feature"
-                )
+            tensor = self._validate_batch((cat, con))
+            cat = cat.to(self.device).to_dense()
+            con = con.to(self.device).to_dense()
 
             # Evaluate
-            cat_out, con_out, mu, logvar = self(tensor)
+            with self.autocast():
+                cat_out, con_out, mu, logvar = self(tensor)
 
             mu = mu.to(self.device)
             logvar = logvar.to(self.device)
@@ -5,15 +5,13 @@ __all__ = ["analyze_latent"]
 
 import re
 from pathlib import Path
-from typing import Sized, cast
+from typing import Any, Callable, Sized, cast
 
 import hydra
 import numpy as np
 import pandas as pd
 import torch
-import torch.multiprocessing
 from sklearn.base import TransformerMixin
-from torch.multiprocessing import Pool
 
 import move.visualization as viz
 from move.analysis.metrics import (
@@ -22,15 +20,18 @@ from move.analysis.metrics import (
 )
 from move.conf.schema import AnalyzeLatentConfig, MOVEConfig
 from move.core.logging import get_logger
+from move.core.parallel import get_pool_layout, make_pool
 from move.core.typing import FloatArray
 from move.data import io
 from move.data.dataloaders import MOVEDataset, make_dataloader
-from move.data.perturbations import (
-    perturb_categorical_data_one,
-    perturb_continuous_data_one,
-)
 from move.data.preprocessing import one_hot_encode_single
 from move.models.vae import VAE
+from move.tasks.perturbation_engine import (
+    get_model_input,
+    get_perturbed_columns,
+    project_perturbed_block,
+)
+from move.tasks.refit_training import check_quantization, quantize_refits
 from move.training.training_loop import TrainingLoopOutput
 
 
@@ -72,95 +73,77 @@ def find_feature_values(
 def _validate_task_config(task_config: AnalyzeLatentConfig) -> None:
     if "_target_" not in task_config.reducer:
         raise ValueError("Reducer class not specified properly.")
-
-
-def _categorical_importance_worker(args):
+    if task_config.quantize:
+        check_quantization(task_config.model)
+
+
+# State shared with the pool processes. The test data, model, first-layer
+# pre-activations and baseline projection live in shared memory and are handed
+# to each process once by the initializer, so tasks only carry the index of the
+# perturbed feature.
+_worker_state: dict[str, Any] = {}
+
+
+def _init_importance_worker(
+    test_dataset: MOVEDataset,
+    dataset_name: str,
+    target_idx: int,
+    is_continuous: bool,
+    value: torch.Tensor,
+    model: VAE,
+    baseline_input: torch.Tensor,
+    baseline_preactivation: torch.Tensor,
+    z: torch.Tensor,
+) -> None:
     """
-    Worker function to calculate the importance of categorical features
+    Pool initializer. Stores references to the shared data and model in the
+    worker process.
     """
-    torch.set_num_threads(1)
-
-    logger = get_logger(__name__)
-
-    (
-        test_dataloader,
-        categorical_names,
-        dataset_name,
-        na_value,
-        index_pert_feat,
-        num_features,
-        model,
-        z,
-    ) = args
-
-    # Diff will store the differences between z and
-    # z_perturb for the perturbed feature index_pert_feat
-    diff = np.empty((num_features))
-
-    logger.debug(f"Perturbing feature {index_pert_feat} for {dataset_name}")
-    dataloader = perturb_categorical_data_one(
-        test_dataloader,
-        categorical_names,
-        dataset_name,
-        na_value,
-        index_pert_feat,
-    )
-    logger.debug(
-        "Perturbation completed. Projecting perturbation on latent space for "
-        f"feature {index_pert_feat}, {dataset_name}"
-    )
-    z_perturb = model.project(dataloader)
-    logger.debug(f"Calculating diff for feature {index_pert_feat}, {dataset_name}")
-    diff = np.sum(z_perturb - z, axis=1)
-
-    logger.debug(
-        "Finished catagorical worker function for "
-        f"feature {index_pert_feat}, {dataset_name}"
-    )
-    return index_pert_feat, diff
-
-
-def _continuous_importance_worker(args):
+    _worker_state.clear()
+    _worker_state["test_dataset"] = test_dataset
+    _worker_state["baseline_input"] = baseline_input
+    _worker_state["dataset_name"] = dataset_name
+    _worker_state["target_idx"] = target_idx
+    _worker_state["is_continuous"] = is_continuous
+    _worker_state["value"] = value
+    _worker_state["model"] = model
+    _worker_state["baseline_preactivation"] = baseline_preactivation
+    _worker_state["z"] = z.numpy()
+
+
+def _importance_worker(index_pert_feat: int):
     """
-    Worker function to calculate the importance of continuous features
+    Worker function to calculate the importance of a categorical or continuous
+    feature
     """
-    torch.set_num_threads(1)
-
     logger = get_logger(__name__)
 
-    (
-        test_dataloader,
-        continuous_names,
-        dataset_name,
-        index_pert_feat,
-        num_features,
-        model,
-        z,
-    ) = args
-
-    # Diff will store the differences between z and z_perturb for the perturbed
-    # feature index_pert_feat
-    diff = np.empty((num_features))
-
-    logger.debug(f"Perturbing feature {index_pert_feat} for {dataset_name}")
-    dataloader = perturb_continuous_data_one(
-        test_dataloader,
-        continuous_names,
-        dataset_name,
-        0.0,
-        index_pert_feat,
-    )
+    dataset_name = _worker_state["dataset_name"]
+
     logger.debug(
-        "Perturbation completed. Projecting perturbation on latent space for "
+        "Projecting perturbation on latent space for "
         f"feature {index_pert_feat}, {dataset_name}"
     )
-    z_perturb = model.project(dataloader)
+    columns = get_perturbed_columns(
+        _worker_state["test_dataset"],
+        _worker_state["target_idx"],
+        _worker_state["is_continuous"],
+        [index_pert_feat],
+    )
+    z_perturb = project_perturbed_block(
+        _worker_state["model"],
+        _worker_state["baseline_input"],
+        _worker_state["baseline_preactivation"],
+        columns,
+        _worker_state["value"],
+    )[0]
     logger.debug(f"Calculating diff for feature {index_pert_feat}, {dataset_name}")
-    diff = np.sum(z_perturb - z, axis=1)
+    # Diff stores the differences between z and z_perturb for the perturbed
+    # feature index_pert_feat
+    diff = np.sum(z_perturb - _worker_state["z"], axis=1)
 
     logger.debug(
-        "Finished continuous worker function for "
-        f"feature {index_pert_feat}, {dataset_name}"
+        f"Finished worker function for feature {index_pert_feat}, {dataset_name}"
     )
     return index_pert_feat, diff
 
@@ -208,7 +191,7 @@ def analyze_latent(config: MOVEConfig) -> None:
     model_path = output_path / "model.pt"
     if model_path.exists():
         logger.debug(f"Re-loading model from {model_path}")
-        model.load_state_dict(torch.load(model_path))
+        model.load_state_dict(io.load_checkpoint(model_path))
         model.to(device)
     else:
         logger.debug("Training model")
@@ -218,6 +201,7 @@ def analyze_latent(config: MOVEConfig) -> None:
             cat_list,
             con_list,
             shuffle=True,
+            sparse=config.data.sparse_input,
             batch_size=task_config.batch_size,
             drop_last=True,
         )
@@ -227,12 +211,15 @@ def analyze_latent(config: MOVEConfig) -> None:
             train_dataloader=train_dataloader,
         )
         losses = output[:-1]
-        torch.save(model.state_dict(), model_path)
+        io.dump_checkpoint(model_path, model.state_dict())
         logger.info("Generating visualizations")
         logger.debug("Generating plot: loss curves")
-        fig = viz.plot_loss_curves(losses)
-        fig_path = str(output_path / "loss_curve.png")
-        fig.savefig(fig_path, bbox_inches="tight")
+        viz.submit_figure(
+            output_path / "loss_curve.png",
+            viz.plot_loss_curves,
+            losses,
+            savefig_kwargs=dict(bbox_inches="tight"),
+        )
         fig_df = pd.DataFrame(dict(zip(viz.LOSS_LABELS, losses)))
         fig_df.index.name = "epoch"
         fig_df.to_csv(output_path / "loss_curve.tsv", sep="\t")
@@ -282,7 +269,8 @@ def analyze_latent(config: MOVEConfig) -> None:
             feature_mapping = {
                 str(code): category for category, code in mappings[dataset_name].items()
             }
-            fig = viz.plot_latent_space_with_cat(
+            plot_func: Callable = viz.plot_latent_space_with_cat
+            plot_args: tuple = (
                 embedding,
                 feature_name,
                 feature_values,
@@ -292,15 +280,16 @@ def analyze_latent(config: MOVEConfig) -> None:
             fig_df[feature_name] = np.where(is_nan, np.nan, feature_values)
         else:
             feature_values = feature_values
-            fig = viz.plot_latent_space_with_con(
-                embedding, feature_name, feature_values
-            )
+            plot_func = viz.plot_latent_space_with_con
+            plot_args = (embedding, feature_name, feature_values)
             fig_df[feature_name] = np.where(feature_values == 0, np.nan, feature_values)
 
         # Remove non-alpha characters
         safe_feature_name = re.sub(r"[^\w\s]", "", feature_name)
-        fig_path = str(output_path / f"latent_space_{safe_feature_name}.png")
-        fig.savefig(fig_path, bbox_inches="tight")
+        fig_path = output_path / f"latent_space_{safe_feature_name}.png"
+        viz.submit_figure(
+            fig_path, plot_func, *plot_args, savefig_kwargs=dict(bbox_inches="tight")
+        )
 
     fig_df.to_csv(output_path / "latent_space.tsv", sep="\t")
 
@@ -320,15 +309,38 @@ def analyze_latent(config: MOVEConfig) -> None:
     logger.debug("Generating plot: reconstruction metrics")
 
     plot_scores = [np.ma.compressed(np.ma.masked_equal(each, 0)) for each in scores]
-    fig = viz.plot_metrics_boxplot(plot_scores, labels)
-    fig_path = str(output_path / "reconstruction_metrics.png")
-    fig.savefig(fig_path, bbox_inches="tight")
+    viz.submit_figure(
+        output_path / "reconstruction_metrics.png",
+        viz.plot_metrics_boxplot,
+        plot_scores,
+        labels,
+        savefig_kwargs=dict(bbox_inches="tight"),
+    )
     fig_df = pd.DataFrame(dict(zip(labels, scores)), index=df_index)
     fig_df.to_csv(output_path / "reconstruction_metrics.tsv", sep="\t")
 
     logger.info("Computing feature importance")
     num_samples = len(cast(Sized, test_dataloader.sampler))
 
+    if task_config.quantize:
+        (model,) = quantize_refits(
+            [model], [0], test_dataloader, output_path / "quantization_qc.tsv"
+        )
+
+    # The first-layer pre-activations of the test data are computed once. Each
+    # perturbation only updates them with the change of its own columns
+    with torch.no_grad():
+        baseline_input = get_model_input(model, test_dataset)
+        baseline_preactivation = model.preactivate(baseline_input)
+
+    if config.task.multiprocess:
+        # Pool processes read the test data and model weights from shared
+        # memory, instead of receiving a copy with every perturbed feature
+        test_dataset.share_memory_()
+        model.share_memory()
+        baseline_input.share_memory_()
+        baseline_preactivation.share_memory_()
+
     # START WITH IMPORTANCE FOR CATEGORICAL FEATURES. MADE CHANGES HERE
     for i, dataset_name in enumerate(config.data.categorical_names):
         logger.debug(f"Generating plot: feature importance '{dataset_name}'")
@@ -344,57 +356,69 @@ def analyze_latent(config: MOVEConfig) -> None:
         diffs = np.empty((num_samples, num_features))
 
         if config.task.multiprocess:
-            args = [
-                (
-                    test_dataloader,
-                    config.data.categorical_names,
-                    dataset_name,
-                    na_value,
-                    index_pert_feat,
-                    num_features,
-                    model,
-                    z,
-                )
-                for index_pert_feat in range(num_features)
-            ]
-
-            with Pool(processes=torch.multiprocessing.cpu_count() - 1) as pool:
+            initargs = (
+                test_dataset,
+                dataset_name,
+                target_idx,
+                False,
+                torch.from_numpy(na_value),
+                model,
+                baseline_input,
+                baseline_preactivation,
+                torch.from_numpy(z).share_memory_(),
+            )
+            results: list[Any] = []
+            layout = get_pool_layout(
+                task_config.parallel,
+                _importance_worker,
+                range(num_features),
+                _init_importance_worker,
+                initargs,
+                results,
+            )
+            with make_pool(layout, _init_importance_worker, initargs) as pool:
                 logger.debug("Inside the pool loop for categorical features")
-                # Map worker function to arguments
-                # We get the bayes_k matrix, filled for all the perturbed features
-                results = pool.map(_categorical_importance_worker, args)
+                # Map worker function to the indices of the perturbed features
+                # (features timed to pick the layout are not computed again)
+                results += pool.map(
+                    _importance_worker,
+                    range(len(results), num_features),
+                    chunksize=task_config.parallel.chunksize,
+                )
 
             # Unpack results
             for j, diff in results:
                 diffs[:, j] = diff
 
         else:
-            j = 0  # Index to keep count of the perturbed feature we are in
-
             for index_pert_feat in range(num_features):
-                dataloader = perturb_categorical_data_one(
-                    test_dataloader,
-                    config.data.categorical_names,
-                    dataset_name,
-                    na_value,
-                    index_pert_feat,
+                # Perturbing a feature sets its one-hot columns to the NaN value
+                columns = get_perturbed_columns(
+                    test_dataset, target_idx, False, [index_pert_feat]
                 )
                 # We calculate the difference for each of the perturbed features,
                 # and store it in an object
-
-                z_perturb = model.project(dataloader)
-                diffs[:, j] = np.sum(z_perturb - z, axis=1)
-
-                j = j + 1  # Increase j for the next iteration
+                z_perturb = project_perturbed_block(
+                    model,
+                    baseline_input,
+                    baseline_preactivation,
+                    columns,
+                    torch.from_numpy(na_value),
+                )[0]
+                diffs[:, index_pert_feat] = np.sum(z_perturb - z, axis=1)
 
         feature_mapping = {
             str(code): category for category, code in mappings[dataset_name].items()
         }
-        fig = viz.plot_categorical_feature_importance(
-            diffs, cat_list[i], cat_names[i], feature_mapping
+        viz.submit_figure(
+            output_path / f"feat_importance_{dataset_name}.png",
+            viz.plot_categorical_feature_importance,
+            diffs,
+            cat_list[i],
+            cat_names[i],
+            feature_mapping,
+            savefig_kwargs=dict(bbox_inches="tight"),
         )
-        fig_path = str(output_path / f"feat_importance_{dataset_name}.png")
-        fig.savefig(fig_path, bbox_inches="tight")
         fig_df = pd.DataFrame(diffs, columns=cat_names[i], index=df_index)
         fig_df.to_csv(output_path / f"feat_importance_{dataset_name}.tsv", sep="\t")
     logger.info(
@@ -417,24 +441,35 @@ def analyze_latent(config: MOVEConfig) -> None:
         diffs = np.empty((num_samples, num_features))
 
         if config.task.multiprocess:
-            args = [
-                (
-                    test_dataloader,
-                    config.data.continuous_names,
-                    dataset_name,
-                    index_pert_feat,
-                    num_features,
-                    model,
-                    z,
-                )
-                for index_pert_feat in range(num_features)
-            ]
-
-            with Pool(processes=torch.multiprocessing.cpu_count() - 1) as pool:
+            initargs = (
+                test_dataset,
+                dataset_name,
+                target_idx,
+                True,
+                torch.tensor(0.0),
+                model,
+                baseline_input,
+                baseline_preactivation,
+                torch.from_numpy(z).share_memory_(),
+            )
+            results = []
+            layout = get_pool_layout(
+                task_config.parallel,
+                _importance_worker,
+                range(num_features),
+                _init_importance_worker,
+                initargs,
+                results,
+            )
+            with make_pool(layout, _init_importance_worker, initargs) as pool:
                 logger.debug("Inside the pool loop for continuous features")
-                # Map worker function to arguments
-                # We get the bayes_k matrix, filled for all the perturbed features
-                results = pool.map(_continuous_importance_worker, args)
+                # Map worker function to the indices of the perturbed features
+                # (features timed to pick the layout are not computed again)
+                results += pool.map(
+                    _importance_worker,
+                    range(len(results), num_features),
+                    chunksize=task_config.parallel.chunksize,
+                )
 
             # Unpack results
 
@@ -445,26 +480,28 @@ def analyze_latent(config: MOVEConfig) -> None:
             logger.debug(f"Generating plot for {dataset_name}")
 
         else:
-            # Index to check the number of perturbed feature we are in now
-            j = 0
-
             for index_pert_feat in range(num_features):
-                dataloader = perturb_continuous_data_one(
-                    test_dataloader,
-                    config.data.continuous_names,
-                    dataset_name,
-                    0.0,
-                    index_pert_feat,
+                # Perturbing a feature sets its column to zero
+                columns = get_perturbed_columns(
+                    test_dataset, target_idx, True, [index_pert_feat]
                 )
-
-                z_perturb = model.project(dataloader)
-                diffs[:, j] = np.sum(z_perturb - z, axis=1)
-
-                j = j + 1
-
-        fig = viz.plot_continuous_feature_importance(diffs, con_list[i], con_names[i])
-        fig_path = str(output_path / f"feat_importance_{dataset_name}.png")
-        fig.savefig(fig_path, bbox_inches="tight")
+                z_perturb = project_perturbed_block(
+                    model,
+                    baseline_input,
+                    baseline_preactivation,
+                    columns,
+                    torch.tensor(0.0),
+                )[0]
+                diffs[:, index_pert_feat] = np.sum(z_perturb - z, axis=1)
+
+        viz.submit_figure(
+            output_path / f"feat_importance_{dataset_name}.png",
+            viz.plot_continuous_feature_importance,
+            diffs,
+            con_list[i],
+            con_names[i],
+            savefig_kwargs=dict(bbox_inches="tight"),
+        )
         fig_df = pd.DataFrame(diffs, columns=con_names[i], index=df_index)
         fig_df.to_csv(output_path / f"feat_importance_{dataset_name}.tsv", sep="\t")
 
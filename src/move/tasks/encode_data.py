@@ -8,6 +8,7 @@ from move.conf.schema import DataConfig
 from move.core.logging import get_logger
 from move.data import io, preprocessing
 from move.visualization.dataset_distributions import plot_value_distributions
+from move.visualization.rendering import submit_figure
 
 
 def encode_data(config: DataConfig):
@@ -53,11 +54,8 @@ def encode_data(config: DataConfig):
 
         # Plotting the value distribution for all continuous datasets
         # before preprocessing:
-        fig = plot_value_distributions(values)
-        fig_path = str(
-            output_path / f"Value_distribution_{dataset_name}_unprocessed.png"
-        )
-        fig.savefig(fig_path)
+        fig_path = output_path / f"Value_distribution_{dataset_name}_unprocessed.png"
+        submit_figure(fig_path, plot_value_distributions, values)
 
         if scale:
             logger.debug(
@@ -67,9 +65,8 @@ def encode_data(config: DataConfig):
             names = names[mask_1d]
             logger.debug(f"Columns with zero variance: {np.sum(~mask_1d)}")
             # Plotting the value distribution for all continuous datasets:
-            fig = plot_value_distributions(values)
-            fig_path = str(output_path / f"Value_distribution_{dataset_name}.png")
-            fig.savefig(fig_path)
+            fig_path = output_path / f"Value_distribution_{dataset_name}.png"
+            submit_figure(fig_path, plot_value_distributions, values)
 
         io.dump_names(interim_data_path / f"{dataset_name}.txt", names)
         np.save(interim_data_path / f"{dataset_name}.npy", values)
@@ -1,19 +1,20 @@
 __all__ = ["identify_associations"]
 
+import hashlib
 from functools import reduce
-from os.path import exists
 from pathlib import Path
-from typing import Literal, Sized, Union, cast
+from typing import Any, Literal, Optional, Sized, Union, cast
 
-import hydra
 import numpy as np
 import pandas as pd
 import torch
-from omegaconf import OmegaConf
-from scipy.stats import ks_2samp, pearsonr  # type: ignore
+from omegaconf import DictConfig, OmegaConf
 from torch.utils.data import DataLoader
 
-from move.analysis.metrics import get_2nd_order_polynomial
+from move.analysis.metrics import (
+    calculate_ks_statistics,
+    calculate_reconstruction_qc,
+)
 from move.conf.schema import (
     IdentifyAssociationsBayesConfig,
     IdentifyAssociationsConfig,
@@ -31,17 +32,41 @@ from move.data.perturbations import (
     perturb_continuous_data_extended,
 )
 from move.data.preprocessing import one_hot_encode_single
-from move.models.vae import VAE
+from move.models.inference import INFERENCE_BACKENDS
 from move.tasks.bayes_parallel import _bayes_approach_parallel
+from move.tasks.ks_parallel import _ks_approach_parallel
+from move.tasks.perturbation_engine import (
+    Refit,
+    calculate_bayes_k_block,
+    calculate_ttest_pvalues_block,
+    check_bayes_k_precision,
+    get_bayes_models_path,
+    get_block_delta,
+    make_refit,
+    plot_perturbation_distribution,
+    reconstruct_block,
+    restore_bayes_k_blocks,
+    select_bayes_associations,
+    store_bayes_k_block,
+)
+from move.tasks.refit_training import (
+    check_quantization,
+    get_baseline_recon_path,
+    get_refit_path,
+    quantize_refits,
+    train_refits,
+)
+from move.tasks.results_store import ResultsStore
+from move.tasks.ttest_parallel import _ttest_approach_parallel
 from move.visualization.dataset_distributions import (
     plot_correlations,
     plot_cumulative_distributions,
     plot_feature_association_graph,
     plot_reconstruction_movement,
 )
+from move.visualization.rendering import submit_figure
 
-# We can do three types of statistical tests. Multiprocessing is only implemented
-# for bayes at the moment
+# We can do three types of statistical tests, all of them with multiprocessing
 TaskType = Literal["bayes", "ttest", "ks"]
 
 # Possible values for continuous pertrubation
@@ -68,12 +93,59 @@ def _validate_task_config(
 ) -> None:
     if not (0.0 <= task_config.sig_threshold <= 1.0):
         raise ValueError("Significance threshold must be within [0, 1].")
+    io.check_table_format(task_config.results_format)
+    backend = task_config.inference_backend
+    if backend is not None and backend not in INFERENCE_BACKENDS:
+        raise ValueError(
+            f"Unknown inference backend '{backend}'. "
+            f"Expected one of: {', '.join(INFERENCE_BACKENDS)}."
+        )
+    if (
+        backend == "script"
+        and task_config.model is not None
+        and task_config.model.precision != "float32"
+    ):
+        raise ValueError("TorchScript inference requires float32 precision.")
+    if task_config.quantize:
+        check_quantization(task_config.model)
+        if backend is not None:
+            raise ValueError("Quantized models cannot use an inference backend.")
     if task_type == "ttest":
         task_config = cast(IdentifyAssociationsTTestConfig, task_config)
         if len(task_config.num_latent) != 4:
             raise ValueError("4 latent space dimensions required.")
 
 
+def _get_results_signature(
+    config: MOVEConfig, baseline_dataset: MOVEDataset
+) -> dict[str, Any]:
+    """Describe what determines the results of the task: the task configuration
+    (except options that only affect how results are computed) and the data."""
+    task_config = OmegaConf.to_container(cast(DictConfig, config.task))
+    assert isinstance(task_config, dict)
+    for option in (
+        "multiprocess",
+        "inference_backend",
+        "parallel",
+        "perturbation_block_size",
+        "resume",
+        "results_format",
+        "save_refits",
+        "training_parallel",
+    ):
+        task_config.pop(option, None)
+    data_hash = hashlib.sha1()
+    for tensor in (baseline_dataset.cat_all, baseline_dataset.con_all):
+        if tensor is not None:
+            data_hash.update(tensor.numpy().tobytes())
+    return dict(
+        task=task_config,
+        categorical_names=list(config.data.categorical_names),
+        continuous_names=list(config.data.continuous_names),
+        data=data_hash.hexdigest(),
+    )
+
+
 def prepare_for_categorical_perturbation(
     config: MOVEConfig,
     interim_path: Path,
@@ -164,159 +236,139 @@ def _bayes_approach(
     task_config: IdentifyAssociationsBayesConfig,
     train_dataloader: DataLoader,
     baseline_dataloader: DataLoader,
-    dataloaders: list[DataLoader],
     models_path: Path,
     num_perturbed: int,
     num_samples: int,
     num_continuous: int,
     nan_mask: BoolArray,
     feature_mask: BoolArray,
+    results_store: ResultsStore,
 ) -> tuple[Union[IntArray, FloatArray], ...]:
 
     assert task_config.model is not None
-    device = torch.device("cuda" if task_config.model.cuda else "cpu")
 
     # Train or reload models
     logger.info("Training or reloading models")
-    mean_diff = np.zeros((num_perturbed, num_samples, num_continuous))
-    normalizer = 1 / task_config.num_refits
 
     # non-perturbed baseline dataset
     baseline_dataset = cast(MOVEDataset, baseline_dataloader.dataset)
 
-    for j in range(task_config.num_refits):
-        # We create as many models (refits) as indicated in the config file
-        # For each j (number of refits) we train a different model, but on the same data
-        # Initialize model
-        model: VAE = hydra.utils.instantiate(
-            task_config.model,
-            continuous_shapes=baseline_dataset.con_shapes,
-            categorical_shapes=baseline_dataset.cat_shapes,
+    # All refits are kept in memory, together with their baseline reconstruction
+    # and the first-layer pre-activations of the baseline data. They are saved
+    # if the results store may be resumed
+    models_path, save_refits = get_bayes_models_path(
+        task_config, models_path, results_store
+    )
+    is_reloaded = [
+        get_refit_path(models_path, task_config.model.num_latent, j).exists()
+        for j in range(task_config.num_refits)
+    ]
+    is_changed = not all(is_reloaded)
+    models = train_refits(
+        task_config.model,
+        task_config.training_loop,
+        train_dataloader,
+        range(task_config.num_refits),
+        task_config.training_parallel,
+        models_path,
+        save_refits,
+        inference_backend=task_config.inference_backend,
+        ensemble=task_config.ensemble_training,
+    )
+    if task_config.quantize:
+        models = quantize_refits(
+            models,
+            range(task_config.num_refits),
+            baseline_dataloader,
+            models_path / f"quantization_qc_{task_config.model.num_latent}.tsv",
         )
-        if j == 0:
-            logger.debug(f"Model: {model}")
-
-        # Train/reload model
-        model_path = models_path / f"model_{task_config.model.num_latent}_{j}.pt"
-        if model_path.exists():
-            logger.debug(f"Re-loading refit {j + 1}/{task_config.num_refits}")
-            model.load_state_dict(torch.load(model_path))
-            model.to(device)
-        else:
-            logger.debug(f"Training refit {j + 1}/{task_config.num_refits}")
-            model.to(device)
-            hydra.utils.call(
-                task_config.training_loop,
-                model=model,
-                train_dataloader=train_dataloader,
-            )
-            # Save the refits, to use them later
-            if task_config.save_refits:
-                # pickle_protocol=4 is necessary for very big models
-                torch.save(model.state_dict(), model_path, pickle_protocol=4)
-        model.eval()
-
+    logger.debug(f"Model: {models[0]}")
+    refits: list[Refit] = []
+    for j, model in enumerate(models):
         # Calculate baseline reconstruction
         # For each model j, we get a different reconstruction for the baseline.
         # We haven't perturbed anything yet, we are just
         # getting the reconstruction for the baseline, to make sure that we get
         # the same reconstruction for each refit, we cannot
         # do it inside each process because the results might be different
-        reconstruction_path = (
-            models_path / f"baseline_recon_{task_config.model.num_latent}_{j}.pt"
+        reconstruction_path = get_baseline_recon_path(
+            models_path, task_config.model.num_latent, j, task_config.quantize
         )
-        if reconstruction_path.exists():
+        # The reconstruction of a newly trained refit is never reloaded
+        if is_reloaded[j] and reconstruction_path.exists():
             logger.debug(f"Loading baseline reconstruction from {reconstruction_path}.")
-            baseline_recon = torch.load(reconstruction_path)
+            baseline_recon = io.load_checkpoint(reconstruction_path).numpy()
         else:
             _, baseline_recon = model.reconstruct(baseline_dataloader)
+            is_changed = True
 
-            # # Save the baseline reconstruction for each model
-            # logger.debug(f"Saving baseline reconstruction {j}")
-            # torch.save(baseline_recon, reconstruction_path, pickle_protocol=4)
-            # logger.debug(f"Saved baseline reconstruction {j}")
+            # Save the baseline reconstruction for each saved model
+            if save_refits:
+                logger.debug(f"Saving baseline reconstruction {j}")
+                io.dump_checkpoint(
+                    reconstruction_path, torch.from_numpy(baseline_recon)
+                )
 
-        # Calculate perturb reconstruction => keep track of mean difference
-        for i in range(num_perturbed):
-            _, perturb_recon = model.reconstruct(dataloaders[i])
-            diff = perturb_recon - baseline_recon  # 2D: N x C
-            mean_diff[i, :, :] += diff * normalizer
+        refits.append(make_refit(model, baseline_recon, baseline_dataset))
 
     # Calculate Bayes factors
+    # Perturbations are processed in blocks: each refit reconstructs all the
+    # perturbations of a block in one forward pass
     logger.info("Identifying significant features")
+
+    # Stored results were computed with the refits (and baseline
+    # reconstructions) of a previous run, so they cannot be reused with new ones
+    if is_changed:
+        results_store.clear()
+
+    # Blocks already in the results store are skipped, and every new block is
+    # stored as soon as it is computed
     bayes_k = np.empty((num_perturbed, num_continuous))
-    bayes_mask = np.zeros(np.shape(bayes_k))
-    for i in range(num_perturbed):
-        mask = feature_mask[:, [i]] | nan_mask  # 2D: N x C
-        diff = np.ma.masked_array(mean_diff[i, :, :], mask=mask)  # 2D: N x C
-        prob = np.ma.compressed(np.mean(diff > 1e-8, axis=0))  # 1D: C
-        computed_bayes_k = np.log(prob + 1e-8) - np.log(1 - prob + 1e-8)
-        bayes_k[i, :] = computed_bayes_k
-        if task_config.target_value in CONTINUOUS_TARGET_VALUE:
-            bayes_mask[i, :] = (
-                baseline_dataloader.dataset.con_all[0, :]
-                - dataloaders[i].dataset.con_all[0, :]
-            )
+    bayes_mask = np.zeros(np.shape(bayes_k), dtype=bool)
+    is_continuous = task_config.target_value in CONTINUOUS_TARGET_VALUE
+    blocks = restore_bayes_k_blocks(
+        results_store, bayes_k, bayes_mask, task_config.perturbation_block_size
+    )
+    for feature_ids in blocks:
+        delta, columns = get_block_delta(
+            config, task_config, baseline_dataset, feature_ids
+        )
+        bayes_k[feature_ids, :], bayes_mask[feature_ids, :] = calculate_bayes_k_block(
+            refits,
+            delta,
+            baseline_dataset,
+            columns,
+            nan_mask,
+            feature_mask[:, feature_ids],
+            is_continuous,
+        )
+        store_bayes_k_block(
+            results_store,
+            feature_ids,
+            bayes_k[feature_ids, :],
+            bayes_mask[feature_ids, :],
+        )
 
-    bayes_mask[bayes_mask != 0] = 1
-    bayes_mask = np.array(bayes_mask, dtype=bool)
-
-    # Calculate Bayes probabilities
-    bayes_abs = np.abs(bayes_k)  # Dimensions are (num_perturbed, num_continuous)
-
-    bayes_p = np.exp(bayes_abs) / (1 + np.exp(bayes_abs))  # 2D: P x C
-
-    bayes_abs[bayes_mask] = np.min(
-        bayes_abs
-    )  # Bring feature_i feature_i associations to minimum
-    # Get only the significant associations:
-    # This will flatten the array, so we get all bayes_abs for all perturbed features
-    # vs all continuous features in one 1D array
-    # Then, we sort them, and get the indexes in the flattened array. So, we get an
-    # list of sorted indexes in the flatenned array
-    sort_ids = np.argsort(bayes_abs, axis=None)[::-1]  # 1D: P*C
-    logger.debug(f"sort_ids are {sort_ids}")
-    # bayes_p is the array from which elements will be taken.
-    # sort_ids contains the indices that determine the order in which elements should
-    # be taken from bayes_p.
-    # This operation essentially rearranges the elements of bayes_p based on the
-    # sorting order specified by sort_ids
-    # np.take considers the input array as if it were flattened when extracting
-    # elements using the provided indices.
-    # So, even though sort_ids is obtained from a flattened version of bayes_abs,
-    # np.take understands how to map these indices
-    # correctly to the original shape of bayes_p.
-    prob = np.take(bayes_p, sort_ids)  # 1D: P*C
-    logger.debug(f"Bayes proba range: [{prob[-1]:.3f} {prob[0]:.3f}]")
-
-    # Sort bayes_k in descending order, aligning with the sorted bayes_abs.
-    bayes_k = np.take(bayes_k, sort_ids)  # 1D: N x C
-
-    # Calculate FDR
-    fdr = np.cumsum(1 - prob) / np.arange(1, prob.size + 1)  # 1D
-    idx = np.argmin(np.abs(fdr - task_config.sig_threshold))
-    # idx will contain the index of the element in fdr that is closest
-    # to task_config.sig_threshold.
-    # This line essentially finds the index where the False Discovery Rate (fdr) is
-    # closest to the significance threshold
-    # (task_config.sig_threshold).
-    logger.debug(f"Index is {idx}")
-    logger.debug(f"FDR range: [{fdr[0]:.3f} {fdr[-1]:.3f}]")
-
-    # Return elements only up to idx. They will be the significant findings
-    # sort_ids[:idx]: Indices of features sorted by significance.
-    # prob[:idx]: Probabilities of significant associations for selected features.
-    # fdr[:idx]: False Discovery Rate values for selected features.
-    # bayes_k[:idx]: Bayes Factors indicating the strength of evidence for selected
-    # associations.
-    return sort_ids[:idx], prob[:idx], fdr[:idx], bayes_k[:idx]
+    if task_config.model.precision != "float32":
+        check_bayes_k_precision(
+            config, task_config, refits, baseline_dataset, nan_mask, feature_mask
+        )
+
+    # Rank associations by Bayes probability and keep the significant ones:
+    # those ranked before the FDR is closest to the significance threshold
+    # sort_ids: flat indices (P x C) of the significant associations
+    # prob: Bayes probabilities of the significant associations
+    # fdr: False Discovery Rate values of the significant associations
+    # bayes_k: Bayes Factors indicating the strength of evidence for the
+    # significant associations
+    return select_bayes_associations(bayes_k, bayes_mask, task_config.sig_threshold)
 
 
 def _ttest_approach(
+    config: MOVEConfig,
     task_config: IdentifyAssociationsTTestConfig,
     train_dataloader: DataLoader,
     baseline_dataloader: DataLoader,
-    dataloaders: list[DataLoader],
     models_path: Path,
     interim_path: Path,
     num_perturbed: int,
@@ -324,12 +376,10 @@ def _ttest_approach(
     num_continuous: int,
     nan_mask: BoolArray,
     feature_mask: BoolArray,
+    results_store: ResultsStore,
 ) -> tuple[Union[IntArray, FloatArray], ...]:
 
-    from scipy.stats import ttest_rel
-
     assert task_config.model is not None
-    device = torch.device("cuda" if task_config.model.cuda else "cpu")
 
     # Train models
     logger.info("Training models")
@@ -342,40 +392,49 @@ def _ttest_approach(
         )
     )
 
-    # Last appended dataloader is the baseline
     baseline_dataset = cast(MOVEDataset, baseline_dataloader.dataset)
+    block_size = task_config.perturbation_block_size
+    blocks = [
+        list(range(start, min(start + block_size, num_perturbed)))
+        for start in range(0, num_perturbed, block_size)
+    ]
 
     for k, num_latent in enumerate(task_config.num_latent):
+        # The p-values of each refit are stored as soon as they are computed.
+        # Refits found in the results store are skipped
+        pending_ids = []
         for j in range(task_config.num_refits):
+            result_key = f"refit_{num_latent}_{j}"
+            if result_key in results_store:
+                logger.debug(f"Skipping refit {j + 1}/{task_config.num_refits}")
+                pvalues[k, j, :, :] = results_store.load(result_key)["pvalues"]
+            else:
+                pending_ids.append(j)
 
-            # Initialize model
-            model: VAE = hydra.utils.instantiate(
-                task_config.model,
-                continuous_shapes=baseline_dataset.con_shapes,
-                categorical_shapes=baseline_dataset.cat_shapes,
-                num_latent=num_latent,
+        models = train_refits(
+            task_config.model,
+            task_config.training_loop,
+            train_dataloader,
+            pending_ids,
+            task_config.training_parallel,
+            models_path,
+            task_config.save_refits,
+            num_latent=num_latent,
+            inference_backend=task_config.inference_backend,
+            ensemble=task_config.ensemble_training,
+        )
+        if task_config.quantize:
+            models = quantize_refits(
+                models,
+                pending_ids,
+                baseline_dataloader,
+                models_path / f"quantization_qc_{num_latent}.tsv",
             )
+        for j, model in zip(pending_ids, models):
+            result_key = f"refit_{num_latent}_{j}"
             if j == 0:
                 logger.debug(f"Model: {model}")
 
-            # Train model
-            model_path = models_path / f"model_{num_latent}_{j}.pt"
-            if model_path.exists():
-                logger.debug(f"Re-loading refit {j + 1}/{task_config.num_refits}")
-                model.load_state_dict(torch.load(model_path))
-                model.to(device)
-            else:
-                logger.debug(f"Training refit {j + 1}/{task_config.num_refits}")
-                model.to(device)
-                hydra.utils.call(
-                    task_config.training_loop,
-                    model=model,
-                    train_dataloader=train_dataloader,
-                )
-                if task_config.save_refits:
-                    torch.save(model.state_dict(), model_path)
-            model.eval()
-
             # Get baseline reconstruction and baseline difference
             _, baseline_recon = model.reconstruct(baseline_dataloader)
             baseline_diff = np.empty((10, num_samples, num_continuous))
@@ -385,17 +444,23 @@ def _ttest_approach(
             baseline_diff = np.mean(baseline_diff, axis=0)  # 2D: N x C
             baseline_diff = np.where(nan_mask, np.nan, baseline_diff)
 
-            # T-test between baseline and perturb difference
-            for i in range(num_perturbed):
-                _, perturb_recon = model.reconstruct(dataloaders[i])
-                perturb_diff = perturb_recon - baseline_recon
-                mask = feature_mask[:, [i]] | nan_mask  # 2D: N x C
-                _, pvalues[k, j, i, :] = ttest_rel(
-                    a=np.where(mask, np.nan, perturb_diff),
-                    b=np.where(mask, np.nan, baseline_diff),
-                    axis=0,
-                    nan_policy="omit",
+            # T-test between baseline and perturb difference. The perturbations
+            # of a block of features are reconstructed in one forward pass
+            refit = make_refit(model, baseline_recon, baseline_dataset)
+            for feature_ids in blocks:
+                delta, columns = get_block_delta(
+                    config, task_config, baseline_dataset, feature_ids
                 )
+                perturb_recon = reconstruct_block(refit, delta, columns)
+                perturb_recon = perturb_recon.reshape(len(feature_ids), num_samples, -1)
+                pvalues[k, j, feature_ids, :] = calculate_ttest_pvalues_block(
+                    perturb_recon,
+                    baseline_recon,
+                    baseline_diff,
+                    nan_mask,
+                    feature_mask[:, feature_ids],
+                )
+            results_store.save(result_key, pvalues=pvalues[k, j, :, :])
 
     # Correct p-values (Bonferroni)
     pvalues = np.minimum(pvalues * num_continuous, 1.0)
@@ -429,6 +494,7 @@ def _ks_approach(
     num_continuous: int,
     con_names: list[list[str]],
     output_path: Path,
+    results_store: ResultsStore,
 ) -> tuple[Union[IntArray, FloatArray], ...]:
     """
     Find associations between continuous features using Kolmogorov-Smirnov distances.
@@ -457,6 +523,8 @@ def _ks_approach(
         con_names: list of lists where eah inner list
                    contains the feature names of a specific continuous dataset
         output_path: path where QC summary metrics will be saved.
+        results_store: store of the refits computed so far. Refits found in
+                       the store are skipped.
 
     Returns:
         sort_ids: list with flattened IDs of the associations
@@ -476,7 +544,6 @@ def _ks_approach(
     """
 
     assert task_config.model is not None
-    device = torch.device("cuda" if task_config.model.cuda else "cpu")
     figure_path = output_path / "figures"
     figure_path.mkdir(exist_ok=True, parents=True)
 
@@ -491,44 +558,50 @@ def _ks_approach(
         (num_samples, task_config.model.num_latent, len(dataloaders))
     )
 
-    # Last appended dataloader is the baseline
-    baseline_dataset = cast(MOVEDataset, baseline_dataloader.dataset)
-
     # Train models
     logger.info("Training models")
 
     target_dataset_idx = config.data.continuous_names.index(task_config.target_dataset)
     perturbed_names = con_names[target_dataset_idx]
 
-    for j in range(task_config.num_refits):  # Train num_refits models
-
-        # Initialize model
-        model: VAE = hydra.utils.instantiate(
-            task_config.model,
-            continuous_shapes=baseline_dataset.con_shapes,
-            categorical_shapes=baseline_dataset.cat_shapes,
+    # The scores of each refit are stored as soon as they are computed.
+    # Refits found in the results store are skipped
+    pending_ids = []
+    for j in range(task_config.num_refits):
+        result_key = f"refit_{j}"
+        if result_key in results_store:
+            logger.debug(f"Skipping refit {j + 1}/{task_config.num_refits}")
+            entry = results_store.load(result_key)
+            stats[j], stat_signs[j] = entry["stats"], entry["stat_signs"]
+            slope[j], rec_corr[j] = entry["slope"], entry["rec_corr"]
+            if j == 0:
+                latent_matrix[:] = results_store.load("latent")["latent_matrix"]
+        else:
+            pending_ids.append(j)
+
+    models = train_refits(
+        task_config.model,
+        task_config.training_loop,
+        train_dataloader,
+        pending_ids,
+        task_config.training_parallel,
+        models_path,
+        task_config.save_refits,
+        inference_backend=task_config.inference_backend,
+        ensemble=task_config.ensemble_training,
+    )
+    if task_config.quantize:
+        models = quantize_refits(
+            models,
+            pending_ids,
+            baseline_dataloader,
+            models_path / f"quantization_qc_{task_config.model.num_latent}.tsv",
         )
+    for j, model in zip(pending_ids, models):
+        result_key = f"refit_{j}"
         if j == 0:
             logger.debug(f"Model: {model}")
 
-        # Train/reload model
-        model_path = models_path / f"model_{task_config.model.num_latent}_{j}.pt"
-        if model_path.exists():
-            logger.debug(f"Re-loading refit {j + 1}/{task_config.num_refits}")
-            model.load_state_dict(torch.load(model_path))
-            model.to(device)
-        else:
-            logger.debug(f"Training refit {j + 1}/{task_config.num_refits}")
-            model.to(device)
-            hydra.utils.call(
-                task_config.training_loop,
-                model=model,
-                train_dataloader=train_dataloader,
-            )
-            if task_config.save_refits:
-                torch.save(model.state_dict(), model_path)
-        model.eval()
-
         # Calculate baseline reconstruction
         _, baseline_recon = model.reconstruct(baseline_dataloader)
         min_feat = np.zeros((num_perturbed, num_continuous))
@@ -541,24 +614,37 @@ def _ks_approach(
         # Correlation and slope for each feature's reconstruction
         feature_names = reduce(list.__add__, con_names)
 
-        for k in range(num_continuous):
-            x = baseline_dataloader.dataset.con_all.numpy()[:, k]  # baseline_recon[:,i]
-            y = baseline_recon[:, k]
-            x_pol, y_pol, (a2, a1, a) = get_2nd_order_polynomial(x, y)
-            slope[j, k] = a1
-            rec_corr[j, k] = pearsonr(x, y).statistic
+        baseline_con = baseline_dataloader.dataset.con_all.numpy()
+        coefficients, rec_corr[j] = calculate_reconstruction_qc(
+            baseline_con, baseline_recon
+        )
+        slope[j] = coefficients[:, 1]
 
+        for k in range(num_continuous):
             if (
                 feature_names[k] in task_config.perturbed_feature_names
                 or feature_names[k] in task_config.target_feature_names
             ):
+                x = baseline_con[:, k]
+                y = baseline_recon[:, k]
+                a2, a1, a = coefficients[k]
+                x_pol = np.linspace(np.min(x), np.max(x), 100)
+                y_pol = np.polyval(coefficients[k], x_pol)
 
                 # Plot correlations
-                fig = plot_correlations(x, y, x_pol, y_pol, a2, a1, a, k)
-                fig.savefig(
+                submit_figure(
                     figure_path
                     / f"Input_vs_reconstruction_correlation_feature_{k}_refit_{j}.png",
-                    dpi=50,
+                    plot_correlations,
+                    x,
+                    y,
+                    x_pol,
+                    y_pol,
+                    a2,
+                    a1,
+                    a,
+                    k,
+                    savefig_kwargs=dict(dpi=50),
                 )
 
         # Calculate perturbed reconstruction and shifts #############################
@@ -581,13 +667,13 @@ def _ks_approach(
                 latent_pert = model.project(dataloaders[i])
                 latent_matrix[:, :, i] = latent_pert
 
-            for k, targ_feat in enumerate(feature_names):
-                # Calculate ks factors: measure distance between baseline and perturbed
-                # reconstruction distributions per feature (k)
-                res = ks_2samp(perturb_recon[:, k], baseline_recon[:, k])
-                stats[j, i, k] = res.statistic
-                stat_signs[j, i, k] = res.statistic_sign
+            # Calculate ks factors: measure distance between baseline and perturbed
+            # reconstruction distributions of all features at once
+            stats[j, i], stat_signs[j, i] = calculate_ks_statistics(
+                perturb_recon, baseline_recon
+            )
 
+            for k, targ_feat in enumerate(feature_names):
                 if (
                     pert_feat in task_config.perturbed_feature_names
                     and targ_feat in task_config.target_feature_names
@@ -607,39 +693,51 @@ def _ks_approach(
                     )
 
                     # Cumulative distribution:
-                    fig = plot_cumulative_distributions(
+                    submit_figure(
+                        figure_path
+                        / (
+                            f"Cumulative_refit_{j}_perturbed_{i}_"
+                            f"measuring_{k}_stats_{stats[j, i, k]}.png"
+                        ),
+                        plot_cumulative_distributions,
                         edges,
                         hist_base,
                         hist_pert,
                         title=f"Cumulative_perturbed_{i}_measuring_"
                         f"{k}_stats_{stats[j, i, k]}",
                     )
-                    fig.savefig(
-                        figure_path
-                        / (
-                            f"Cumulative_refit_{j}_perturbed_{i}_"
-                            f"measuring_{k}_stats_{stats[j, i, k]}.png"
-                        )
-                    )
 
                     # Feature changes:
-                    fig = plot_reconstruction_movement(baseline_recon, perturb_recon, k)
-                    fig.savefig(
-                        figure_path / f"Changes_pert_{i}_on_feat_{k}_refit_{j}.png"
+                    # Only the plotted feature is sent to the renderer
+                    submit_figure(
+                        figure_path / f"Changes_pert_{i}_on_feat_{k}_refit_{j}.png",
+                        plot_reconstruction_movement,
+                        baseline_recon[:, [k]],
+                        perturb_recon[:, [k]],
+                        0,
                     )
 
+        if j == 0:
+            results_store.save("latent", latent_matrix=latent_matrix)
+        results_store.save(
+            result_key,
+            stats=stats[j],
+            stat_signs=stat_signs[j],
+            slope=slope[j],
+            rec_corr=rec_corr[j],
+        )
+
     # Save latent space matrix:
     np.save(output_path / "latent_location.npy", latent_matrix)
     np.save(output_path / "perturbed_features_list.npy", np.array(perturbed_names))
 
     # Creating a mask for self associations
     logger.debug("Creating self-association mask")
+    # Only the first sample of each perturbed dataset is needed
     for i in range(num_perturbed):
         if task_config.target_value in CONTINUOUS_TARGET_VALUE:
-            ks_mask[i, :] = (
-                baseline_dataloader.dataset.con_all[0, :]
-                - dataloaders[i].dataset.con_all[0, :]
-            )
+            _, perturbed_con = dataloaders[i].dataset[0]
+            ks_mask[i, :] = baseline_dataloader.dataset.con_all[0, :] - perturbed_con
     ks_mask[ks_mask != 0] = 1
     ks_mask = np.array(ks_mask, dtype=bool)
 
@@ -679,9 +777,9 @@ def save_results(
     sig_ids,
     extra_cols,
     extra_colnames,
-) -> None:
+) -> Optional[pd.DataFrame]:
     """
-    This function saves the obtained associations in a TSV file containing
+    This function saves the obtained associations in a table containing
     the following columns:
         feature_a_id
         feature_b_id
@@ -690,6 +788,10 @@ def save_results(
         feature_b_dataset
         proba/p_value: number quantifying the significance of the association
 
+    The table is written as TSV, Parquet or Feather, according to the
+    `results_format` of the task. In the columnar formats, the feature names
+    and datasets are dictionary-encoded.
+
     Args:
         config: main config
         con_shapes: tuple with the number of features per continuous dataset
@@ -701,6 +803,9 @@ def save_results(
         sig_ids: ids for the significat features
         extra_cols: extra data when calling the approach function
         extra_colnames: names for the extra data columns
+
+    Returns:
+        The table of associations, or None if there are no significant hits
     """
     logger.info(f"Significant hits found: {sig_ids.size}")
     task_config = cast(IdentifyAssociationsConfig, config.task)
@@ -708,46 +813,50 @@ def save_results(
 
     num_continuous = sum(con_shapes)  # C
 
-    if sig_ids.size > 0:
-        sig_ids = np.vstack((sig_ids // num_continuous, sig_ids % num_continuous)).T
-        logger.info("Writing results")
-        results = pd.DataFrame(sig_ids, columns=["feature_a_id", "feature_b_id"])
+    if sig_ids.size == 0:
+        return None
 
-        # Check if the task is for continuous or categorical data
-        if task_config.target_value in CONTINUOUS_TARGET_VALUE:
-            target_dataset_idx = config.data.continuous_names.index(
-                task_config.target_dataset
-            )
-            # This creates a DataFrame named a_df with one column
-            # named "feature_a_name". The values in this column are
-            # taken from con_names using the target_dataset_idx index.
-            a_df = pd.DataFrame(dict(feature_a_name=con_names[target_dataset_idx]))
-        else:
-            target_dataset_idx = config.data.categorical_names.index(
-                task_config.target_dataset
-            )
+    sig_ids = np.vstack((sig_ids // num_continuous, sig_ids % num_continuous)).T
+    logger.info("Writing results")
+    results = pd.DataFrame(sig_ids, columns=["feature_a_id", "feature_b_id"])
 
-            a_df = pd.DataFrame(dict(feature_a_name=cat_names[target_dataset_idx]))
-        a_df.index.name = "feature_a_id"
-        a_df.reset_index(inplace=True)
-        feature_names = reduce(list.__add__, con_names)
-        b_df = pd.DataFrame(dict(feature_b_name=feature_names))
-        b_df.index.name = "feature_b_id"
-        b_df.reset_index(inplace=True)
-        results = results.merge(a_df, on="feature_a_id", how="left").merge(
-            b_df, on="feature_b_id", how="left"
-        )
-        results["feature_b_dataset"] = pd.cut(
-            results["feature_b_id"],
-            bins=cast(list[int], np.cumsum([0] + con_shapes)),
-            right=False,
-            labels=config.data.continuous_names,
+    # Check if the task is for continuous or categorical data
+    if task_config.target_value in CONTINUOUS_TARGET_VALUE:
+        target_dataset_idx = config.data.continuous_names.index(
+            task_config.target_dataset
         )
-        for col, colname in zip(extra_cols, extra_colnames):
-            results[colname] = col
-        results.to_csv(
-            output_path / f"results_sig_assoc_{task_type}.tsv", sep="\t", index=False
+        a_names = con_names[target_dataset_idx]
+    else:
+        target_dataset_idx = config.data.categorical_names.index(
+            task_config.target_dataset
         )
+        a_names = cat_names[target_dataset_idx]
+    # Names are looked up by feature index
+    feature_names = reduce(list.__add__, con_names)
+    results["feature_a_name"] = np.take(
+        np.array(a_names, dtype=object), results["feature_a_id"]
+    )
+    results["feature_b_name"] = np.take(
+        np.array(feature_names, dtype=object), results["feature_b_id"]
+    )
+    results["feature_b_dataset"] = pd.cut(
+        results["feature_b_id"],
+        bins=cast(list[int], np.cumsum([0] + con_shapes)),
+        right=False,
+        labels=config.data.continuous_names,
+    )
+    for col, colname in zip(extra_cols, extra_colnames):
+        results[colname] = col
+
+    results_format = task_config.results_format
+    if results_format != "tsv":
+        # Repeated names are stored once, as dictionaries
+        for colname in ("feature_a_name", "feature_b_name"):
+            results[colname] = results[colname].astype("category")
+    io.dump_table(
+        output_path / f"results_sig_assoc_{task_type}.{results_format}", results
+    )
+    return results
 
 
 def identify_associations(config: MOVEConfig) -> None:
@@ -789,6 +898,7 @@ def identify_associations(config: MOVEConfig) -> None:
         cat_list,  # List of categorical datasets
         con_list,  # List of continuous datasets
         shuffle=True,
+        sparse=config.data.sparse_input,
         batch_size=task_config.batch_size,
         drop_last=True,
     )
@@ -811,6 +921,14 @@ def identify_associations(config: MOVEConfig) -> None:
     nan_mask = (orig_con == 0).numpy()  # NaN values encoded as 0s
     logger.debug(f"# NaN values: {np.sum(nan_mask)}/{orig_con.numel()}")
 
+    # Partial results are stored as they are computed, so that an interrupted
+    # run can be resumed
+    results_store = ResultsStore(
+        interim_path / "results_store" / task_type,
+        signature=_get_results_signature(config, baseline_dataset),
+        resume=task_config.resume,
+    )
+
     # Indentify associations between continuous features:
     logger.info(f"Perturbing dataset: '{task_config.target_dataset}'")
     if task_config.target_value in CONTINUOUS_TARGET_VALUE:
@@ -818,10 +936,17 @@ def identify_associations(config: MOVEConfig) -> None:
         logger.info(f"Perturbation type: {task_config.target_value}")
         output_subpath = Path(output_path) / "perturbation_visualization"
         output_subpath.mkdir(exist_ok=True, parents=True)
-        if not task_config.multiprocess:
+        if not task_config.multiprocess and task_type == "ks":
             dataloaders = prepare_for_continuous_perturbation(
                 config, output_subpath, baseline_dataloader
             )
+        else:
+            # Perturbations are computed in blocks (by the Bayes and t-test
+            # approaches or inside the workers), only the figure of the
+            # perturbations is made here
+            plot_perturbation_distribution(
+                config, task_config, baseline_dataset, output_subpath
+            )
         feature_mask = nan_mask
         con_dataset_names = config.data.continuous_names
         target_idx = con_dataset_names.index(
@@ -843,7 +968,7 @@ def identify_associations(config: MOVEConfig) -> None:
         target_value = one_hot_encode_single(target_mapping, task_config.target_value)
         feature_mask = np.all(target_dataset == target_value, axis=2)  # 2D: N x P
         feature_mask |= np.sum(target_dataset, axis=2) == 0
-        if not task_config.multiprocess:
+        if not task_config.multiprocess and task_type == "ks":
             dataloaders = prepare_for_categorical_perturbation(
                 config, interim_path, baseline_dataloader
             )
@@ -874,6 +999,7 @@ def identify_associations(config: MOVEConfig) -> None:
                 num_continuous=num_continuous,
                 nan_mask=nan_mask,
                 feature_mask=feature_mask,
+                results_store=results_store,
             )
             logger.debug(
                 "Completed bayes task (parallel function in main function "
@@ -885,13 +1011,14 @@ def identify_associations(config: MOVEConfig) -> None:
                 task_config,
                 train_dataloader=train_dataloader,
                 baseline_dataloader=baseline_dataloader,
-                dataloaders=dataloaders,
+                # perturbations are computed in blocks by the perturbation engine
                 models_path=models_path,
                 num_perturbed=num_perturbed,
                 num_samples=num_samples,
                 num_continuous=num_continuous,
                 nan_mask=nan_mask,
                 feature_mask=feature_mask,
+                results_store=results_store,
             )
 
         extra_colnames = ["proba", "fdr", "bayes_k"]
@@ -899,40 +1026,69 @@ def identify_associations(config: MOVEConfig) -> None:
     elif task_type == "ttest":
         task_config = cast(IdentifyAssociationsTTestConfig, task_config)
         if task_config.multiprocess:
-            raise NotImplementedError("Multiprocessing is not supported for T-test.")
-        sig_ids, *extra_cols = _ttest_approach(
-            task_config,
-            train_dataloader,
-            baseline_dataloader,
-            dataloaders,
-            models_path,
-            interim_path,
-            num_perturbed,
-            num_samples,
-            num_continuous,
-            nan_mask,
-            feature_mask,
-        )
+            sig_ids, *extra_cols = _ttest_approach_parallel(
+                config,
+                task_config,
+                train_dataloader,
+                baseline_dataloader,
+                models_path,
+                interim_path,
+                num_perturbed,
+                num_samples,
+                num_continuous,
+                nan_mask,
+                feature_mask,
+                results_store,
+            )
+        else:
+            sig_ids, *extra_cols = _ttest_approach(
+                config,
+                task_config,
+                train_dataloader,
+                baseline_dataloader,
+                models_path,
+                interim_path,
+                num_perturbed,
+                num_samples,
+                num_continuous,
+                nan_mask,
+                feature_mask,
+                results_store,
+            )
 
         extra_colnames = ["p_value"]
 
     elif task_type == "ks":
         task_config = cast(IdentifyAssociationsKSConfig, task_config)
         if task_config.multiprocess:
-            raise NotImplementedError("Multiprocessing is not supported for KS.")
-        sig_ids, *extra_cols = _ks_approach(
-            config,
-            task_config,
-            train_dataloader,
-            baseline_dataloader,
-            dataloaders,
-            models_path,
-            num_perturbed,
-            num_samples,
-            num_continuous,
-            con_names,
-            output_path,
-        )
+            sig_ids, *extra_cols = _ks_approach_parallel(
+                config,
+                task_config,
+                train_dataloader,
+                baseline_dataloader,
+                models_path,
+                num_perturbed,
+                num_samples,
+                num_continuous,
+                con_names,
+                output_path,
+                results_store,
+            )
+        else:
+            sig_ids, *extra_cols = _ks_approach(
+                config,
+                task_config,
+                train_dataloader,
+                baseline_dataloader,
+                dataloaders,
+                models_path,
+                num_perturbed,
+                num_samples,
+                num_continuous,
+                con_names,
+                output_path,
+                results_store,
+            )
 
         extra_colnames = ["ks_distance"]
 
@@ -940,7 +1096,7 @@ def identify_associations(config: MOVEConfig) -> None:
         raise ValueError()
 
     # RESULTS ################################
-    save_results(
+    association_df = save_results(
         config,
         con_shapes,
         cat_names,
@@ -951,9 +1107,13 @@ def identify_associations(config: MOVEConfig) -> None:
         extra_colnames,
     )
 
-    if exists(output_path / f"results_sig_assoc_{task_type}.tsv"):
-        association_df = pd.read_csv(
-            output_path / f"results_sig_assoc_{task_type}.tsv", sep="\t"
-        )
-        _ = plot_feature_association_graph(association_df, output_path)
-        _ = plot_feature_association_graph(association_df, output_path, layout="spring")
+    # Plots are made from the table in memory, instead of reading it back
+    if association_df is not None:
+        for layout in ("circular", "spring"):
+            submit_figure(
+                None,
+                plot_feature_association_graph,
+                association_df,
+                output_path,
+                layout=layout,
+            )
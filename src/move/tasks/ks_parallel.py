@@ -0,0 +1,418 @@
+from functools import reduce
+from itertools import chain
+from pathlib import Path
+from typing import Any, Optional, Union, cast
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+
+from move.analysis.metrics import (
+    calculate_ks_statistics,
+    calculate_reconstruction_qc,
+)
+from move.conf.schema import IdentifyAssociationsKSConfig, MOVEConfig
+from move.core.logging import get_logger
+from move.core.parallel import get_pool_layout, make_pool
+from move.core.typing import FloatArray, IntArray
+from move.data.dataloaders import MOVEDataset
+from move.models.vae import VAE
+from move.tasks.perturbation_engine import (
+    Refit,
+    get_block_delta,
+    get_self_association_mask,
+    make_refit,
+    project_block,
+    reconstruct_block,
+)
+from move.tasks.refit_training import quantize_refits, train_refits
+from move.tasks.results_store import ResultsStore
+from move.visualization.dataset_distributions import (
+    plot_correlations,
+    plot_cumulative_distributions,
+    plot_reconstruction_movement,
+)
+from move.visualization.rendering import submit_figure
+
+# Possible values for continuous pertrubation
+CONTINUOUS_TARGET_VALUE = ["minimum", "maximum", "plus_std", "minus_std"]
+
+# Model, baseline reconstruction and first-layer pre-activations of a refit, as
+# passed to the pool
+SharedRefit = tuple[VAE, torch.Tensor, torch.Tensor]
+
+logger = get_logger(__name__)
+
+
+# State shared with the pool processes. The baseline dataset and refits (with
+# their baseline reconstructions) live in shared memory and are handed to each
+# process once by the initializer, so tasks only carry the indices of a refit
+# and of a block of perturbed features.
+_worker_state: dict[str, Any] = {}
+
+
+def _init_ks_worker(
+    config: MOVEConfig,
+    task_config: IdentifyAssociationsKSConfig,
+    baseline_dataset: MOVEDataset,
+    refits: dict[int, SharedRefit],
+    perturbed_names: list[str],
+    feature_names: list[str],
+    figure_path: Path,
+) -> None:
+    """
+    Pool initializer. Stores references to the shared tensors in the worker
+    process. NumPy views are created over the shared buffers, no data is copied.
+    """
+    _worker_state.clear()
+    _worker_state["config"] = config
+    _worker_state["task_config"] = task_config
+    _worker_state["baseline_dataset"] = baseline_dataset
+    _worker_state["refits"] = {
+        j: Refit(model, baseline_recon.numpy(), baseline_preactivation)
+        for j, (model, baseline_recon, baseline_preactivation) in refits.items()
+    }
+    _worker_state["perturbed_names"] = perturbed_names
+    _worker_state["feature_names"] = feature_names
+    _worker_state["figure_path"] = figure_path
+
+
+def _ks_approach_worker(task: tuple[int, list[int]]):
+    """
+    Worker function to calculate the KS scores of a block of perturbed features,
+    for one refit. The latent representation of the perturbed samples is also
+    returned for the first refit.
+    """
+    j, feature_ids = task
+    logger.debug(f"Inside the worker function for refit {j}, {feature_ids}")
+
+    config: MOVEConfig = _worker_state["config"]
+    task_config: IdentifyAssociationsKSConfig = _worker_state["task_config"]
+    baseline_dataset: MOVEDataset = _worker_state["baseline_dataset"]
+    perturbed_names: list[str] = _worker_state["perturbed_names"]
+    feature_names: list[str] = _worker_state["feature_names"]
+    figure_path: Path = _worker_state["figure_path"]
+    refit: Refit = _worker_state["refits"][j]
+    baseline_recon = refit.baseline_recon
+
+    # Reconstruct the perturbations of all features in the block at once
+    delta, columns = get_block_delta(
+        config, task_config, baseline_dataset, feature_ids
+    )
+    num_samples = baseline_dataset.num_samples
+    perturb_recons = reconstruct_block(refit, delta, columns)
+    perturb_recons = perturb_recons.reshape(len(feature_ids), num_samples, -1)
+
+    # Save latent representation for perturbed samples
+    latent: Optional[FloatArray] = None
+    if j == 0:
+        latent = project_block(
+            refit.model, refit.baseline_preactivation, delta, columns
+        )
+
+    min_baseline = np.min(baseline_recon, axis=0)
+    max_baseline = np.max(baseline_recon, axis=0)
+    stats = np.empty((len(feature_ids), len(feature_names)))
+    stat_signs = np.empty_like(stats)
+    for b, i in enumerate(feature_ids):
+        pert_feat = perturbed_names[i]
+        perturb_recon = perturb_recons[b]
+        min_feat = np.min([min_baseline, np.min(perturb_recon, axis=0)], axis=0)
+        max_feat = np.max([max_baseline, np.max(perturb_recon, axis=0)], axis=0)
+
+        # Calculate ks factors: measure distance between baseline and perturbed
+        # reconstruction distributions of all features at once
+        stats[b], stat_signs[b] = calculate_ks_statistics(
+            perturb_recon, baseline_recon
+        )
+
+        for k, targ_feat in enumerate(feature_names):
+            if (
+                pert_feat in task_config.perturbed_feature_names
+                and targ_feat in task_config.target_feature_names
+            ):
+
+                # Plotting preliminary results:
+                n_bins = 50
+                hist_base, edges = np.histogram(
+                    baseline_recon[:, k],
+                    bins=np.linspace(min_feat[k], max_feat[k], n_bins),
+                    density=True,
+                )
+                hist_pert, edges = np.histogram(
+                    perturb_recon[:, k],
+                    bins=np.linspace(min_feat[k], max_feat[k], n_bins),
+                    density=True,
+                )
+
+                # Cumulative distribution:
+                submit_figure(
+                    figure_path
+                    / (
+                        f"Cumulative_refit_{j}_perturbed_{i}_"
+                        f"measuring_{k}_stats_{stats[b, k]}.png"
+                    ),
+                    plot_cumulative_distributions,
+                    edges,
+                    hist_base,
+                    hist_pert,
+                    title=f"Cumulative_perturbed_{i}_measuring_"
+                    f"{k}_stats_{stats[b, k]}",
+                )
+
+                # Feature changes:
+                # Only the plotted feature is sent to the renderer
+                submit_figure(
+                    figure_path / f"Changes_pert_{i}_on_feat_{k}_refit_{j}.png",
+                    plot_reconstruction_movement,
+                    baseline_recon[:, [k]],
+                    perturb_recon[:, [k]],
+                    0,
+                )
+    logger.debug(f"KS scores calculated for refit {j}, {feature_ids}")
+
+    return j, feature_ids, stats, stat_signs, latent
+
+
+def _ks_approach_parallel(
+    config: MOVEConfig,
+    task_config: IdentifyAssociationsKSConfig,
+    train_dataloader: DataLoader,
+    baseline_dataloader: DataLoader,
+    models_path: Path,
+    num_perturbed: int,
+    num_samples: int,
+    num_continuous: int,
+    con_names: list[list[str]],
+    output_path: Path,
+    results_store: ResultsStore,
+) -> tuple[Union[IntArray, FloatArray], ...]:
+    """
+    Find associations between continuous features using Kolmogorov-Smirnov
+    distances, computing the refit x perturbed feature grid in parallel. See
+    `_ks_approach` for a description of the method and its outputs.
+
+    Refits are trained or reloaded first, and the quality control of their
+    reconstructions is done in the main process. Refits are then placed in
+    shared memory and passed to the pool once. Each task is a block of
+    perturbed features of one refit.
+
+    The scores of a refit are saved in the results store once all its blocks
+    complete, and refits found in the store are skipped.
+    """
+    assert task_config.model is not None
+    figure_path = output_path / "figures"
+    figure_path.mkdir(exist_ok=True, parents=True)
+
+    # Data containers
+    stats = np.empty((task_config.num_refits, num_perturbed, num_continuous))
+    stat_signs = np.empty_like(stats)
+    rec_corr, slope = np.empty((task_config.num_refits, num_continuous)), np.empty(
+        (task_config.num_refits, num_continuous)
+    )
+    latent_matrix = np.empty(
+        (num_samples, task_config.model.num_latent, num_perturbed + 1)
+    )
+
+    baseline_dataset = cast(MOVEDataset, baseline_dataloader.dataset)
+    assert baseline_dataset.con_all is not None
+
+    # Train models
+    logger.info("Training models")
+
+    target_dataset_idx = config.data.continuous_names.index(task_config.target_dataset)
+    perturbed_names = con_names[target_dataset_idx]
+    feature_names = reduce(list.__add__, con_names)
+
+    # Refits found in the results store are skipped
+    pending_ids = []
+    for j in range(task_config.num_refits):
+        result_key = f"refit_{j}"
+        if result_key in results_store:
+            logger.debug(f"Skipping refit {j + 1}/{task_config.num_refits}")
+            entry = results_store.load(result_key)
+            stats[j], stat_signs[j] = entry["stats"], entry["stat_signs"]
+            slope[j], rec_corr[j] = entry["slope"], entry["rec_corr"]
+            if j == 0:
+                latent_matrix[:] = results_store.load("latent")["latent_matrix"]
+        else:
+            pending_ids.append(j)
+
+    models = train_refits(
+        task_config.model,
+        task_config.training_loop,
+        train_dataloader,
+        pending_ids,
+        task_config.training_parallel,
+        models_path,
+        task_config.save_refits,
+        inference_backend=task_config.inference_backend,
+        ensemble=task_config.ensemble_training,
+    )
+    if task_config.quantize:
+        models = quantize_refits(
+            models,
+            pending_ids,
+            baseline_dataloader,
+            models_path / f"quantization_qc_{task_config.model.num_latent}.tsv",
+        )
+    refits: dict[int, SharedRefit] = {}
+    for j, model in zip(pending_ids, models):
+        if j == 0:
+            logger.debug(f"Model: {model}")
+
+        # Calculate baseline reconstruction
+        _, baseline_recon = model.reconstruct(baseline_dataloader)
+
+        # QC of feature's reconstruction ##############################
+        logger.debug("Calculating quality control of the feature reconstructions")
+        # Correlation and slope for each feature's reconstruction
+        baseline_con = baseline_dataset.con_all.numpy()
+        coefficients, rec_corr[j] = calculate_reconstruction_qc(
+            baseline_con, baseline_recon
+        )
+        slope[j] = coefficients[:, 1]
+
+        for k in range(num_continuous):
+            if (
+                feature_names[k] in task_config.perturbed_feature_names
+                or feature_names[k] in task_config.target_feature_names
+            ):
+                x = baseline_con[:, k]
+                y = baseline_recon[:, k]
+                a2, a1, a = coefficients[k]
+                x_pol = np.linspace(np.min(x), np.max(x), 100)
+                y_pol = np.polyval(coefficients[k], x_pol)
+
+                # Plot correlations
+                submit_figure(
+                    figure_path
+                    / f"Input_vs_reconstruction_correlation_feature_{k}_refit_{j}.png",
+                    plot_correlations,
+                    x,
+                    y,
+                    x_pol,
+                    y_pol,
+                    a2,
+                    a1,
+                    a,
+                    k,
+                    savefig_kwargs=dict(dpi=50),
+                )
+
+        # Save original latent space for first refit:
+        if j == 0:
+            latent_matrix[:, :, -1] = model.project(baseline_dataloader)
+
+        # Weights, reconstruction and first-layer pre-activations are moved to
+        # shared memory
+        refit = make_refit(model, baseline_recon, baseline_dataset)
+        model.share_memory()
+        refits[j] = (
+            model,
+            torch.from_numpy(baseline_recon).share_memory_(),
+            refit.baseline_preactivation.share_memory_(),
+        )
+
+    # Each task is a block of perturbed features of one refit
+    block_size = task_config.perturbation_block_size
+    blocks = [
+        list(range(start, min(start + block_size, num_perturbed)))
+        for start in range(0, num_perturbed, block_size)
+    ]
+    tasks = [(j, feature_ids) for j in refits for feature_ids in blocks]
+    num_pending_blocks = {j: len(blocks) for j in refits}
+
+    if len(tasks) > 0:
+        logger.info("Computing KS scores")
+        baseline_dataset.share_memory_()
+        initargs = (
+            config,
+            task_config,
+            baseline_dataset,
+            refits,
+            perturbed_names,
+            feature_names,
+            figure_path,
+        )
+        timed_results: list[Any] = []
+        layout = get_pool_layout(
+            task_config.parallel,
+            _ks_approach_worker,
+            tasks,
+            _init_ks_worker,
+            initargs,
+            timed_results,
+        )
+        with make_pool(layout, _init_ks_worker, initargs) as pool:
+            # Tasks timed to pick the layout are not computed again
+            results = chain(
+                timed_results,
+                pool.imap_unordered(
+                    _ks_approach_worker,
+                    tasks[len(timed_results) :],
+                    chunksize=task_config.parallel.chunksize,
+                ),
+            )
+            # Place each block at its indices, and store a refit once all of its
+            # blocks are done
+            for j, feature_ids, block_stats, block_signs, latent in results:
+                stats[j, feature_ids, :] = block_stats
+                stat_signs[j, feature_ids, :] = block_signs
+                if latent is not None:
+                    latent_matrix[:, :, feature_ids] = latent.transpose(1, 2, 0)
+                num_pending_blocks[j] -= 1
+                if num_pending_blocks[j] == 0:
+                    if j == 0:
+                        results_store.save("latent", latent_matrix=latent_matrix)
+                    results_store.save(
+                        f"refit_{j}",
+                        stats=stats[j],
+                        stat_signs=stat_signs[j],
+                        slope=slope[j],
+                        rec_corr=rec_corr[j],
+                    )
+        logger.info("Pool multiprocess completed")
+
+    # Save latent space matrix:
+    np.save(output_path / "latent_location.npy", latent_matrix)
+    np.save(output_path / "perturbed_features_list.npy", np.array(perturbed_names))
+
+    # Creating a mask for self associations
+    logger.debug("Creating self-association mask")
+    ks_mask = np.zeros((num_perturbed, num_continuous), dtype=bool)
+    if task_config.target_value in CONTINUOUS_TARGET_VALUE:
+        for feature_ids in blocks:
+            delta, columns = get_block_delta(
+                config, task_config, baseline_dataset, feature_ids
+            )
+            ks_mask[feature_ids, :] = get_self_association_mask(
+                baseline_dataset, delta, columns
+            )
+
+    # Take the median of KS values (with sign) over refits.
+    final_stats = np.nanmedian(stats * stat_signs, axis=0)
+    final_stats[ks_mask] = (
+        0.0  # Zero all masked values, placing them at end of the ranking
+    )
+
+    # KS-threshold:
+    ks_thr = np.sqrt(-np.log(task_config.sig_threshold / 2) * 1 / (num_samples))
+    logger.info(f"Suggested absolute KS threshold is: {ks_thr}")
+
+    # Sort associations by absolute KS value
+    sort_ids = np.argsort(abs(final_stats), axis=None)[::-1]  # 1D: N x C
+    ks_distance = np.take(final_stats, sort_ids)  # 1D: N x C
+
+    # Writing Quality control csv file.
+    # Mean slope and correlation over refits as qc metrics.
+    logger.info("Writing QC file")
+    qc_df = pd.DataFrame({"Feature names": feature_names})
+    qc_df["slope"] = np.nanmean(slope, axis=0)
+    qc_df["reconstruction_correlation"] = np.nanmean(rec_corr, axis=0)
+    qc_df.to_csv(output_path / "QC_summary_KS.tsv", sep="\t", index=False)
+
+    # Return first idx associations: redefined for reasonable threshold
+
+    return sort_ids[abs(ks_distance) >= ks_thr], ks_distance[abs(ks_distance) >= ks_thr]
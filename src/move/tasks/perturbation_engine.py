@@ -0,0 +1,691 @@
+__all__ = [
+    "Refit",
+    "calculate_bayes_k_block",
+    "calculate_ttest_pvalues_block",
+    "check_bayes_k_precision",
+    "get_bayes_models_path",
+    "get_block_delta",
+    "get_model_input",
+    "get_perturbed_columns",
+    "get_self_association_mask",
+    "make_refit",
+    "plot_perturbation_distribution",
+    "project_block",
+    "project_perturbed_block",
+    "reconstruct_block",
+    "restore_bayes_k_blocks",
+    "select_bayes_associations",
+    "store_bayes_k_block",
+]
+
+from pathlib import Path
+from typing import NamedTuple, cast
+
+import numpy as np
+import torch
+from scipy.special import stdtr  # type: ignore
+
+from move.conf.schema import IdentifyAssociationsConfig, MOVEConfig
+from move.core.logging import get_logger
+from move.core.typing import BoolArray, FloatArray, IntArray
+from move.data import io
+from move.data.dataloaders import MOVEDataset
+from move.data.perturbations import (
+    ContinuousPerturbationType,
+    perturb_categorical_data_block,
+    perturb_continuous_data_block,
+)
+from move.data.preprocessing import one_hot_encode_single
+from move.models.vae import VAE
+from move.tasks.results_store import ResultsStore
+from move.visualization.dataset_distributions import plot_value_distributions
+from move.visualization.rendering import submit_figure
+
+# Possible values for continuous pertrubation
+CONTINUOUS_TARGET_VALUE = ["minimum", "maximum", "plus_std", "minus_std"]
+
+logger = get_logger(__name__)
+
+
+def _get_num_categorical_inputs(dataset: MOVEDataset) -> int:
+    """Return the number of model input columns of the categorical data."""
+    return sum(int(np.prod(shape)) for shape in dataset.cat_shapes or [])
+
+
+def get_block_delta(
+    config: MOVEConfig,
+    task_config: IdentifyAssociationsConfig,
+    baseline_dataset: MOVEDataset,
+    feature_ids: list[int],
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Compute how the perturbation of each feature in a block changes the model
+    input. Only the perturbed columns are taken from the baseline data, the
+    perturbed copies of the dataset are never built.
+
+    Args:
+        config: main configuration
+        task_config: configuration of the identify associations task
+        baseline_dataset: reference dataset that will be perturbed
+        feature_ids: indices of the perturbed features (in the target dataset)
+
+    Returns:
+        Change of the perturbed columns (3D: K x N x D), and the model input
+        columns changed by each perturbation (2D: K x D). The k-th entry
+        corresponds to perturbing `feature_ids[k]`.
+    """
+    if task_config.target_value in CONTINUOUS_TARGET_VALUE:
+        assert baseline_dataset.con_all is not None
+        target_idx = config.data.continuous_names.index(task_config.target_dataset)
+        perturbed_columns = perturb_continuous_data_block(
+            baseline_dataset,
+            config.data.continuous_names,
+            task_config.target_dataset,
+            cast(ContinuousPerturbationType, task_config.target_value),
+            feature_ids,
+        )
+        columns = get_perturbed_columns(
+            baseline_dataset, target_idx, True, feature_ids
+        )
+        # Continuous data follows the categorical data in the model input
+        con_columns = columns - _get_num_categorical_inputs(baseline_dataset)
+        baseline_columns = baseline_dataset.con_all[:, con_columns[:, 0]].T
+        delta = perturbed_columns - baseline_columns  # 2D: K x N
+        return delta[:, :, None], columns
+    assert baseline_dataset.cat_all is not None
+    interim_path = Path(config.data.interim_data_path)
+    mappings = io.load_mappings(interim_path / "mappings.json")
+    target_mapping = mappings[task_config.target_dataset]
+    target_value = one_hot_encode_single(target_mapping, task_config.target_value)
+    target_idx = config.data.categorical_names.index(task_config.target_dataset)
+    perturbed_columns = perturb_categorical_data_block(
+        baseline_dataset,
+        config.data.categorical_names,
+        task_config.target_dataset,
+        target_value,
+        feature_ids,
+    )
+    columns = get_perturbed_columns(baseline_dataset, target_idx, False, feature_ids)
+    baseline_columns = baseline_dataset.cat_all[:, columns].transpose(0, 1)
+    return perturbed_columns - baseline_columns, columns  # 3D: K x N x D
+
+
+def get_self_association_mask(
+    baseline_dataset: MOVEDataset, delta: torch.Tensor, columns: torch.Tensor
+) -> BoolArray:
+    """
+    Mask the association of each perturbed continuous feature with itself,
+    when its perturbation changes the first sample.
+
+    Args:
+        baseline_dataset: reference (non-perturbed) dataset
+        delta: change of the perturbed columns (3D: K x N x 1), as returned by
+            `get_block_delta`
+        columns: indices of the perturbed columns (2D: K x 1)
+
+    Returns:
+        Mask of self-associations (2D: K x C)
+    """
+    assert baseline_dataset.con_shapes is not None
+    num_block = columns.shape[0]
+    mask = np.zeros((num_block, sum(baseline_dataset.con_shapes)), dtype=bool)
+    con_columns = columns[:, 0] - _get_num_categorical_inputs(baseline_dataset)
+    mask[np.arange(num_block), con_columns.numpy()] = (delta[:, 0, 0] != 0).numpy()
+    return mask
+
+
+def plot_perturbation_distribution(
+    config: MOVEConfig,
+    task_config: IdentifyAssociationsConfig,
+    baseline_dataset: MOVEDataset,
+    output_subpath: Path,
+) -> None:
+    """
+    Plot the values of all perturbed continuous features, collapsed in one plot.
+    This is the figure saved by `perturb_continuous_data_extended`, for the code
+    paths that build the perturbations in blocks.
+
+    Args:
+        config: main configuration
+        task_config: configuration of the identify associations task
+        baseline_dataset: reference dataset that will be perturbed
+        output_subpath: path where the figure will be saved
+    """
+    assert baseline_dataset.con_shapes is not None
+    target_idx = config.data.continuous_names.index(task_config.target_dataset)
+    num_perturbed = baseline_dataset.con_shapes[target_idx]
+    # Only the perturbed column of each feature is plotted, so the perturbed
+    # values of all features are computed at once from the baseline columns
+    perturbations = perturb_continuous_data_block(
+        baseline_dataset,
+        config.data.continuous_names,
+        task_config.target_dataset,
+        cast(ContinuousPerturbationType, task_config.target_value),
+        list(range(num_perturbed)),
+    )
+    perturbations = perturbations.T.numpy()  # 2D: N x P
+
+    fig_path = (
+        output_subpath / f"perturbation_distribution_{task_config.target_dataset}.png"
+    )
+    submit_figure(fig_path, plot_value_distributions, perturbations)
+
+
+class Refit(NamedTuple):
+    """A trained model (in evaluation mode), its reconstruction of the baseline
+    continuous data, and its first-layer pre-activations of the baseline data."""
+
+    model: VAE
+    baseline_recon: FloatArray
+    baseline_preactivation: torch.Tensor
+
+
+def get_model_input(model: VAE, dataset: MOVEDataset) -> torch.Tensor:
+    """Return all the samples of a dataset as a single model input (categorical
+    and continuous data concatenated)."""
+    cat = torch.empty(0) if dataset.cat_all is None else dataset.cat_all
+    con = torch.empty(0) if dataset.con_all is None else dataset.con_all
+    return model._validate_batch((cat, con))
+
+
+@torch.no_grad()
+def make_refit(
+    model: VAE, baseline_recon: FloatArray, baseline_dataset: MOVEDataset
+) -> Refit:
+    """Cache the first-layer pre-activations of the baseline data for a model."""
+    baseline_input = get_model_input(model, baseline_dataset)
+    return Refit(model, baseline_recon, model.preactivate(baseline_input))
+
+
+def get_perturbed_columns(
+    baseline_dataset: MOVEDataset,
+    target_idx: int,
+    is_continuous: bool,
+    feature_ids: list[int],
+) -> torch.Tensor:
+    """
+    Find the model input columns that change when perturbing each feature: the
+    column of a continuous feature, or the one-hot columns of a categorical
+    feature. Categorical data precedes continuous data in the model input.
+
+    Args:
+        baseline_dataset: reference dataset
+        target_idx: index of the perturbed dataset (among the categorical or
+            continuous datasets)
+        is_continuous: whether the perturbed dataset is continuous
+        feature_ids: indices of the perturbed features (in the target dataset)
+
+    Returns:
+        Column indices (2D: K x D)
+    """
+    cat_sizes = [int(np.prod(shape)) for shape in baseline_dataset.cat_shapes or []]
+    feature_ids_ = torch.tensor(feature_ids)[:, None]
+    if is_continuous:
+        assert baseline_dataset.con_shapes is not None
+        offset = sum(cat_sizes) + sum(baseline_dataset.con_shapes[:target_idx])
+        return offset + feature_ids_
+    assert baseline_dataset.cat_shapes is not None
+    offset = sum(cat_sizes[:target_idx])
+    num_classes = baseline_dataset.cat_shapes[target_idx][1]
+    return offset + feature_ids_ * num_classes + torch.arange(num_classes)
+
+
+@torch.no_grad()
+def reconstruct_block(
+    refit: Refit, delta: torch.Tensor, columns: torch.Tensor
+) -> FloatArray:
+    """
+    Reconstruct the continuous data of a block of perturbations in a single
+    forward pass. Only the change of the perturbed columns goes through the
+    first encoder layer, the rest is taken from the cached baseline
+    pre-activations.
+
+    Args:
+        refit: model and its baseline pre-activations
+        delta: change of the perturbed columns (3D: K x N x D)
+        columns: indices of the perturbed columns (2D: K x D)
+
+    Returns:
+        Continuous reconstruction (2D: KN x C)
+    """
+    model = refit.model
+    with model.autocast():
+        preactivation = model.update_preactivation(
+            refit.baseline_preactivation, delta.to(model.device), columns
+        )
+        mu, logvar = model.encode_preactivation(preactivation.flatten(0, 1))
+        _, con_recon = model.decode(model.reparameterize(mu, logvar))
+    assert con_recon is not None
+    return con_recon.float().cpu().numpy()
+
+
+@torch.no_grad()
+def project_perturbed_block(
+    model: VAE,
+    baseline_input: torch.Tensor,
+    baseline_preactivation: torch.Tensor,
+    columns: torch.Tensor,
+    value: torch.Tensor,
+) -> FloatArray:
+    """
+    Project K perturbations of the baseline data into the latent space. Each
+    perturbation sets some columns of the model input to a fixed value. Only
+    the change of those columns goes through the first encoder layer.
+
+    Args:
+        model: model in evaluation mode
+        baseline_input: model input of the baseline data (2D: N x I)
+        baseline_preactivation: first-layer pre-activations of the baseline
+            data (2D: N x H)
+        columns: indices of the perturbed columns (2D: K x D)
+        value: new value of the perturbed columns (broadcastable to D)
+
+    Returns:
+        Mean latent vectors (3D: K x N x L)
+    """
+    baseline_columns = baseline_input[:, columns].transpose(0, 1)  # 3D: K x N x D
+    delta = value.to(baseline_columns) - baseline_columns
+    return project_block(model, baseline_preactivation, delta, columns)
+
+
+@torch.no_grad()
+def project_block(
+    model: VAE,
+    baseline_preactivation: torch.Tensor,
+    delta: torch.Tensor,
+    columns: torch.Tensor,
+) -> FloatArray:
+    """
+    Project a block of K perturbations of the baseline data into the latent
+    space, from the change of their perturbed columns.
+
+    Args:
+        model: model in evaluation mode
+        baseline_preactivation: first-layer pre-activations of the baseline
+            data (2D: N x H)
+        delta: change of the perturbed columns (3D: K x N x D)
+        columns: indices of the perturbed columns (2D: K x D)
+
+    Returns:
+        Mean latent vectors (3D: K x N x L)
+    """
+    num_block, num_samples, _ = delta.shape
+    with model.autocast():
+        preactivation = model.update_preactivation(
+            baseline_preactivation, delta.to(model.device), columns
+        )
+        mu, _ = model.encode_preactivation(preactivation.flatten(0, 1))
+    return mu.float().view(num_block, num_samples, -1).cpu().numpy()
+
+
+def calculate_bayes_k_block(
+    refits: list[Refit],
+    delta: torch.Tensor,
+    baseline_dataset: MOVEDataset,
+    columns: torch.Tensor,
+    nan_mask: BoolArray,
+    feature_mask: BoolArray,
+    is_continuous: bool,
+) -> tuple[FloatArray, BoolArray]:
+    """
+    Calculate the Bayes factors of a block of K perturbed features. Each refit
+    reconstructs all perturbations of the block in one forward pass (K x N
+    rows).
+
+    Args:
+        refits: list of models (in evaluation mode) with their baseline
+            reconstructions and pre-activations
+        delta: change of the perturbed columns (3D: K x N x D), as returned
+            by `get_block_delta`
+        baseline_dataset: reference (non-perturbed) dataset
+        columns: model input columns changed by each perturbation, as
+            returned by `get_perturbed_columns` (2D: K x D)
+        nan_mask: mask for NaNs (2D: N x C)
+        feature_mask: mask for the perturbed features of the block (2D: N x K)
+        is_continuous: whether the perturbed features are continuous
+
+    Returns:
+        Bayes factors (2D: K x C) and the mask of self-associations (2D: K x C)
+    """
+    num_block, num_samples, _ = delta.shape
+
+    # mean_diff contains the differences between the baseline and the perturbed
+    # reconstruction for each feature in the block, averaged over refits (all
+    # refits have the same importance). It is accumulated refit by refit, in
+    # place, so the block needs a single K x N x C array besides the
+    # reconstruction of the current refit
+    mean_diff = None
+    normalizer = 1 / len(refits)
+    for refit in refits:
+        diff = reconstruct_block(refit, delta, columns)
+        diff = diff.reshape(num_block, num_samples, -1)
+        np.subtract(diff, refit.baseline_recon, out=diff)  # 3D: K x N x C
+        np.multiply(diff, normalizer, out=diff)
+        if mean_diff is None:
+            mean_diff = np.zeros(diff.shape)
+        mean_diff += diff
+        del diff
+    assert mean_diff is not None
+
+    # Apply masks, and calculate the probability of a positive difference. The
+    # masks are applied in place, and the number of unmasked samples is counted
+    # from the 2D masks
+    is_positive = mean_diff > 1e-8  # 3D: K x N x C
+    del mean_diff
+    is_positive &= ~nan_mask
+    is_positive &= ~feature_mask.T[:, :, np.newaxis]
+    num_unmasked = (~feature_mask).T.astype(np.int64) @ (~nan_mask).astype(np.int64)
+    prob = np.sum(is_positive, axis=1) / num_unmasked  # 2D: K x C
+
+    # Calculate Bayes factor
+    bayes_k = np.log(prob + 1e-8) - np.log(1 - prob + 1e-8)
+
+    # Mask self-associations (difference for only perturbed feature)
+    bayes_mask = np.zeros(bayes_k.shape, dtype=bool)
+    if is_continuous:
+        bayes_mask = get_self_association_mask(baseline_dataset, delta, columns)
+
+    return bayes_k, bayes_mask
+
+
+def check_bayes_k_precision(
+    config: MOVEConfig,
+    task_config: IdentifyAssociationsConfig,
+    refits: list[Refit],
+    baseline_dataset: MOVEDataset,
+    nan_mask: BoolArray,
+    feature_mask: BoolArray,
+) -> FloatArray:
+    """
+    Validate the precision of the refits: calculate the Bayes factors of the
+    first block of perturbed features in the precision of the refits and in
+    float32, and log how much they deviate.
+
+    Both are calculated with the same random state (the latent space samples
+    are the same) and the same baseline reconstructions, so the deviation only
+    comes from the precision of the perturbed forward passes. The global random
+    state is restored afterwards.
+
+    Args:
+        config: main configuration
+        task_config: configuration of the task
+        refits: list of models (in evaluation mode) with their baseline
+            reconstructions and pre-activations
+        baseline_dataset: reference (non-perturbed) dataset
+        nan_mask: mask for NaNs (2D: N x C)
+        feature_mask: mask for the perturbed features (2D: N x P)
+
+    Returns:
+        Absolute deviation of the Bayes factors (2D: K x C)
+    """
+    num_block = min(task_config.perturbation_block_size, feature_mask.shape[1])
+    feature_ids = list(range(num_block))
+    delta, columns = get_block_delta(
+        config, task_config, baseline_dataset, feature_ids
+    )
+    is_continuous = task_config.target_value in CONTINUOUS_TARGET_VALUE
+
+    precisions = [refit.model.precision for refit in refits]
+    seed = int(torch.randint(2**31, ()))
+    results = []
+    try:
+        for is_reference in (False, True):
+            if is_reference:
+                for refit in refits:
+                    refit.model.precision = "float32"
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(seed)
+                bayes_k, bayes_mask = calculate_bayes_k_block(
+                    refits,
+                    delta,
+                    baseline_dataset,
+                    columns,
+                    nan_mask,
+                    feature_mask[:, feature_ids],
+                    is_continuous,
+                )
+            results.append(np.where(bayes_mask, np.nan, bayes_k))
+    finally:
+        for refit, precision in zip(refits, precisions):
+            refit.model.precision = precision
+
+    deviation = np.abs(results[0] - results[1])
+    logger.info(
+        f"Bayes factors in {precisions[0]} deviate from float32 by "
+        f"{np.nanmean(deviation):.4g} on average (max: {np.nanmax(deviation):.4g}) "
+        f"in the first {num_block} perturbed features"
+    )
+    return deviation
+
+
+def calculate_ttest_pvalues_block(
+    perturb_recon: FloatArray,
+    baseline_recon: FloatArray,
+    baseline_diff: FloatArray,
+    nan_mask: BoolArray,
+    feature_mask: BoolArray,
+) -> FloatArray:
+    """
+    Calculate the p-values of a paired t-test between the perturbed and the
+    baseline differences of a block of K perturbed features, for one refit.
+
+    The result is the same as calling `scipy.stats.ttest_rel` (with
+    `nan_policy="omit"`) per perturbed feature, on both differences with
+    masked values replaced by NaN. All features of the block are tested at
+    once, from the sums of the paired differences and of their squared
+    deviations over the unmasked samples.
+
+    Args:
+        perturb_recon: reconstruction of each perturbation (3D: K x N x C)
+        baseline_recon: reconstruction of the baseline (2D: N x C)
+        baseline_diff: difference between repeated baseline reconstructions
+            (2D: N x C)
+        nan_mask: mask for NaNs (2D: N x C)
+        feature_mask: mask for the perturbed features of the block (2D: N x K)
+
+    Returns:
+        P-values (2D: K x C)
+    """
+    # Paired differences, with masked values set to NaN
+    diff = np.subtract(perturb_recon, baseline_recon)  # 3D: K x N x C
+    diff = np.subtract(diff, baseline_diff)
+    diff[:, nan_mask] = np.nan
+    diff[feature_mask.T] = np.nan
+    is_valid = ~np.isnan(diff)
+    diff[~is_valid] = 0
+
+    # Mean and unbiased variance of the differences of the unmasked samples
+    num_valid = np.sum(is_valid, axis=1)  # 2D: K x C
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_diff = np.sum(diff, axis=1) / num_valid
+        diff -= mean_diff[:, np.newaxis, :]
+        diff[~is_valid] = 0
+        var_diff = np.sum(diff * diff, axis=1) / (num_valid - 1)
+        t_stat = mean_diff / np.sqrt(var_diff / num_valid)
+    df = (num_valid - 1).astype(np.float64)
+    df[df < 1] = np.nan
+    return 2 * stdtr(df, -np.abs(t_stat))
+
+
+def get_bayes_models_path(
+    task_config: IdentifyAssociationsConfig,
+    models_path: Path,
+    results_store: ResultsStore,
+) -> tuple[Path, bool]:
+    """
+    Find where the refits of the Bayes approach (and their baseline
+    reconstructions) are saved. Stored blocks can only be resumed with the
+    refits that computed them, so refits are saved whenever resuming is
+    enabled. Unless `save_refits` is set, they are kept in the results store,
+    and discarded together with the stored blocks.
+
+    Args:
+        task_config: configuration of the identify associations task
+        models_path: directory of the saved refits
+        results_store: store of the blocks computed so far
+
+    Returns:
+        Directory of the refits, and whether newly trained refits are saved
+    """
+    if task_config.save_refits or not task_config.resume:
+        return models_path, task_config.save_refits
+    return results_store.subdirectory("refits"), True
+
+
+def restore_bayes_k_blocks(
+    results_store: ResultsStore,
+    bayes_k: FloatArray,
+    bayes_mask: BoolArray,
+    block_size: int,
+) -> list[list[int]]:
+    """
+    Fill the Bayes factors and masks of the features already in the results
+    store, and split the remaining features into blocks.
+
+    Args:
+        results_store: store of the blocks computed so far
+        bayes_k: Bayes factors, filled in place (2D: P x C)
+        bayes_mask: mask of self-associations, filled in place (2D: P x C)
+        block_size: number of features per block
+
+    Returns:
+        Blocks of feature indices that still have to be computed
+    """
+    is_done = np.zeros(bayes_k.shape[0], dtype=bool)
+    for key in results_store.keys():
+        entry = results_store.load(key)
+        feature_ids = entry["feature_ids"]
+        bayes_k[feature_ids, :] = entry["bayes_k"]
+        bayes_mask[feature_ids, :] = entry["bayes_mask"]
+        is_done[feature_ids] = True
+    pending_ids = np.flatnonzero(~is_done).tolist()
+    if np.any(is_done):
+        logger.info(
+            f"Skipping {np.sum(is_done)} features found in the results store"
+        )
+    return [
+        pending_ids[start : start + block_size]
+        for start in range(0, len(pending_ids), block_size)
+    ]
+
+
+def store_bayes_k_block(
+    results_store: ResultsStore,
+    feature_ids: list[int],
+    bayes_k: FloatArray,
+    bayes_mask: BoolArray,
+) -> None:
+    """
+    Save the Bayes factors and mask of a block of features in the results store.
+
+    Args:
+        results_store: store of the blocks computed so far
+        feature_ids: indices of the perturbed features of the block
+        bayes_k: Bayes factors of the block (2D: K x C)
+        bayes_mask: mask of self-associations of the block (2D: K x C)
+    """
+    results_store.save(
+        f"features_{feature_ids[0]}",
+        feature_ids=np.array(feature_ids),
+        bayes_k=bayes_k,
+        bayes_mask=bayes_mask,
+    )
+
+
+def _argsort_descending(values: FloatArray, ids: IntArray) -> IntArray:
+    """Sort flat indices (in ascending order) by descending value. Ties are
+    sorted by descending index."""
+    return ids[np.argsort(values[ids], kind="stable")[::-1]]
+
+
+def select_bayes_associations(
+    bayes_k: FloatArray,
+    bayes_mask: BoolArray,
+    sig_threshold: float,
+    num_top: int = 2**16,
+) -> tuple[IntArray, FloatArray, FloatArray, FloatArray]:
+    """
+    Rank the associations by absolute Bayes factor and select them up to the
+    FDR cutoff (the rank at which the FDR is closest to the significance
+    threshold).
+
+    Only the top of the ranking is sorted. The top `num_top` associations are
+    found with a partition, and this number grows until the FDR cutoff is
+    among them. Since the FDR of the ranked associations does not decrease, no
+    later rank can be closer to the threshold. Self-associations, which are
+    ranked last, are checked separately.
+
+    The ranking is the one of a reversed stable sort: ties of absolute Bayes
+    factor, including the self-associations ranked last, are ordered by
+    descending flat index. This is not always the order of a reversed
+    `np.argsort`, which leaves ties in an unspecified order. With ties at the
+    cutoff, the selected associations can therefore differ from those of a
+    full unstable sort, and so can the FDR of tied self-associations, whose
+    probabilities differ.
+
+    Args:
+        bayes_k: Bayes factors (2D: P x C)
+        bayes_mask: mask of self-associations (2D: P x C)
+        sig_threshold: FDR threshold
+        num_top: initial number of top associations to sort
+
+    Returns:
+        Flat indices, probabilities, FDR and Bayes factors of the significant
+        associations, in descending order of absolute Bayes factor
+    """
+    bayes_abs = np.abs(bayes_k)  # 2D: P x C
+    bayes_p = np.exp(bayes_abs) / (1.0 + np.exp(bayes_abs))  # 2D: P x C
+
+    # Bring self-associations to the minimum, they are ranked last together
+    # with the associations tied at the minimum
+    min_abs = np.min(bayes_abs)
+    bayes_abs[bayes_mask] = min_abs
+    flat_abs, flat_p = bayes_abs.ravel(), bayes_p.ravel()
+    size = flat_abs.size
+    last_ids = np.flatnonzero(flat_abs == min_abs)[::-1]
+    num_first = size - last_ids.size
+
+    # Bound of the rounding error of the FDR
+    tol = 4 * size * np.finfo(flat_p.dtype).eps
+
+    # Sort a growing number of top associations, until the FDR moves past the
+    # threshold. Only values above the cut are sorted, so that ties at the cut
+    # (split arbitrarily by the partition) are never included.
+    num_top = max(1, num_top)
+    while True:
+        # Past a quarter of the associations, sorting all of them is cheaper
+        if num_top < num_first // 4:
+            cut = np.partition(flat_abs, size - num_top)[size - num_top]
+            sort_ids = np.flatnonzero(flat_abs > cut)
+        else:
+            sort_ids = np.flatnonzero(flat_abs > min_abs)
+        sort_ids = _argsort_descending(flat_abs, sort_ids)
+        fdr = np.cumsum(1 - flat_p[sort_ids]) / np.arange(1, sort_ids.size + 1)
+        dist = np.abs(fdr - sig_threshold)
+        idx = int(np.argmin(dist)) if dist.size > 0 else 0
+        if sort_ids.size == num_first:
+            break
+        if dist.size > 0 and fdr[-1] >= sig_threshold and dist[-1] - tol > dist[idx]:
+            break
+        num_top *= 4
+
+    # Self-associations may bring the FDR back close to the threshold. If so,
+    # the whole ranking is needed
+    if last_ids.size > 0:
+        first_fdr_sum = num_first - (np.sum(flat_p) - np.sum(flat_p[last_ids]))
+        last_fdr = (first_fdr_sum + np.cumsum(1 - flat_p[last_ids])) / np.arange(
+            num_first + 1, size + 1
+        )
+        if dist.size == 0 or np.min(np.abs(last_fdr - sig_threshold)) <= (
+            dist[idx] + tol
+        ):
+            if sort_ids.size < num_first:
+                sort_ids = np.flatnonzero(flat_abs > min_abs)
+                sort_ids = _argsort_descending(flat_abs, sort_ids)
+            sort_ids = np.concatenate((sort_ids, last_ids))
+            fdr = np.cumsum(1 - flat_p[sort_ids]) / np.arange(1, size + 1)
+            idx = int(np.argmin(np.abs(fdr - sig_threshold)))
+    logger.debug(f"Index is {idx}")
+
+    sort_ids = sort_ids[:idx]
+    return sort_ids, flat_p[sort_ids], fdr[:idx], bayes_k.ravel()[sort_ids]
@@ -0,0 +1,335 @@
+__all__ = [
+    "check_quantization",
+    "get_baseline_recon_path",
+    "get_refit_path",
+    "quantize_refits",
+    "train_refits",
+]
+
+from functools import partial
+from pathlib import Path
+from typing import Any, Iterable, Optional, cast
+
+import hydra
+import numpy as np
+import pandas as pd
+import torch
+from torch import optim
+from torch.utils.data import DataLoader
+
+from move.conf.schema import ParallelConfig, TrainingLoopConfig, VAEConfig
+from move.core.logging import get_logger
+from move.core.parallel import get_pool_layout, make_pool
+from move.data import io
+from move.data.dataloaders import MOVEDataset
+from move.models.ensemble import EnsembleVAE
+from move.models.inference import quantize_vae
+from move.models.vae import VAE
+
+logger = get_logger(__name__)
+
+
+# State shared with the pool processes. The configurations and the training
+# data are handed to each process once by the initializer, so tasks only carry
+# the index and seed of a refit.
+_worker_state: dict[str, Any] = {}
+
+
+def get_refit_path(models_path: Path, num_latent: int, refit_id: int) -> Path:
+    """Return the path of the weights of a refit."""
+    return models_path / f"model_{num_latent}_{refit_id}.pt"
+
+
+def get_baseline_recon_path(
+    models_path: Path, num_latent: int, refit_id: int, is_quantized: bool = False
+) -> Path:
+    """Return the path of the baseline reconstruction of a refit (or of its
+    quantized version)."""
+    suffix = "_int8" if is_quantized else ""
+    return models_path / f"baseline_recon_{num_latent}_{refit_id}{suffix}.pt"
+
+
+def _make_model(
+    model_config: VAEConfig,
+    train_dataloader: DataLoader,
+    num_latent: Optional[int],
+) -> VAE:
+    train_dataset = cast(MOVEDataset, train_dataloader.dataset)
+    kwargs = {} if num_latent is None else dict(num_latent=num_latent)
+    model: VAE = hydra.utils.instantiate(
+        model_config,
+        continuous_shapes=train_dataset.con_shapes,
+        categorical_shapes=train_dataset.cat_shapes,
+        **kwargs,
+    )
+    return model
+
+
+def _train_model(
+    model_config: VAEConfig,
+    training_loop_config: TrainingLoopConfig,
+    train_dataloader: DataLoader,
+    num_latent: Optional[int],
+    seed: int,
+) -> VAE:
+    """Train a new model. The seed sets the initial weights, the order of the
+    training batches and the dropout masks."""
+    device = torch.device("cuda" if model_config.cuda else "cpu")
+    torch.manual_seed(seed)
+    model = _make_model(model_config, train_dataloader, num_latent)
+    model.to(device)
+    hydra.utils.call(
+        training_loop_config,
+        model=model,
+        train_dataloader=train_dataloader,
+    )
+    return model
+
+
+def _init_refit_worker(
+    model_config: VAEConfig,
+    training_loop_config: TrainingLoopConfig,
+    train_dataloader: DataLoader,
+    num_latent: Optional[int],
+) -> None:
+    """Pool initializer. Stores the configurations and the training data in the
+    worker process."""
+    _worker_state.clear()
+    _worker_state["model_config"] = model_config
+    _worker_state["training_loop_config"] = training_loop_config
+    _worker_state["train_dataloader"] = train_dataloader
+    _worker_state["num_latent"] = num_latent
+
+
+def _refit_worker(task: tuple[int, int]) -> tuple[int, dict[str, torch.Tensor]]:
+    """Worker function to train a refit. Returns its index and weights."""
+    refit_id, seed = task
+    logger.debug(f"Training refit {refit_id + 1} in worker process")
+    model = _train_model(
+        _worker_state["model_config"],
+        _worker_state["training_loop_config"],
+        _worker_state["train_dataloader"],
+        _worker_state["num_latent"],
+        seed,
+    )
+    return refit_id, model.state_dict()
+
+
+def train_refits(
+    model_config: VAEConfig,
+    training_loop_config: TrainingLoopConfig,
+    train_dataloader: DataLoader,
+    refit_ids: Iterable[int],
+    parallel_config: ParallelConfig,
+    models_path: Optional[Path] = None,
+    save_refits: bool = False,
+    num_latent: Optional[int] = None,
+    inference_backend: Optional[str] = None,
+    ensemble: bool = False,
+) -> list[VAE]:
+    """Train or reload a set of refits of the same model.
+
+    Refits whose weights are found in the models path are reloaded, the rest
+    are trained. If the pool configuration allows more than one worker, refits
+    are trained concurrently, each in its own process with the configured
+    number of threads. Otherwise, they are trained one after another in the
+    main process. Refits using CUDA are always trained in the main process.
+    Alternatively, all refits are trained at once as an ensemble (see
+    `EnsembleVAE`), in the main process.
+
+    Each refit is seeded from a base seed (drawn from the global random state)
+    plus its index. Hence, refits do not depend on the number of workers. In
+    an ensemble, this seed only sets the initial weights, as all refits share
+    the order of the training batches.
+
+    Args:
+        model_config: configuration of the model
+        training_loop_config: configuration of the training loop
+        train_dataloader: training data
+        refit_ids: indices of the refits
+        parallel_config: configuration of the pool of worker processes
+        models_path: directory of the weights of the refits. If not set,
+            refits are never reloaded nor saved.
+        save_refits: whether to save the weights of each trained refit (as
+            soon as it is trained)
+        num_latent: latent space size, overriding that of the model
+            configuration
+        inference_backend: if set, the evaluation graph of each refit is
+            compiled with this backend (see `VAE.compile_inference`)
+        ensemble: whether to train the refits as an ensemble
+
+    Returns:
+        Refits in evaluation mode, in the same order as their indices
+    """
+    refit_ids = list(refit_ids)
+    device = torch.device("cuda" if model_config.cuda else "cpu")
+    if num_latent is None:
+        latent_size = model_config.num_latent
+    else:
+        latent_size = num_latent
+
+    # A refit's seed only depends on its index (and the global random state)
+    base_seed = int(torch.randint(2**31, ()))
+
+    models: dict[int, VAE] = {}
+    pending_ids = []
+    for j in refit_ids:
+        if models_path is not None:
+            model_path = get_refit_path(models_path, latent_size, j)
+            if model_path.exists():
+                logger.debug(f"Re-loading refit {j + 1}")
+                model = _make_model(model_config, train_dataloader, num_latent)
+                model.load_state_dict(io.load_checkpoint(model_path))
+                models[j] = model.to(device)
+                continue
+        pending_ids.append(j)
+
+    def save(refit_id: int, model: VAE) -> None:
+        if models_path is not None and save_refits:
+            model_path = get_refit_path(models_path, latent_size, refit_id)
+            io.dump_checkpoint(model_path, model.state_dict())
+
+    layout = None
+    if (
+        len(pending_ids) > 1
+        and not ensemble
+        and not model_config.cuda
+        and parallel_config.workers != 1
+    ):
+        layout = get_pool_layout(parallel_config)
+        layout = layout._replace(workers=min(layout.workers, len(pending_ids)))
+
+    if ensemble and len(pending_ids) > 1:
+        logger.info(f"Training {len(pending_ids)} refits as an ensemble")
+        # The global random state is restored after training
+        with torch.random.fork_rng(devices=[]):
+            members = []
+            for j in pending_ids:
+                torch.manual_seed(base_seed + j)
+                members.append(
+                    _make_model(model_config, train_dataloader, num_latent).to(device)
+                )
+            torch.manual_seed(base_seed)
+            ensemble_model = EnsembleVAE(members)
+            kwargs = {}
+            if training_loop_config.optimizer is None:
+                # The stacked weights are large, and the step of the default
+                # Adam optimizer (one pass per operation) is memory-bound
+                kwargs["optimizer"] = partial(optim.Adam, fused=True)
+            hydra.utils.call(
+                training_loop_config,
+                model=ensemble_model,
+                train_dataloader=train_dataloader,
+                **kwargs,
+            )
+        for index, (j, model) in enumerate(zip(pending_ids, members)):
+            model.load_state_dict(ensemble_model.member_state_dict(index))
+            models[j] = model
+            save(j, model)
+    elif layout is not None and layout.workers > 1:
+        logger.info(f"Training {len(pending_ids)} refits in parallel")
+        tasks = [(j, base_seed + j) for j in pending_ids]
+        initargs = (model_config, training_loop_config, train_dataloader, num_latent)
+        with make_pool(layout, _init_refit_worker, initargs) as pool:
+            # Refits are saved as soon as they finish
+            for j, state_dict in pool.imap_unordered(_refit_worker, tasks):
+                logger.debug(f"Trained refit {j + 1}")
+                model = _make_model(model_config, train_dataloader, num_latent)
+                model.load_state_dict(state_dict)
+                models[j] = model
+                save(j, model)
+    else:
+        for j in pending_ids:
+            logger.debug(f"Training refit {j + 1}")
+            # The global random state is restored after training
+            with torch.random.fork_rng(devices=[]):
+                model = _train_model(
+                    model_config,
+                    training_loop_config,
+                    train_dataloader,
+                    num_latent,
+                    base_seed + j,
+                )
+            models[j] = model
+            save(j, model)
+
+    for model in models.values():
+        model.eval()
+        if inference_backend is not None:
+            model.compile_inference(inference_backend)
+    return [models[j] for j in refit_ids]
+
+
+def check_quantization(model_config: Optional[VAEConfig]) -> None:
+    """Raise an error if the refits of a model configuration cannot be
+    quantized: quantized layers only run on the CPU and in float32."""
+    if model_config is None:
+        return
+    if model_config.cuda:
+        raise ValueError("Quantized models only run on the CPU.")
+    if model_config.precision != "float32":
+        raise ValueError("Quantized models require float32 precision.")
+
+
+def quantize_refits(
+    models: list[VAE],
+    refit_ids: Iterable[int],
+    dataloader: DataLoader,
+    report_path: Optional[Path] = None,
+) -> list[VAE]:
+    """Quantize a set of refits for inference (see `quantize_vae`), and check
+    how much the quantized refits deviate from the float ones.
+
+    The data is reconstructed by each float and quantized refit with the same
+    latent space samples. The QC report lists, per refit, the mean and maximum
+    absolute error and the correlation between both continuous
+    reconstructions, and the agreement of the categorical reconstructions.
+
+    Args:
+        models: refits in evaluation mode
+        refit_ids: indices of the refits
+        dataloader: data to reconstruct (not shuffled)
+        report_path: path of the QC report (TSV), whose directory is created
+            if needed (e.g., the models directory when refits are not saved).
+            If not set, the report is only logged.
+
+    Returns:
+        Quantized refits, in the same order
+    """
+    quantized_models = []
+    records = []
+    for refit_id, model in zip(refit_ids, models):
+        quantized = quantize_vae(model)
+        quantized_models.append(quantized)
+
+        seed = int(torch.randint(2**31, ()))
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            cat_recons, con_recon = model.reconstruct(dataloader)
+            torch.manual_seed(seed)
+            q_cat_recons, q_con_recon = quantized.reconstruct(dataloader)
+
+        record: dict[str, Any] = {}
+        if len(con_recon) > 0:
+            error = np.abs(q_con_recon - con_recon)
+            record["mean_absolute_error"] = error.mean()
+            record["max_absolute_error"] = error.max()
+            record["correlation"] = np.corrcoef(
+                con_recon.ravel(), q_con_recon.ravel()
+            )[0, 1]
+        if len(cat_recons) > 0:
+            record["categorical_agreement"] = np.mean(
+                np.concatenate(
+                    [(q == c).ravel() for q, c in zip(q_cat_recons, cat_recons)]
+                )
+            )
+        logger.info(
+            f"Quantized refit {refit_id + 1}: "
+            + ", ".join(f"{key}={value:.4g}" for key, value in record.items())
+        )
+        records.append(dict(refit=refit_id, **record))
+
+    if report_path is not None:
+        report_path.parent.mkdir(parents=True, exist_ok=True)
+        pd.DataFrame(records).to_csv(report_path, sep="\t", index=False)
+    return quantized_models
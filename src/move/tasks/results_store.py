@@ -0,0 +1,95 @@
+__all__ = ["ResultsStore"]
+
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from move.core.logging import get_logger
+from move.core.typing import PathLike
+
+logger = get_logger(__name__)
+
+
+class ResultsStore:
+    """
+    On-disk store of partial results, used to checkpoint long tasks and resume
+    them after an interruption. Each entry is a set of named arrays, saved in its
+    own `.npz` file as soon as it is computed.
+
+    The store is tied to a signature (e.g., the task configuration and a
+    fingerprint of the data). If the signature of a previous run differs, the
+    stored results are discarded, together with the subdirectories of the
+    store.
+
+    Args:
+        path: directory of the store
+        signature: JSON-serializable description of what produces the results
+        resume: whether to keep the results of a previous run. If False, the
+            store starts empty.
+    """
+
+    def __init__(
+        self, path: PathLike, signature: dict[str, Any], resume: bool = True
+    ) -> None:
+        self.path = Path(path)
+        self.signature = json.loads(json.dumps(signature, default=str))
+        signature_path = self.path / "signature.json"
+        self.path.mkdir(parents=True, exist_ok=True)
+        if not resume:
+            self._discard()
+        elif not signature_path.exists() or (
+            json.loads(signature_path.read_text()) != self.signature
+        ):
+            if len(self) > 0:
+                logger.warning(f"Discarding outdated results in {self.path}")
+            self._discard()
+        signature_path.write_text(json.dumps(self.signature, indent=2))
+        if len(self) > 0:
+            logger.info(f"Resuming from {len(self)} stored results in {self.path}")
+
+    def __contains__(self, key: str) -> bool:
+        return (self.path / f"{key}.npz").exists()
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def keys(self) -> list[str]:
+        """Return the keys of the stored entries, in sorted order."""
+        return sorted(entry.stem for entry in self.path.glob("*.npz"))
+
+    def save(self, key: str, **arrays: Any) -> None:
+        """Save an entry. The file is written under a temporary name and then
+        renamed, so an interrupted write never leaves a partial entry."""
+        tmp_path = self.path / f"{key}.tmp"
+        with open(tmp_path, "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(tmp_path, self.path / f"{key}.npz")
+
+    def load(self, key: str) -> dict[str, np.ndarray]:
+        """Load the arrays of an entry."""
+        with np.load(self.path / f"{key}.npz") as entry:
+            return {name: entry[name] for name in entry.files}
+
+    def subdirectory(self, name: str) -> Path:
+        """Return a subdirectory of the store (created if needed), for data the
+        stored results depend on, e.g., the models that computed them. It is
+        only removed when the stored results are discarded."""
+        path = self.path / name
+        path.mkdir(exist_ok=True)
+        return path
+
+    def clear(self) -> None:
+        """Remove all entries. Subdirectories are kept."""
+        for entry in self.path.glob("*.npz"):
+            entry.unlink()
+
+    def _discard(self) -> None:
+        """Remove all entries and subdirectories."""
+        self.clear()
+        for path in self.path.iterdir():
+            if path.is_dir():
+                shutil.rmtree(path)
@@ -0,0 +1,273 @@
+from itertools import chain
+from pathlib import Path
+from typing import Any, Union, cast
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from move.conf.schema import IdentifyAssociationsTTestConfig, MOVEConfig
+from move.core.logging import get_logger
+from move.core.parallel import get_pool_layout, make_pool
+from move.core.typing import BoolArray, FloatArray, IntArray
+from move.data.dataloaders import MOVEDataset
+from move.models.vae import VAE
+from move.tasks.perturbation_engine import (
+    Refit,
+    calculate_ttest_pvalues_block,
+    get_block_delta,
+    make_refit,
+    reconstruct_block,
+)
+from move.tasks.refit_training import quantize_refits, train_refits
+from move.tasks.results_store import ResultsStore
+
+# Model, baseline reconstruction, first-layer pre-activations and baseline
+# difference of a refit, as passed to the pool
+SharedRefit = tuple[VAE, torch.Tensor, torch.Tensor, torch.Tensor]
+
+logger = get_logger(__name__)
+
+
+# State shared with the pool processes. The baseline dataset, masks and refits
+# (with their baseline reconstructions and differences) live in shared memory
+# and are handed to each process once by the initializer, so tasks only carry
+# the indices of a refit and of a block of perturbed features.
+_worker_state: dict[str, Any] = {}
+
+
+def _init_ttest_worker(
+    config: MOVEConfig,
+    task_config: IdentifyAssociationsTTestConfig,
+    baseline_dataset: MOVEDataset,
+    refits: dict[tuple[int, int], SharedRefit],
+    nan_mask: torch.Tensor,
+    feature_mask: torch.Tensor,
+) -> None:
+    """
+    Pool initializer. Stores references to the shared tensors in the worker
+    process. NumPy views are created over the shared buffers, no data is copied.
+    """
+    _worker_state.clear()
+    _worker_state["config"] = config
+    _worker_state["task_config"] = task_config
+    _worker_state["baseline_dataset"] = baseline_dataset
+    _worker_state["refits"] = {
+        key: (
+            Refit(model, baseline_recon.numpy(), baseline_preactivation),
+            baseline_diff.numpy(),
+        )
+        for key, (
+            model,
+            baseline_recon,
+            baseline_preactivation,
+            baseline_diff,
+        ) in refits.items()
+    }
+    _worker_state["nan_mask"] = nan_mask.numpy()
+    _worker_state["feature_mask"] = feature_mask.numpy()
+
+
+def _ttest_approach_worker(task: tuple[int, int, list[int]]):
+    """
+    Worker function to calculate the p-values of a block of perturbed features,
+    for one refit of one latent space size.
+    """
+    k, j, feature_ids = task
+    logger.debug(f"Inside the worker function for refit {k, j}, {feature_ids}")
+
+    config: MOVEConfig = _worker_state["config"]
+    task_config: IdentifyAssociationsTTestConfig = _worker_state["task_config"]
+    baseline_dataset: MOVEDataset = _worker_state["baseline_dataset"]
+    nan_mask: BoolArray = _worker_state["nan_mask"]
+    feature_mask: BoolArray = _worker_state["feature_mask"]
+    refit, baseline_diff = _worker_state["refits"][k, j]
+
+    # Reconstruct the perturbations of all features in the block at once
+    delta, columns = get_block_delta(
+        config, task_config, baseline_dataset, feature_ids
+    )
+    perturb_recon = reconstruct_block(refit, delta, columns)
+    num_samples = baseline_dataset.num_samples
+    perturb_recon = perturb_recon.reshape(len(feature_ids), num_samples, -1)
+
+    # T-test between baseline and perturb difference, for the whole block
+    pvalues = calculate_ttest_pvalues_block(
+        perturb_recon,
+        refit.baseline_recon,
+        baseline_diff,
+        nan_mask,
+        feature_mask[:, feature_ids],
+    )
+    logger.debug(f"P-values calculated for refit {k, j}, {feature_ids}")
+
+    return k, j, feature_ids, pvalues
+
+
+def _ttest_approach_parallel(
+    config: MOVEConfig,
+    task_config: IdentifyAssociationsTTestConfig,
+    train_dataloader: DataLoader,
+    baseline_dataloader: DataLoader,
+    models_path: Path,
+    interim_path: Path,
+    num_perturbed: int,
+    num_samples: int,
+    num_continuous: int,
+    nan_mask: BoolArray,
+    feature_mask: BoolArray,
+    results_store: ResultsStore,
+) -> tuple[Union[IntArray, FloatArray], ...]:
+    """
+    Calculate the t-test p-values of all perturbed features in parallel.
+
+    Models (one per latent space size and refit) are trained or reloaded first,
+    together with their baseline reconstruction and baseline difference. They
+    are placed in shared memory and passed to the pool once. Each task is a
+    block of perturbed features of one refit, so the whole latent size x refit
+    x feature grid is spread over the pool.
+
+    The p-values of a refit are saved in the results store once all its blocks
+    complete, and refits found in the store are skipped.
+    """
+    assert task_config.model is not None
+
+    # Train models
+    logger.info("Training models")
+    pvalues = np.empty(
+        (
+            len(task_config.num_latent),
+            task_config.num_refits,
+            num_perturbed,
+            num_continuous,
+        )
+    )
+
+    baseline_dataset = cast(MOVEDataset, baseline_dataloader.dataset)
+
+    refits: dict[tuple[int, int], SharedRefit] = {}
+    for k, num_latent in enumerate(task_config.num_latent):
+        # Refits found in the results store are skipped
+        pending_ids = []
+        for j in range(task_config.num_refits):
+            result_key = f"refit_{num_latent}_{j}"
+            if result_key in results_store:
+                logger.debug(f"Skipping refit {j + 1}/{task_config.num_refits}")
+                pvalues[k, j, :, :] = results_store.load(result_key)["pvalues"]
+            else:
+                pending_ids.append(j)
+
+        models = train_refits(
+            task_config.model,
+            task_config.training_loop,
+            train_dataloader,
+            pending_ids,
+            task_config.training_parallel,
+            models_path,
+            task_config.save_refits,
+            num_latent=num_latent,
+            inference_backend=task_config.inference_backend,
+            ensemble=task_config.ensemble_training,
+        )
+        if task_config.quantize:
+            models = quantize_refits(
+                models,
+                pending_ids,
+                baseline_dataloader,
+                models_path / f"quantization_qc_{num_latent}.tsv",
+            )
+        for j, model in zip(pending_ids, models):
+            if j == 0:
+                logger.debug(f"Model: {model}")
+
+            # Get baseline reconstruction and baseline difference
+            _, baseline_recon = model.reconstruct(baseline_dataloader)
+            baseline_diff = np.empty((10, num_samples, num_continuous))
+            for i in range(10):
+                _, recon = model.reconstruct(baseline_dataloader)
+                baseline_diff[i, :, :] = recon - baseline_recon
+            baseline_diff = np.mean(baseline_diff, axis=0)  # 2D: N x C
+            baseline_diff = np.where(nan_mask, np.nan, baseline_diff)
+
+            # Weights, reconstruction, difference and first-layer
+            # pre-activations are moved to shared memory
+            refit = make_refit(model, baseline_recon, baseline_dataset)
+            model.share_memory()
+            refits[k, j] = (
+                model,
+                torch.from_numpy(baseline_recon).share_memory_(),
+                refit.baseline_preactivation.share_memory_(),
+                torch.from_numpy(baseline_diff).share_memory_(),
+            )
+
+    # The baseline data and masks are also shared
+    baseline_dataset.share_memory_()
+    shared_nan_mask = torch.from_numpy(nan_mask).share_memory_()
+    shared_feature_mask = torch.from_numpy(feature_mask).share_memory_()
+
+    # Each task is a block of perturbed features of one refit
+    block_size = task_config.perturbation_block_size
+    blocks = [
+        list(range(start, min(start + block_size, num_perturbed)))
+        for start in range(0, num_perturbed, block_size)
+    ]
+    tasks = [(k, j, feature_ids) for k, j in refits for feature_ids in blocks]
+    num_pending_blocks = {key: len(blocks) for key in refits}
+
+    if len(tasks) > 0:
+        logger.info("Calculating p-values")
+        initargs = (
+            config,
+            task_config,
+            baseline_dataset,
+            refits,
+            shared_nan_mask,
+            shared_feature_mask,
+        )
+        timed_results: list[Any] = []
+        layout = get_pool_layout(
+            task_config.parallel,
+            _ttest_approach_worker,
+            tasks,
+            _init_ttest_worker,
+            initargs,
+            timed_results,
+        )
+        with make_pool(layout, _init_ttest_worker, initargs) as pool:
+            # Tasks timed to pick the layout are not computed again
+            results = chain(
+                timed_results,
+                pool.imap_unordered(
+                    _ttest_approach_worker,
+                    tasks[len(timed_results) :],
+                    chunksize=task_config.parallel.chunksize,
+                ),
+            )
+            # Place each block at its indices, and store a refit once all of its
+            # blocks are done
+            for k, j, feature_ids, block_pvalues in results:
+                pvalues[k, j, feature_ids, :] = block_pvalues
+                num_pending_blocks[k, j] -= 1
+                if num_pending_blocks[k, j] == 0:
+                    result_key = f"refit_{task_config.num_latent[k]}_{j}"
+                    results_store.save(result_key, pvalues=pvalues[k, j, :, :])
+        logger.info("Pool multiprocess completed")
+
+    # Correct p-values (Bonferroni)
+    pvalues = np.minimum(pvalues * num_continuous, 1.0)
+    np.save(interim_path / "pvals.npy", pvalues)
+
+    # Find significant hits
+    overlap_thres = task_config.num_refits // 2
+    reject = pvalues <= task_config.sig_threshold  # 4D: L x R x P x C
+    overlap = reject.sum(axis=1) >= overlap_thres  # 3D: L x P x C
+    sig_ids = overlap.sum(axis=0) >= 3  # 2D: P x C
+    sig_ids = np.flatnonzero(sig_ids)  # 1D
+
+    # Report median p-value
+    masked_pvalues = np.ma.masked_array(pvalues, mask=~reject)  # 4D
+    masked_pvalues = np.ma.median(masked_pvalues, axis=1)  # 3D
+    masked_pvalues = np.ma.median(masked_pvalues, axis=0)  # 2D
+    sig_pvalues = np.ma.compressed(np.take(masked_pvalues, sig_ids))  # 1D
+
+    return sig_ids, sig_pvalues
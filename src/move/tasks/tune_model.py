@@ -29,6 +29,7 @@ from move.core.typing import BoolArray
 from move.data import io
 from move.data.dataloaders import MOVEDataset, make_dataloader, split_samples
 from move.models.vae import VAE
+from move.tasks.refit_training import train_refits
 
 TaskType = Literal["reconstruction", "stability"]
 
@@ -97,6 +98,7 @@ def tune_model(config: MOVEConfig) -> float:
             cat_list,
             con_list,
             shuffle=True,
+            sparse=config.data.sparse_input,
             batch_size=task_config.batch_size,
             drop_last=True,
         )
@@ -109,28 +111,20 @@ def tune_model(config: MOVEConfig) -> float:
             drop_last=False,
         )
 
-        train_dataset = cast(MOVEDataset, train_dataloader.dataset)
-
         logger.info(f"Training {task_config.num_refits} refits")
+        models = train_refits(
+            task_config.model,
+            task_config.training_loop,
+            train_dataloader,
+            range(task_config.num_refits),
+            task_config.training_parallel,
+            ensemble=task_config.ensemble_training,
+        )
 
         cosine_sim0 = None
         cosine_sim_diffs = []
-        for j in range(task_config.num_refits):
+        for j, model in enumerate(models):
             logger.debug(f"Refit: {j + 1}/{task_config.num_refits}")
-            model: VAE = hydra.utils.instantiate(
-                task_config.model,
-                continuous_shapes=train_dataset.con_shapes,
-                categorical_shapes=train_dataset.cat_shapes,
-            )
-            model.to(device)
-
-            hydra.utils.call(
-                task_config.training_loop,
-                model=model,
-                train_dataloader=train_dataloader,
-            )
-
-            model.eval()
             latent, *_ = model.latent(test_dataloader, kld_weight=1)
 
             if cosine_sim0 is None:
@@ -172,6 +166,7 @@ def tune_model(config: MOVEConfig) -> float:
             con_list,
             split_mask,
             shuffle=True,
+            sparse=config.data.sparse_input,
             batch_size=task_config.batch_size,
             drop_last=True,
         )
@@ -1,10 +1,14 @@
-from typing import Optional
+from typing import Callable, Optional
 
+from torch import optim
 from torch.utils.data import DataLoader
 
+from move.data.dataloaders import MOVEDataLoader
 from move.models.vae import VAE
 
 TrainingLoopOutput = tuple[list[float], list[float], list[float], list[float], float]
+OptimizerFactory = Callable[..., optim.Optimizer]
+SchedulerFactory = Callable[[optim.Optimizer], optim.lr_scheduler.LRScheduler]
 
 
 def dilate_batch(dataloader: DataLoader) -> DataLoader:
@@ -20,7 +24,7 @@ def dilate_batch(dataloader: DataLoader) -> DataLoader:
     assert dataloader.batch_size is not None
     dataset = dataloader.dataset
     batch_size = int(dataloader.batch_size * 1.5)
-    return DataLoader(dataset, batch_size, shuffle=True, drop_last=True)
+    return MOVEDataLoader(dataset, batch_size, shuffle=True, drop_last=True)
 
 
 BATCH_DILATION_STEPS = []
@@ -37,11 +41,18 @@ def training_loop(
     kld_warmup_steps: list[int] = KLD_WARMUP_STEPS,
     early_stopping: bool = False,
     patience: int = 0,
+    optimizer: Optional[OptimizerFactory] = None,
+    lr_scheduler: Optional[SchedulerFactory] = None,
+    reset_optimizer: bool = False,
 ) -> TrainingLoopOutput:
     """
     Trains a VAE model with batch dilation and KLD warm-up. Optionally,
     enforce early stopping.
 
+    A single optimizer is created for the whole training, so its state (e.g.,
+    Adam's moment estimates) carries over between epochs. An optional learning
+    rate scheduler is stepped after every epoch.
+
     Args:
         model (VAE): trained VAE model object
         train_dataloader (DataLoader):  An object feeding data to the VAE
@@ -59,6 +70,17 @@ def training_loop(
 
         patience (int, optional): number of epochs to wait before early stop
                                   if no progress on the validation set. Defaults to 0.
+        optimizer (Optional[OptimizerFactory], optional): function creating the
+            optimizer from the model parameters and the learning rate (e.g., a
+            partially instantiated `torch.optim` class). Defaults to Adam.
+        lr_scheduler (Optional[SchedulerFactory], optional): function creating a
+            learning rate scheduler from the optimizer (e.g., a partially
+            instantiated `torch.optim.lr_scheduler` class). `ReduceLROnPlateau`
+            is stepped with the validation loss if early stopping is enabled,
+            else with the training loss. Defaults to None (constant rate).
+        reset_optimizer (bool, optional): whether to create a new optimizer
+            every epoch, as older versions did. Schedulers cannot be used then.
+            Defaults to False.
 
     Returns:
         (tuple): a tuple containing:
@@ -73,6 +95,13 @@ def training_loop(
 
     kld_weight = 0.0
 
+    if optimizer is None:
+        optimizer = optim.Adam
+    if reset_optimizer and lr_scheduler is not None:
+        raise ValueError("Learning rate schedulers require a persistent optimizer.")
+    model_optimizer = optimizer(model.parameters(), lr=lr)
+    scheduler = None if lr_scheduler is None else lr_scheduler(model_optimizer)
+
     for epoch in range(1, num_epochs + 1):
         if epoch in kld_warmup_steps:
             kld_weight += 1 / len(kld_warmup_steps)
@@ -80,22 +109,34 @@ def training_loop(
         if epoch in batch_dilation_steps:
             train_dataloader = dilate_batch(train_dataloader)
 
+        if reset_optimizer:
+            model_optimizer = optimizer(model.parameters(), lr=lr)
+
         for i, output in enumerate(
-            model.encoding(train_dataloader, epoch, lr, kld_weight)
+            model.encoding(train_dataloader, epoch, lr, kld_weight, model_optimizer)
         ):
             outputs[i].append(output)
+        monitored_loss = outputs[0][-1]
 
         if early_stopping and valid_dataloader is not None:
             output = model.latent(valid_dataloader, kld_weight)
             valid_likelihood = output[-1]
+            monitored_loss = valid_likelihood
             if valid_likelihood > min_likelihood and counter < patience:
                 counter += 1
                 if counter % 5 == 0:
                     lr *= 0.9
+                    for param_group in model_optimizer.param_groups:
+                        param_group["lr"] *= 0.9
             elif counter == patience:
                 break
             else:
                 min_likelihood = valid_likelihood
                 counter = 0
 
+        if isinstance(scheduler, optim.lr_scheduler.ReduceLROnPlateau):
+            scheduler.step(monitored_loss)
+        elif scheduler is not None:
+            scheduler.step()
+
     return *outputs, kld_weight
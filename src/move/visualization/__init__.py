@@ -7,7 +7,9 @@ __all__ = [
     "plot_latent_space_with_con",
     "plot_loss_curves",
     "plot_metrics_boxplot",
+    "plotting_session",
     "style_settings",
+    "submit_figure",
 ]
 
 
@@ -21,4 +23,5 @@ from move.visualization.latent_space import (
 )
 from move.visualization.loss_curves import LOSS_LABELS, plot_loss_curves
 from move.visualization.metrics import plot_metrics_boxplot
+from move.visualization.rendering import plotting_session, submit_figure
 from move.visualization.style import color_cycle, style_settings
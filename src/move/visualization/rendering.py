@@ -0,0 +1,176 @@
+__all__ = ["plotting_session", "submit_figure"]
+
+import collections
+import os
+import pickle
+from contextlib import contextmanager
+from multiprocessing.pool import AsyncResult
+from multiprocessing.pool import Pool as ProcessPool
+from typing import Any, Callable, Iterator, Optional
+
+import matplotlib
+import matplotlib.figure
+import matplotlib.pyplot as plt
+
+from move.conf.schema import PlottingConfig
+from move.core.logging import get_logger
+from move.core.parallel import PoolLayout, make_pool
+from move.core.typing import PathLike
+
+logger = get_logger(__name__)
+
+# Figure jobs waiting in the pool, per worker process. Submitting more jobs
+# waits for the oldest ones, so that queued data does not pile up in memory
+MAX_PENDING_PER_WORKER = 4
+
+
+def _init_rendering_worker() -> None:
+    """Pool initializer. Worker processes render without a display."""
+    matplotlib.use("Agg")
+
+
+def _render_figure(
+    path: Optional[PathLike],
+    plot_func: Callable[..., matplotlib.figure.Figure],
+    args: tuple,
+    kwargs: dict[str, Any],
+    savefig_kwargs: dict[str, Any],
+) -> None:
+    """Create a figure, save it (unless the plotting function saves it
+    itself), and close it."""
+    fig = plot_func(*args, **kwargs)
+    try:
+        if path is not None:
+            fig.savefig(path, **savefig_kwargs)
+    finally:
+        plt.close(fig)
+
+
+def _render_pickled_figure(job: bytes) -> None:
+    """Render a figure job pickled by the main process."""
+    _render_figure(*pickle.loads(job))
+
+
+class _FigureRenderer:
+    """Render figures in the main process or in a pool of background worker
+    processes, honoring the plotting configuration."""
+
+    def __init__(self, config: PlottingConfig) -> None:
+        self.config = config
+        self.num_figures = 0
+        self.pid = os.getpid()
+        self.pool: Optional[ProcessPool] = None
+        self.pending: collections.deque[AsyncResult] = collections.deque()
+        if config.enabled and config.workers > 0:
+            layout = PoolLayout(workers=config.workers, threads=1)
+            self.pool = make_pool(layout, _init_rendering_worker)
+
+    def submit(
+        self,
+        path: Optional[PathLike],
+        plot_func: Callable[..., matplotlib.figure.Figure],
+        args: tuple,
+        kwargs: dict[str, Any],
+        savefig_kwargs: dict[str, Any],
+    ) -> None:
+        if not self.config.enabled:
+            return
+        max_figures = self.config.max_figures
+        if max_figures is not None and self.num_figures >= max_figures:
+            if self.num_figures == max_figures:
+                logger.warning(
+                    f"Reached the limit of {max_figures} figures. "
+                    "Further figures are skipped"
+                )
+                self.num_figures += 1
+            return
+        self.num_figures += 1
+        job = (path, plot_func, args, kwargs, savefig_kwargs)
+        # Worker processes of a task (forked from the main process) cannot
+        # use the pool of the main process, so they render their own figures
+        if self.pool is None or os.getpid() != self.pid:
+            _render_figure(*job)
+            return
+        while len(self.pending) >= MAX_PENDING_PER_WORKER * self.config.workers:
+            self.pending.popleft().get()
+        # Arguments are pickled right away, so that later changes to them (in
+        # the main process) do not alter the figure
+        pickled_job = pickle.dumps(job, protocol=pickle.HIGHEST_PROTOCOL)
+        self.pending.append(
+            self.pool.apply_async(_render_pickled_figure, (pickled_job,))
+        )
+
+    def close(self) -> None:
+        """Wait for the figures in progress, and stop the worker processes."""
+        if self.pool is None:
+            return
+        try:
+            while self.pending:
+                self.pending.popleft().get()
+        except BaseException:
+            self.terminate()
+            raise
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self) -> None:
+        """Stop the worker processes, discarding the figures in progress."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+
+_renderer: Optional[_FigureRenderer] = None
+
+
+@contextmanager
+def plotting_session(config: PlottingConfig) -> Iterator[None]:
+    """Render the figures submitted within this context according to a
+    configuration. Background worker processes are started on entering, and
+    all figures are finished on exiting.
+
+    Args:
+        config: configuration of the figure rendering
+    """
+    global _renderer
+    renderer = _FigureRenderer(config)
+    previous_renderer, _renderer = _renderer, renderer
+    try:
+        yield
+    except BaseException:
+        renderer.terminate()
+        raise
+    else:
+        renderer.close()
+    finally:
+        _renderer = previous_renderer
+
+
+def submit_figure(
+    path: Optional[PathLike],
+    plot_func: Callable[..., matplotlib.figure.Figure],
+    *args: Any,
+    savefig_kwargs: Optional[dict[str, Any]] = None,
+    **kwargs: Any,
+) -> None:
+    """Create a figure with a plotting function, save it, and close it.
+
+    Within a plotting session with background workers, the figure is rendered
+    by a worker process and this function returns immediately (the plotting
+    function and its arguments must be picklable). Otherwise, the figure is
+    rendered in the calling process (as in the worker processes of multiprocess
+    tasks, whose figures count towards the limit separately). Figures may be
+    skipped, if plotting is disabled or the limit of figures is reached.
+
+    Args:
+        path: path of the saved figure. If None, the plotting function is
+            expected to save the figure itself.
+        plot_func: function returning a figure
+        *args: positional arguments of the plotting function
+        savefig_kwargs: keyword arguments of `Figure.savefig`
+        **kwargs: keyword arguments of the plotting function
+    """
+    renderer = _renderer
+    if renderer is None:
+        renderer = _FigureRenderer(PlottingConfig(workers=0))
+    renderer.submit(path, plot_func, args, kwargs, savefig_kwargs or {})
@@ -11,6 +11,8 @@ import networkx as nx
 import numpy as np
 import torch
 
+from move.data import io
+
 
 def plot_vae(
     path: Path,
@@ -50,7 +52,7 @@ def plot_vae(
         j: hidden node index
         i: latent node index
     """
-    model_weights = torch.load(path / filename)
+    model_weights = io.load_checkpoint(path / filename)
     G = nx.Graph()
 
     # Position of the layers:
@@ -0,0 +1,155 @@
+"""
+This code times the inference backends of the VAE (eager, TorchScript and
+torch.compile, see VAE.compile_inference) when reconstructing and projecting the
+encoded data of a MOVE workspace. The model is built from the model config of
+the given task, so its timings match those of the refits of that task. Its
+weights are not trained, which does not change the amount of work.
+
+It must be run from the workspace (i.e., the folder holding the config folder),
+after encoding the data (move-dl data=... task=encode_data).
+
+Args:
+-d or --data: name of the data config
+-t or --task: name of the task config providing the model and batch size
+-r or --repeats: number of timed passes over the data per backend
+-nt or --num_threads: number of threads used by torch
+
+Returns:
+    Table of the mean and standard deviation of the time (in ms) of a pass
+    over the data, and the largest absolute difference with the eager outputs.
+
+Example:
+
+    cd tutorial
+    move-dl data=random_small task=encode_data
+    python ../supplementary_files/benchmark_inference.py \\
+        -d random_small -t random_small__id_assoc_bayes
+
+"""
+
+import argparse
+import time
+from pathlib import Path
+from typing import Callable, cast
+
+import hydra
+import numpy as np
+import torch
+
+from move.data import io
+from move.data.dataloaders import MOVEDataset, make_dataloader
+from move.models.vae import VAE
+
+BACKENDS = ("eager", "script", "compile")
+
+parser = argparse.ArgumentParser(
+    description="Time the inference backends of the VAE on reconstruct/project"
+)
+parser.add_argument(
+    "-d",
+    "--data",
+    metavar="d",
+    type=str,
+    default="random_small",
+    help="name of the data config",
+)
+parser.add_argument(
+    "-t",
+    "--task",
+    metavar="t",
+    type=str,
+    default="random_small__id_assoc_bayes",
+    help="name of the task config providing the model and batch size",
+)
+parser.add_argument(
+    "-r",
+    "--repeats",
+    metavar="r",
+    type=int,
+    default=20,
+    help="number of timed passes over the data per backend",
+)
+parser.add_argument(
+    "-nt",
+    "--num_threads",
+    metavar="nt",
+    type=int,
+    default=None,
+    help="number of threads used by torch",
+)
+
+
+def time_pass(fn: Callable[[], object], repeats: int) -> tuple[float, float]:
+    """Returns the mean and standard deviation (in ms) of the time of `fn`."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1e3)
+    return float(np.mean(times)), float(np.std(times))
+
+
+def max_difference(output, reference) -> float:
+    """Returns the largest absolute difference between two (nested) outputs."""
+    if isinstance(output, (list, tuple)):
+        return max(
+            (max_difference(a, b) for a, b in zip(output, reference)), default=0.0
+        )
+    return float(np.max(np.abs(output - reference)))
+
+
+def main(args: argparse.Namespace) -> None:
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    config = io.read_config(args.data, args.task)
+    interim_path = Path(config.data.interim_data_path)
+    cat_list, _, con_list, _ = io.load_preprocessed_data(
+        interim_path,
+        config.data.categorical_names,
+        config.data.continuous_names,
+    )
+    dataloader = make_dataloader(
+        cat_list,
+        con_list,
+        shuffle=False,
+        sparse=config.data.sparse_input,
+        batch_size=config.task.batch_size,
+    )
+    dataset = cast(MOVEDataset, dataloader.dataset)
+
+    torch.manual_seed(0)
+    model: VAE = hydra.utils.instantiate(
+        config.task.model,
+        continuous_shapes=dataset.con_shapes,
+        categorical_shapes=dataset.cat_shapes,
+    )
+    model.eval()
+    print(
+        f"Model: {model}, {dataset.num_samples} samples, "
+        f"batch size {config.task.batch_size}, {torch.get_num_threads()} thread(s)"
+    )
+
+    references = {}
+    print(
+        f"{'backend':<10}{'method':<14}{'mean (ms)':>12}{'std (ms)':>12}"
+        f"{'max diff':>12}"
+    )
+    for backend in BACKENDS:
+        if backend != "eager":
+            model.compile_inference(backend)
+        for method in ("reconstruct", "project"):
+            fn = getattr(model, method)
+            # Warm-up pass (compilation happens here). The reconstruction
+            # samples the latent space, so the draws are seeded for comparison
+            torch.manual_seed(0)
+            output = fn(dataloader)
+            mean, std = time_pass(lambda: fn(dataloader), args.repeats)
+            if backend == "eager":
+                references[method] = output
+            diff = max_difference(output, references[method])
+            print(f"{backend:<10}{method:<14}{mean:>12.1f}{std:>12.1f}{diff:>12.1e}")
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
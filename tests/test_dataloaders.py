@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from move.data.dataloaders import MOVEDataLoader, PerturbedMOVEDataset, make_dataset
+
+
+def _make_dataset(num_samples=10, sparse=False):
+    rng = np.random.default_rng(0)
+    cat = np.eye(3, dtype=np.float32)[rng.integers(0, 3, size=(num_samples, 2))]
+    con = rng.normal(size=(num_samples, 4)).astype(np.float32)
+    return make_dataset([cat], [con], sparse=sparse)
+
+
+@pytest.mark.parametrize("is_categorical", [False, True])
+def test_perturbed_dataset_matches_perturbed_copy(is_categorical):
+    dataset = _make_dataset()
+    baseline_all = dataset.cat_all if is_categorical else dataset.con_all
+    baseline_copy = baseline_all.clone()
+    columns = torch.tensor([1, 3])
+    values = torch.tensor([5.0, -5.0]).expand(len(dataset), -1)
+
+    perturbed_dataset = PerturbedMOVEDataset(dataset, columns, values, is_categorical)
+    expected = baseline_all.clone()
+    expected[:, columns] = values
+    perturbed_all = (
+        perturbed_dataset.cat_all if is_categorical else perturbed_dataset.con_all
+    )
+    torch.testing.assert_close(perturbed_all, expected)
+
+    # Samples are perturbed one at a time, and the baseline is not modified
+    cat, con = next(iter(DataLoader(perturbed_dataset, batch_size=len(dataset))))
+    if is_categorical:
+        torch.testing.assert_close(cat, expected)
+        torch.testing.assert_close(con, dataset.con_all)
+    else:
+        torch.testing.assert_close(cat, dataset.cat_all)
+        torch.testing.assert_close(con, expected)
+    torch.testing.assert_close(baseline_all, baseline_copy)
+
+
+@pytest.mark.filterwarnings("ignore:Sparse CSR tensor support")
+def test_perturbed_dataset_validates_inputs():
+    dataset = _make_dataset()
+    columns = torch.tensor([0])
+    with pytest.raises(ValueError):
+        PerturbedMOVEDataset(dataset, columns, torch.zeros(3, 1), False)
+    with pytest.raises(ValueError):
+        PerturbedMOVEDataset(
+            _make_dataset(sparse=True), columns, torch.zeros(10, 1), False
+        )
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+@pytest.mark.parametrize("drop_last", [False, True])
+@pytest.mark.parametrize("perturbed", [False, True])
+def test_dataloader_batches_match_regular_dataloader(shuffle, drop_last, perturbed):
+    dataset = _make_dataset(num_samples=11)
+    if perturbed:
+        values = torch.zeros(len(dataset), 1)
+        dataset = PerturbedMOVEDataset(dataset, torch.tensor([2]), values, False)
+    kwargs = dict(batch_size=4, shuffle=shuffle, drop_last=drop_last)
+
+    torch.manual_seed(0)
+    expected = list(DataLoader(dataset, **kwargs))
+    expected_state = torch.get_rng_state()
+    torch.manual_seed(0)
+    batches = list(MOVEDataLoader(dataset, **kwargs))
+    assert len(batches) == len(expected)
+    for (cat, con), (expected_cat, expected_con) in zip(batches, expected):
+        torch.testing.assert_close(cat, expected_cat)
+        torch.testing.assert_close(con, expected_con)
+    # The random state is left as a regular DataLoader leaves it
+    torch.testing.assert_close(torch.get_rng_state(), expected_state)
+
+
+def test_dataloader_batches_of_a_single_data_type():
+    dataset = make_dataset(con_list=[np.arange(12, dtype=np.float32).reshape(6, 2)])
+    for (cat, con), (expected_cat, expected_con) in zip(
+        MOVEDataLoader(dataset, batch_size=4), DataLoader(dataset, batch_size=4)
+    ):
+        assert cat.shape == expected_cat.shape == (len(con), 0)
+        torch.testing.assert_close(con, expected_con)
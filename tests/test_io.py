@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import torch
+
+from move.data import io
+
+
+def test_checkpoint_round_trip(tmp_path):
+    path = tmp_path / "refit.pt"
+    model = torch.nn.Linear(4, 3)
+    io.dump_checkpoint(path, model.state_dict())
+    state_dict = io.load_checkpoint(path)
+    assert state_dict.keys() == model.state_dict().keys()
+    for name, value in model.state_dict().items():
+        torch.testing.assert_close(state_dict[name], value)
+
+    # Loaded tensors can be modified without changing the file
+    state_dict["weight"].zero_()
+    torch.testing.assert_close(io.load_checkpoint(path)["weight"], model.weight.data)
+
+    recon = torch.randn(5, 2)
+    io.dump_checkpoint(path, recon)
+    torch.testing.assert_close(io.load_checkpoint(path), recon)
+
+
+def test_load_checkpoint_of_older_versions(tmp_path):
+    recon = np.random.default_rng(0).normal(size=(5, 2)).astype(np.float32)
+    model = torch.nn.Linear(4, 3)
+    legacy_files = {
+        "pickled_array.pt": (recon, {"pickle_protocol": 4}),
+        "pickled_module.pt": (model, {}),
+        "legacy_format.pt": (
+            model.state_dict(),
+            {"_use_new_zipfile_serialization": False},
+        ),
+    }
+    for name, (obj, kwargs) in legacy_files.items():
+        path = tmp_path / name
+        torch.save(obj, path, **kwargs)
+        # Older checkpoints are neither unpickled nor rewritten by a plain load
+        content = path.read_bytes()
+        with pytest.raises(ValueError, match="convert_checkpoint"):
+            io.load_checkpoint(path)
+        assert path.read_bytes() == content
+
+        # Once converted, they are loaded memory-mapped
+        converted = io.convert_checkpoint(path)
+        loaded = io.load_checkpoint(path)
+        if isinstance(obj, np.ndarray):
+            np.testing.assert_array_equal(converted.numpy(), obj)
+            np.testing.assert_array_equal(loaded.numpy(), obj)
+        else:
+            for key, value in model.state_dict().items():
+                torch.testing.assert_close(converted[key], value)
+                torch.testing.assert_close(loaded[key], value)
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+from scipy.stats import ks_2samp, pearsonr
+
+from move.analysis.metrics import (
+    MAX_EXACT_KS_SAMPLES,
+    calculate_ks_statistics,
+    calculate_reconstruction_qc,
+)
+
+
+def _ks_2samp_columns(data1, data2):
+    results = [ks_2samp(data1[:, i], data2[:, i]) for i in range(data1.shape[1])]
+    statistics = np.array([res.statistic for res in results])
+    signs = np.array([res.statistic_sign for res in results], dtype=float)
+    return statistics, signs
+
+
+@pytest.mark.parametrize("chunk_size", [None, 3])
+def test_ks_statistics_match_scipy(chunk_size):
+    rng = np.random.default_rng(0)
+    data1 = rng.normal(size=(50, 10))
+    data2 = rng.normal(0.3, size=(37, 10))
+    statistics, signs = calculate_ks_statistics(data1, data2, chunk_size)
+    expected_statistics, expected_signs = _ks_2samp_columns(data1, data2)
+    np.testing.assert_array_equal(statistics, expected_statistics)
+    np.testing.assert_array_equal(signs, expected_signs)
+
+
+def test_ks_statistics_with_ties_match_scipy():
+    rng = np.random.default_rng(1)
+    # Few distinct values, with ties within and across samples
+    data1 = rng.integers(0, 4, size=(40, 20)).astype(float)
+    data2 = rng.integers(1, 5, size=(60, 20)).astype(float)
+    data2[:40, 0] = data1[:, 0]  # overlapping samples
+    data1[:, 1] = data2[:, 1] = 2.0  # constant and equal samples
+    statistics, signs = calculate_ks_statistics(data1, data2)
+    expected_statistics, expected_signs = _ks_2samp_columns(data1, data2)
+    np.testing.assert_array_equal(statistics, expected_statistics)
+    np.testing.assert_array_equal(signs, expected_signs)
+
+
+def test_ks_statistics_of_large_samples_match_scipy():
+    rng = np.random.default_rng(2)
+    data1 = np.round(rng.normal(size=(MAX_EXACT_KS_SAMPLES + 1, 3)), 2)
+    data2 = np.round(rng.normal(0.1, size=(MAX_EXACT_KS_SAMPLES + 7, 3)), 2)
+    statistics, signs = calculate_ks_statistics(data1, data2)
+    expected_statistics, expected_signs = _ks_2samp_columns(data1, data2)
+    np.testing.assert_allclose(statistics, expected_statistics, rtol=0, atol=1e-12)
+    np.testing.assert_array_equal(signs, expected_signs)
+
+
+def test_ks_statistics_of_columns_with_nan():
+    data1 = np.arange(12.0).reshape(6, 2)
+    data2 = np.arange(8.0).reshape(4, 2)
+    data1[0, 1] = np.nan
+    statistics, signs = calculate_ks_statistics(data1, data2)
+    assert not np.isnan(statistics[0]) and not np.isnan(signs[0])
+    assert np.isnan(statistics[1]) and np.isnan(signs[1])
+
+
+def test_ks_statistics_validate_shapes():
+    with pytest.raises(ValueError):
+        calculate_ks_statistics(np.zeros((3, 2)), np.zeros((3, 3)))
+    with pytest.raises(ValueError):
+        calculate_ks_statistics(np.zeros(3), np.zeros(3))
+
+
+@pytest.mark.parametrize("chunk_size", [None, 4])
+def test_reconstruction_qc_matches_polyfit_and_pearsonr(chunk_size):
+    rng = np.random.default_rng(3)
+    # Features with offsets and scales far from standard
+    original = rng.normal(50.0, 10.0, size=(80, 9))
+    reconstruction = (
+        0.01 * original**2 - original + rng.normal(scale=5.0, size=original.shape)
+    )
+    coefficients, correlations = calculate_reconstruction_qc(
+        original, reconstruction, chunk_size
+    )
+    for i in range(original.shape[1]):
+        x, y = original[:, i], reconstruction[:, i]
+        np.testing.assert_allclose(
+            coefficients[i], np.polyfit(x, y, deg=2), rtol=1e-6, atol=1e-8
+        )
+        np.testing.assert_allclose(correlations[i], pearsonr(x, y).statistic)
+
+
+def test_reconstruction_qc_of_constant_features():
+    rng = np.random.default_rng(4)
+    original = rng.normal(size=(20, 2))
+    original[:, 1] = 3.0
+    reconstruction = rng.normal(size=(20, 2))
+    coefficients, correlations = calculate_reconstruction_qc(original, reconstruction)
+    np.testing.assert_allclose(
+        coefficients[1], [0.0, 0.0, reconstruction[:, 1].mean()], atol=1e-12
+    )
+    assert np.isnan(correlations[1]) and not np.isnan(correlations[0])
+    with pytest.raises(ValueError):
+        calculate_reconstruction_qc(original, reconstruction[:, :1])
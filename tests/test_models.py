@@ -0,0 +1,171 @@
+import copy
+
+import pytest
+import torch
+
+from move.models.ensemble import EnsembleVAE
+from move.models.inference import FoldedVAE
+from move.models.vae import VAE
+
+NUM_SAMPLES = 16
+
+
+def _make_vae(seed, **kwargs):
+    torch.manual_seed(seed)
+    return VAE(
+        categorical_shapes=[(5, 3)],
+        continuous_shapes=[6, 4],
+        num_hidden=kwargs.pop("num_hidden", [32, 16]),
+        num_latent=4,
+        categorical_weights=[1],
+        continuous_weights=[1, 2],
+        **kwargs,
+    )
+
+
+def _make_batch():
+    generator = torch.Generator().manual_seed(0)
+    categories = torch.randint(0, 3, (NUM_SAMPLES, 5), generator=generator)
+    cat = torch.nn.functional.one_hot(categories, 3).float().flatten(1)
+    con = torch.randn(NUM_SAMPLES, 10, generator=generator)
+    return cat, con
+
+
+@pytest.fixture
+def no_sampling(monkeypatch):
+    """Take the mean latent vectors instead of sampling the latent space."""
+    monkeypatch.setattr(VAE, "reparameterize", lambda self, mu, logvar: mu)
+
+
+def test_ensemble_outputs_match_members(no_sampling):
+    models = [_make_vae(seed) for seed in range(3)]
+    for model in models:
+        model.eval()
+    ensemble = EnsembleVAE(models).eval()
+    cat, con = _make_batch()
+    x = torch.cat((cat, con), dim=1)
+
+    with torch.no_grad():
+        reconstruction, mu, logvar = ensemble(x)
+        for j, model in enumerate(models):
+            _, con_out, model_mu, model_logvar = model(x)
+            torch.testing.assert_close(mu[j], model_mu)
+            torch.testing.assert_close(logvar[j], model_logvar)
+            con_reconstruction = reconstruction[j, :, model.num_categorical :]
+            torch.testing.assert_close(con_reconstruction, con_out)
+
+
+def test_ensemble_gradients_match_members(no_sampling):
+    models = [_make_vae(seed, dropout=0.0) for seed in range(3)]
+    ensemble = EnsembleVAE([copy.deepcopy(model) for model in models]).train()
+    template = ensemble.template
+    cat, con = _make_batch()
+    x = torch.cat((cat, con), dim=1)
+
+    # The ensemble is trained on the sum of the losses of its members
+    reconstruction, mu, logvar = ensemble(x)
+    reconstruction = reconstruction.flatten(0, 1)
+    loss, *_ = template.loss_function(
+        cat.repeat(3, 1),
+        template.decompose_categorical(reconstruction),
+        con.repeat(3, 1),
+        reconstruction[:, template.num_categorical :],
+        mu.flatten(0, 1),
+        logvar.flatten(0, 1),
+        1.0,
+    )
+    (loss * 3).backward()
+
+    for j, model in enumerate(models):
+        model.train()
+        cat_out, con_out, model_mu, model_logvar = model(x)
+        model_loss, *_ = model.loss_function(
+            cat, cat_out, con, con_out, model_mu, model_logvar, 1.0
+        )
+        model_loss.backward()
+        for name in ensemble.linear_names:
+            key = name.replace(".", "_")
+            torch.testing.assert_close(
+                ensemble.weights[key].grad[j].T,
+                model.get_submodule(name).weight.grad,
+                rtol=1e-4,
+                atol=1e-6,
+            )
+        # Running statistics of the batch normalizations are updated alike
+        state_dict = ensemble.member_state_dict(j)
+        for name, value in model.state_dict().items():
+            torch.testing.assert_close(state_dict[name], value)
+
+
+def test_ensemble_member_state_dicts_round_trip():
+    models = [_make_vae(seed) for seed in range(2)]
+    ensemble = EnsembleVAE(models)
+    for j, model in enumerate(models):
+        copy_model = _make_vae(100)
+        copy_model.load_state_dict(ensemble.member_state_dict(j))
+        for name, value in model.state_dict().items():
+            torch.testing.assert_close(copy_model.state_dict()[name], value)
+
+
+def test_ensemble_members_must_share_their_architecture():
+    with pytest.raises(ValueError):
+        EnsembleVAE([_make_vae(0), _make_vae(1, num_hidden=[32, 8])])
+
+
+def _make_trained_vae():
+    """Return a VAE in evaluation mode, with non-trivial batch normalizations."""
+    model = _make_vae(0, num_hidden=[32, 16, 8])
+    generator = torch.Generator().manual_seed(1)
+    with torch.no_grad():
+        for norm in [*model.encodernorms, *model.decodernorms]:
+            norm.weight.uniform_(0.5, 2.0, generator=generator)
+            norm.bias.normal_(generator=generator)
+        # Update the running statistics
+        model.train()
+        for _ in range(5):
+            model(3 * torch.randn(NUM_SAMPLES, 25, generator=generator) + 1)
+    return model.eval()
+
+
+def test_folded_vae_matches_model_in_evaluation_mode():
+    model = _make_trained_vae()
+    folded = FoldedVAE(model)
+    cat, con = _make_batch()
+    x = torch.cat((cat, con), dim=1)
+
+    with torch.no_grad():
+        preactivation = model.preactivate(x)
+        mu, logvar = model.encode_preactivation(preactivation)
+        folded_mu, folded_logvar = folded.encode_preactivation(preactivation)
+        torch.testing.assert_close(folded_mu, mu, rtol=1e-5, atol=1e-5)
+        torch.testing.assert_close(folded_logvar, logvar, rtol=1e-5, atol=1e-5)
+
+        cat_out, con_out = model.decode(mu)
+        reconstruction = folded.decode(mu)
+        torch.testing.assert_close(
+            reconstruction[:, model.num_categorical :], con_out, rtol=1e-5, atol=1e-5
+        )
+        torch.testing.assert_close(
+            model.decompose_categorical(reconstruction)[0],
+            cat_out[0],
+            rtol=1e-5,
+            atol=1e-5,
+        )
+
+
+@pytest.mark.filterwarnings("ignore:`torch.jit:FutureWarning")
+def test_compiled_inference_is_used_in_evaluation_mode():
+    model = _make_trained_vae()
+    cat, con = _make_batch()
+    x = torch.cat((cat, con), dim=1)
+    with torch.no_grad():
+        mu, logvar = model.encode(x)
+        model.compile_inference("script")
+        compiled_mu, compiled_logvar = model.encode(x)
+        torch.testing.assert_close(compiled_mu, mu, rtol=1e-5, atol=1e-5)
+        torch.testing.assert_close(compiled_logvar, logvar, rtol=1e-5, atol=1e-5)
+    assert model._get_inference() is not None
+
+    # Training discards the compiled graph
+    model.train()
+    assert model._inference is None
@@ -0,0 +1,155 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+from scipy.stats import ttest_rel
+from torch.utils.data import DataLoader
+
+from move.data import io
+from move.data.dataloaders import make_dataset
+from move.data.perturbations import (
+    perturb_categorical_data_one,
+    perturb_continuous_data_extended_one,
+)
+from move.tasks.perturbation_engine import (
+    calculate_ttest_pvalues_block,
+    get_block_delta,
+    get_self_association_mask,
+    select_bayes_associations,
+)
+
+
+@pytest.mark.parametrize(
+    "target_dataset, target_value",
+    [
+        ("cat_b", "y"),
+        ("con_b", "minimum"),
+        ("con_b", "maximum"),
+        ("con_b", "plus_std"),
+        ("con_b", "minus_std"),
+    ],
+)
+def test_block_delta_matches_perturbed_datasets(tmp_path, target_dataset, target_value):
+    rng = np.random.default_rng(0)
+    num_samples = 12
+    cat_list = [
+        np.eye(num_classes, dtype=np.float32)[
+            rng.integers(0, num_classes, size=(num_samples, num_features))
+        ]
+        for num_features, num_classes in [(2, 3), (4, 2)]
+    ]
+    con_list = [
+        rng.normal(size=(num_samples, num_features)).astype(np.float32)
+        for num_features in (3, 5)
+    ]
+    baseline_dataset = make_dataset(cat_list, con_list)
+    baseline_dataloader = DataLoader(baseline_dataset, batch_size=num_samples)
+    io.dump_mappings(tmp_path / "mappings.json", {"cat_b": {"x": 0, "y": 1}})
+    config = SimpleNamespace(
+        data=SimpleNamespace(
+            categorical_names=["cat_a", "cat_b"],
+            continuous_names=["con_a", "con_b"],
+            interim_data_path=str(tmp_path),
+        )
+    )
+    task_config = SimpleNamespace(
+        target_dataset=target_dataset, target_value=target_value
+    )
+    feature_ids = [3, 0, 2]
+
+    delta, columns = get_block_delta(config, task_config, baseline_dataset, feature_ids)
+    baseline_input = torch.cat((baseline_dataset.cat_all, baseline_dataset.con_all), 1)
+    expected_mask = np.zeros((len(feature_ids), 8), dtype=bool)
+    for k, i in enumerate(feature_ids):
+        if target_dataset == "cat_b":
+            target_encoded = np.array([[0, 1]])
+            perturbed_dataloader = perturb_categorical_data_one(
+                baseline_dataloader, ["cat_a", "cat_b"], "cat_b", target_encoded, i
+            )
+        else:
+            perturbed_dataloader = perturb_continuous_data_extended_one(
+                baseline_dataloader, ["con_a", "con_b"], "con_b", target_value, i
+            )
+        perturbed_input = torch.cat(next(iter(perturbed_dataloader)), 1)
+        # Only the perturbed columns change, by exactly the delta
+        expected = perturbed_input - baseline_input
+        changed = np.flatnonzero(expected.abs().sum(0))
+        assert set(changed) <= set(columns[k].tolist())
+        torch.testing.assert_close(delta[k], expected[:, columns[k]], rtol=0, atol=0)
+        # Self-associations are masked if the first sample changes
+        expected_mask[k] = (expected[0, -8:] != 0).numpy()
+
+    if target_dataset == "con_b":
+        mask = get_self_association_mask(baseline_dataset, delta, columns)
+        np.testing.assert_array_equal(mask, expected_mask)
+
+
+def test_ttest_pvalues_block_matches_ttest_rel():
+    rng = np.random.default_rng(0)
+    num_perturbed, num_samples, num_continuous = 3, 30, 8
+    perturb_recon = rng.normal(size=(num_perturbed, num_samples, num_continuous))
+    baseline_recon = rng.normal(size=(num_samples, num_continuous))
+    baseline_diff = rng.normal(scale=0.1, size=(num_samples, num_continuous))
+    nan_mask = rng.random((num_samples, num_continuous)) < 0.2
+    nan_mask[1:, -1] = True  # a single valid sample, so no p-value
+    feature_mask = rng.random((num_samples, num_perturbed)) < 0.2
+
+    pvalues = calculate_ttest_pvalues_block(
+        perturb_recon, baseline_recon, baseline_diff, nan_mask, feature_mask
+    )
+    for k in range(num_perturbed):
+        mask = feature_mask[:, [k]] | nan_mask
+        with np.errstate(divide="ignore", invalid="ignore"):
+            _, expected = ttest_rel(
+                a=np.where(mask, np.nan, perturb_recon[k] - baseline_recon),
+                b=np.where(mask, np.nan, baseline_diff),
+                axis=0,
+                nan_policy="omit",
+            )
+        np.testing.assert_allclose(pvalues[k], expected, rtol=1e-10)
+    assert np.isnan(pvalues[:, -1]).all()
+
+
+def _select_by_full_sort(bayes_k, bayes_mask, sig_threshold):
+    """Reference selection: rank all associations with a reversed stable sort."""
+    bayes_abs = np.abs(bayes_k)
+    bayes_p = np.exp(bayes_abs) / (1.0 + np.exp(bayes_abs))
+    bayes_abs[bayes_mask] = np.min(bayes_abs)
+    sort_ids = np.argsort(bayes_abs, axis=None, kind="stable")[::-1]
+    prob = bayes_p.ravel()[sort_ids]
+    fdr = np.cumsum(1 - prob) / np.arange(1, prob.size + 1)
+    idx = int(np.argmin(np.abs(fdr - sig_threshold)))
+    sort_ids = sort_ids[:idx]
+    return sort_ids, prob[:idx], fdr[:idx], bayes_k.ravel()[sort_ids]
+
+
+@pytest.mark.parametrize("sig_threshold", [0.01, 0.05, 0.2, 0.5])
+@pytest.mark.parametrize("num_top", [1, 16, 2**16])
+def test_select_bayes_associations_matches_full_sort(sig_threshold, num_top):
+    rng = np.random.default_rng(0)
+    # Rounded values, so that there are many ties
+    bayes_k = np.round(rng.normal(scale=3.0, size=(40, 60)), 1)
+    bayes_mask = rng.random((40, 60)) < 0.1
+    expected = _select_by_full_sort(bayes_k, bayes_mask, sig_threshold)
+    actual = select_bayes_associations(bayes_k, bayes_mask, sig_threshold, num_top)
+    np.testing.assert_array_equal(actual[0], expected[0])
+    for actual_values, expected_values in zip(actual[1:], expected[1:]):
+        np.testing.assert_allclose(actual_values, expected_values)
+
+
+def test_select_bayes_associations_tie_order():
+    # Ties are ranked by descending flat index, not in np.argsort order
+    bayes_k = np.array([[5.0, -5.0], [5.0, 0.0]])
+    bayes_mask = np.zeros_like(bayes_k, dtype=bool)
+    sort_ids, prob, fdr, selected_k = select_bayes_associations(
+        bayes_k, bayes_mask, 1.0, num_top=1
+    )
+    np.testing.assert_array_equal(sort_ids, [2, 1, 0])
+    np.testing.assert_array_equal(selected_k, [5.0, -5.0, 5.0])
+
+    # Self-associations are ranked last, also by descending flat index
+    bayes_k = np.array([[1.0, 4.0, 2.0], [3.0, 0.5, 0.5]])
+    bayes_mask = np.array([[True, False, False], [False, False, True]])
+    sort_ids, *_ = select_bayes_associations(bayes_k, bayes_mask, 1.0)
+    np.testing.assert_array_equal(sort_ids, [1, 3, 2, 5, 4])
@@ -0,0 +1,62 @@
+import numpy as np
+
+from move.tasks.results_store import ResultsStore
+
+
+def test_results_store_resumes(tmp_path):
+    signature = {"task": "bayes", "seed": 1}
+    store = ResultsStore(tmp_path, signature)
+    assert len(store) == 0
+    store.save("refit_1", stats=np.arange(3.0), signs=np.ones(3))
+    store.save("refit_0", stats=np.zeros(2))
+
+    store = ResultsStore(tmp_path, signature)
+    assert store.keys() == ["refit_0", "refit_1"]
+    assert "refit_1" in store and "refit_2" not in store
+    entry = store.load("refit_1")
+    np.testing.assert_array_equal(entry["stats"], np.arange(3.0))
+    np.testing.assert_array_equal(entry["signs"], np.ones(3))
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_results_store_discards_results_of_another_signature(tmp_path):
+    store = ResultsStore(tmp_path, {"task": "bayes", "seed": 1})
+    store.save("refit_0", stats=np.zeros(2))
+
+    store = ResultsStore(tmp_path, {"task": "bayes", "seed": 2})
+    assert len(store) == 0
+    store.save("refit_0", stats=np.ones(2))
+
+    # The new signature is kept
+    store = ResultsStore(tmp_path, {"task": "bayes", "seed": 2})
+    np.testing.assert_array_equal(store.load("refit_0")["stats"], np.ones(2))
+
+
+def test_results_store_clear(tmp_path):
+    signature = {"task": "ttest", "path": tmp_path}  # not JSON-serializable
+    store = ResultsStore(tmp_path, signature)
+    store.save("refit_0", pvalues=np.zeros(2))
+    store.clear()
+    assert len(store) == 0
+
+    store.save("refit_0", pvalues=np.zeros(2))
+    store = ResultsStore(tmp_path, signature, resume=False)
+    assert len(store) == 0
+
+
+def test_results_store_subdirectories(tmp_path):
+    signature = {"task": "bayes", "seed": 1}
+    store = ResultsStore(tmp_path, signature)
+    refits_path = store.subdirectory("refits")
+    (refits_path / "model_0.pt").write_bytes(b"weights")
+    store.save("features_0", bayes_k=np.zeros(2))
+
+    # Subdirectories are kept when resuming and when entries are cleared
+    store = ResultsStore(tmp_path, signature)
+    store.clear()
+    assert store.subdirectory("refits") == refits_path
+    assert (refits_path / "model_0.pt").exists()
+
+    # They are discarded with the results of another signature
+    store = ResultsStore(tmp_path, {"task": "bayes", "seed": 2})
+    assert not refits_path.exists()